@@ -0,0 +1,75 @@
+#!python
+"""Measures the wall-clock time needed to stash and apply a patch on a
+Mercurial repository, both with and without a Mercurial command server.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from stash.repository import MercurialRepository
+from stash.stash import Stash
+
+def create_repository(path, file_count):
+    """Creates a Mercurial repository at *path* containing *file_count*
+    committed files.
+    """
+    os.mkdir(path)
+    repository = MercurialRepository(path, create=True)
+    file_names = ['file%d' % i for i in range(file_count)]
+    for file_name in file_names:
+        with open(os.path.join(path, file_name), 'w') as f:
+            f.write('123\n')
+    repository.add(file_names)
+    repository.commit('Initial commit.')
+    repository.close()
+
+def time_round_trips(path, rounds, modified_count):
+    """Stashes and applies a patch *rounds* times on the repository at *path*.
+    Returns a tuple containing the total time spent on creating and applying
+    the patches.
+    """
+    create_time, apply_time = 0.0, 0.0
+    stash = Stash(path)
+    for _ in range(rounds):
+        for i in range(modified_count):
+            with open(os.path.join(path, 'file%d' % i), 'w') as f:
+                f.write('321\n')
+
+        start = time.time()
+        stash.create_patch('benchmark')
+        create_time += time.time() - start
+
+        start = time.time()
+        stash.apply_patch('benchmark')
+        apply_time += time.time() - start
+
+        stash.repository.revert_all()
+    stash.repository.close()
+    return create_time, apply_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--rounds', type=int, default=5, help='number of create/apply round trips')
+    parser.add_argument('-f', '--files', type=int, default=100, help='number of files in the repository')
+    parser.add_argument('-m', '--modified', type=int, default=10, help='number of modified files per patch')
+    args = parser.parse_args()
+
+    temp_path = tempfile.mkdtemp(prefix='stash-benchmark-')
+    try:
+        Stash.STASH_PATH = os.path.join(temp_path, 'stash')
+        repository_path = os.path.join(temp_path, 'repo')
+        create_repository(repository_path, args.files)
+
+        for use_command_server in (False, True):
+            MercurialRepository.USE_COMMAND_SERVER = use_command_server
+            create_time, apply_time = time_round_trips(repository_path, args.rounds, args.modified)
+            print('%-16s create: %.3fs  apply: %.3fs  (%d rounds)' % \
+                    ('command server' if use_command_server else 'one-shot', create_time, apply_time, args.rounds))
+    finally:
+        shutil.rmtree(temp_path)
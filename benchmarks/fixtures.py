@@ -0,0 +1,91 @@
+"""Synthetic working copies used by the stash benchmarks."""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from stash.repository import GitRepository, MercurialRepository, SubversionRepository
+
+REPOSITORY_CLASSES = {
+    'git': GitRepository,
+    'hg': MercurialRepository,
+    'svn': SubversionRepository,
+}
+"""Repository implementations that can be benchmarked, by name."""
+
+class WorkingCopy(object):
+    """A synthetic working copy containing *files* committed files of *lines*
+    lines each, of which *binary* files contain binary data. Files are spread
+    over several directories.
+    """
+
+    FILES_PER_DIRECTORY = 100
+
+    def __init__(self, vcs, path, files, lines=20, binary=0, seed=0):
+        self.path = path
+        self.files = files
+        self.lines = lines
+        self.binary = binary
+        self._random = random.Random(seed)
+
+        os.mkdir(path)
+        self.repository = REPOSITORY_CLASSES[vcs](path, create=True)
+
+        file_names = [self.get_file_name(i) for i in range(files)]
+        for i, file_name in enumerate(file_names):
+            self._write(file_name, self._contents(i, 0))
+        self.repository.add(file_names)
+        self.repository.commit('Initial commit.')
+
+        super(WorkingCopy, self).__init__()
+
+    def get_file_name(self, i):
+        """Returns the name of committed file number *i*."""
+        return os.path.join('dir%d' % (i // self.FILES_PER_DIRECTORY), 'file%d' % i)
+
+    def _contents(self, i, generation):
+        """Returns the contents of file number *i* for the given modification
+        *generation*.
+        """
+        if i < self.binary:
+            data = bytearray(self._random.getrandbits(8) for _ in range(self.lines * 16))
+            data[0] = 0
+            return bytes(data)
+        return ''.join('line %d of file %d, generation %d\n' % (line, i, generation if line % 4 == 0 else 0)
+                       for line in range(self.lines)).encode('ascii')
+
+    def _write(self, file_name, data):
+        path = os.path.join(self.path, file_name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def change(self, modified, added, deleted, generation=1):
+        """Modifies the first *modified* files (starting with the binary
+        ones), adds *added* new files to the repository, and removes the last
+        *deleted* files from the repository.
+        """
+        for i in range(min(modified, self.files)):
+            self._write(self.get_file_name(i), self._contents(i, generation))
+
+        added_file_names = [os.path.join('new', 'file%d' % i) for i in range(added)]
+        for i, file_name in enumerate(added_file_names):
+            self._write(file_name, self._contents(self.files + i, generation))
+        if added_file_names:
+            self.repository.add(added_file_names)
+
+        deleted_file_names = [self.get_file_name(i) for i in range(max(self.files - deleted, 0), self.files)]
+        if deleted_file_names:
+            self.repository.remove(deleted_file_names)
+
+def is_available(vcs):
+    """Returns whether the command-line tools for *vcs* are installed."""
+    command = {'git': 'git', 'hg': 'hg', 'svn': 'svnadmin'}[vcs]
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(directory, command), os.X_OK):
+            return True
+    return False
@@ -0,0 +1,166 @@
+#!python
+"""Benchmarks the core stash operations on synthetic Mercurial and Subversion
+working copies of increasing size, and writes the results as JSON. Results of
+two runs can be compared to detect performance regressions.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from fixtures import REPOSITORY_CLASSES, WorkingCopy, is_available
+
+from stash.repository import Repository
+from stash.stash import Stash
+
+clock = getattr(time, 'perf_counter', time.time)
+"""Most precise clock available for measuring wall-clock time."""
+
+OPERATIONS = ['create_patch', 'get_patches', 'get_patch', 'write_patch', 'apply_patch']
+"""Operations that are timed, in the order in which they are executed."""
+
+def median(values):
+    """Returns the median of the list of *values*."""
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def run_scenario(vcs, path, files, modified, added, deleted, binary, lines, repeat, watch=False):
+    """Creates a working copy with the given parameters at *path*, and times
+    all :py:data:`OPERATIONS` *repeat* times. In case *watch* is set, the
+    working copy is watched for changes. Returns a dictionary mapping each
+    operation to a list of wall-clock times in seconds.
+    """
+    working_copy = WorkingCopy(vcs, os.path.join(path, 'repo'), files, lines, binary)
+    stash = Stash(working_copy.path)
+    if watch:
+        stash.repository.watch()
+
+    times = dict((operation, []) for operation in OPERATIONS)
+    def timed(operation, function, *args):
+        start = clock()
+        result = function(*args)
+        times[operation].append(clock() - start)
+        return result
+
+    for generation in range(1, repeat + 1):
+        working_copy.change(modified, added, deleted, generation)
+
+        timed('create_patch', stash.create_patch, 'benchmark')
+        timed('get_patches', Stash.get_patches)
+        timed('get_patch', Stash.get_patch, 'benchmark')
+        timed('write_patch', Stash.write_patch, 'benchmark', io.BytesIO())
+        if not timed('apply_patch', stash.apply_patch, 'benchmark'):
+            raise RuntimeError('benchmark patch did not apply cleanly')
+
+        # Stash the changes once more to restore the unmodified working copy.
+        stash.create_patch('cleanup')
+        Stash.remove_patch('cleanup')
+
+    stash.repository.close()
+    working_copy.repository.close()
+    return times
+
+def compare(results, baseline, threshold, minimum_delta):
+    """Prints a comparison of *results* with *baseline*. Returns ``True`` in
+    case any operation became slower by more than a factor *threshold*, and by
+    more than *minimum_delta* seconds.
+    """
+    def key(result):
+        return tuple(result[parameter] for parameter in ('vcs', 'files', 'modified', 'added', 'deleted', 'binary', 'lines', 'operation'))
+
+    baseline = dict((key(result), result) for result in baseline['results'])
+    regressed = False
+    for result in results['results']:
+        reference = baseline.get(key(result))
+        if reference is None or not reference['median']:
+            continue
+        ratio = result['median'] / reference['median']
+        marker = ''
+        if ratio > threshold and result['median'] - reference['median'] > minimum_delta:
+            marker = '  REGRESSION'
+            regressed = True
+        print('%-4s %7d files  %-13s %8.4fs -> %8.4fs  (x%.2f)%s' % \
+                (result['vcs'], result['files'], result['operation'], reference['median'], result['median'], ratio, marker))
+    return regressed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--vcs', nargs='+', choices=sorted(REPOSITORY_CLASSES), default=sorted(REPOSITORY_CLASSES), \
+            help='version control systems to benchmark, unavailable ones are skipped')
+    parser.add_argument('--files', nargs='+', type=int, default=[100, 1000], help='number of files in each working copy')
+    parser.add_argument('--modified', type=float, default=0.1, help='fraction of files that is modified')
+    parser.add_argument('--added', type=float, default=0.02, help='number of added files, as a fraction of the number of files')
+    parser.add_argument('--deleted', type=float, default=0.02, help='fraction of files that is deleted')
+    parser.add_argument('--binary', type=float, default=0.01, help='fraction of files containing binary data')
+    parser.add_argument('--lines', type=int, default=20, help='number of lines per file, determines the patch size')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='number of times each operation is timed')
+    parser.add_argument('--serial', action='store_true', \
+            help='execute all version control queries serially instead of overlapping independent ones')
+    parser.add_argument('--watch', action='store_true', \
+            help='watch the working copy for changes, so queries only examine paths that may have changed')
+    parser.add_argument('-o', '--output', help='file to write the results to in JSON format')
+    parser.add_argument('--compare', metavar='BASELINE', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, \
+            help='slow down factor above which an operation is reported as a regression')
+    parser.add_argument('--minimum-delta', type=float, default=0.005, \
+            help='slow down in seconds below which an operation is never reported as a regression')
+    args = parser.parse_args()
+
+    if args.serial:
+        Repository.MAX_WORKERS = 0
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'serial': args.serial,
+        'watch': args.watch,
+        'results': [],
+    }
+
+    temp_path = tempfile.mkdtemp(prefix='stash-benchmark-')
+    try:
+        Stash.STASH_PATH = os.path.join(temp_path, 'stash')
+        for vcs in args.vcs:
+            if not is_available(vcs):
+                sys.stderr.write("Skipping '%s', it is not installed.\n" % vcs)
+                continue
+
+            for files in args.files:
+                parameters = {
+                    'vcs': vcs,
+                    'files': files,
+                    'modified': int(files * args.modified),
+                    'added': int(files * args.added),
+                    'deleted': int(files * args.deleted),
+                    'binary': int(files * args.binary),
+                    'lines': args.lines,
+                }
+
+                scenario_path = os.path.join(temp_path, '%s-%d' % (vcs, files))
+                os.mkdir(scenario_path)
+                times = run_scenario(path=scenario_path, repeat=args.repeat, watch=args.watch, **parameters)
+                shutil.rmtree(scenario_path)
+
+                for operation in OPERATIONS:
+                    result = dict(parameters, operation=operation, times=times[operation], median=median(times[operation]))
+                    results['results'].append(result)
+                    print('%-4s %7d files  %-13s %8.4fs' % (vcs, files, operation, result['median']))
+    finally:
+        shutil.rmtree(temp_path)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold, args.minimum_delta):
+                sys.exit(1)
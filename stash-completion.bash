@@ -10,7 +10,7 @@ _stash()
     opts=( -r --remove -s --show -a --apply )
 
     case "${opts[@]}" in *"${prev}"*)
-        patches=`ls $HOME/.patches/`
+        patches=`stash.py -l 2>/dev/null`
         COMPREPLY=( $(compgen -W "${patches}" -- ${cur}) )
         return 0
     esac
@@ -0,0 +1,274 @@
+import argparse
+import errno
+import os
+import signal
+import sys
+import time
+
+from . import trace
+from .client import get_socket_path
+from .compression import get_codecs
+from .exception import StashException
+from .index import PatchIndex
+from .patch import HunkStatus
+from .repository import Repository
+from .stash import PatchState, Stash
+
+def parse_time(value):
+    """Parses a date, optionally followed by a time, to seconds since the
+    epoch.
+    """
+    for time_format in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date '%s', expected YYYY-MM-DD [HH:MM[:SS]]" % value)
+
+def get_repository_root(path):
+    """Returns the absolute root path of the repository *path* is part of, or
+    the absolute path of *path* in case it is not part of a repository.
+    """
+    try:
+        return os.path.abspath(Repository(path).root_path)
+    except (StashException, OSError):
+        return os.path.abspath(path)
+
+def get_repository_paths(paths):
+    """Returns *paths* relative to the root of the repository the current
+    working directory is part of. In case the current working directory is not
+    part of a repository, *paths* are returned unmodified.
+    """
+    try:
+        root_path = os.path.abspath(Repository(os.getcwd()).root_path)
+    except (StashException, OSError):
+        return paths
+    return [os.path.relpath(os.path.abspath(path), root_path) for path in paths]
+
+def print_stat(stat):
+    """Prints the summary *stat* of a patch, similar to ``diffstat``."""
+    width = max([len(file_name) for file_name, _, _, _ in stat] + [0])
+    for file_name, added, removed, binary in stat:
+        if binary:
+            print(' %-*s | Bin' % (width, file_name))
+        else:
+            print(' %-*s | %5d %s%s' % (width, file_name, added + removed, '+' * min(added, 40), '-' * min(removed, 40)))
+    print(' %d file(s) changed, %d insertion(s)(+), %d deletion(s)(-)' % \
+            (len(stat), sum(added for _, added, _, _ in stat), sum(removed for _, _, removed, _ in stat)))
+
+def print_matches(matches, output):
+    """Writes each matching hunk in *matches*, preceded by the names of its
+    patch and file, to the binary file object *output*.
+    """
+    for patch_name, file_name, hunk in matches:
+        output.write(('%s: %s\n' % (patch_name, file_name)).encode('utf-8', 'surrogateescape'))
+        output.write(b'@@ -%d,%d +%d,%d @@\n' % (hunk.old_start, hunk.old_count, hunk.new_start, hunk.new_count))
+        for tag, contents in hunk.lines:
+            output.write(tag + contents)
+            if not contents.endswith(b'\n'):
+                output.write(b'\n')
+
+def print_check(results):
+    """Prints the outcome of checking whether patches apply, for each patch
+    and each file in the patch.
+    """
+    status_names = {HunkStatus.Applied: 'clean', HunkStatus.Fuzzy: 'fuzzy', HunkStatus.Conflict: 'conflict'}
+    for patch_name, result in results:
+        status = max([file_result.status for file_result in result.files] + [HunkStatus.Applied])
+        print('%s: %s' % (patch_name, status_names[status]))
+        for file_result in result.files:
+            line = '    %-8s %s' % (status_names[file_result.status], file_result.new_name or file_result.old_name)
+            if file_result.error is not None:
+                line += ' (%s)' % file_result.error
+            print(line)
+
+def print_states(states):
+    """Prints the state of each patch relative to the working copy."""
+    state_names = {PatchState.AppliesExactly: 'applies-exactly', PatchState.NeedsMerge: 'needs-merge',
+                   PatchState.BaseMissing: 'base-missing'}
+    width = max([len(patch_name) for patch_name, _ in states] + [0])
+    for patch_name, state in states:
+        print('%-*s  %s' % (width, patch_name, state_names[state]))
+
+def print_profile(tracer, output):
+    """Prints a summary of all operations and commands recorded by *tracer*
+    to the text file object *output*.
+    """
+    output.write('%-10s %-40s %6s %10s %12s\n' % ('kind', 'name', 'count', 'time (s)', 'output (B)'))
+    for category, name, count, duration, output_size in tracer.get_summary():
+        output.write('%-10s %-40s %6d %10.4f %12d\n' % (category, name, count, duration, output_size))
+    output.write('total wall time: %.4fs\n' % tracer.now())
+
+def create_parser():
+    """Returns the parser for the command-line arguments of stash."""
+    parser = argparse.ArgumentParser(description='Stash HG changes to the stash directory (~/.stash).')
+    parser.add_argument('-l', '--list', dest='show_list', action='store_true', help='list all currently stashed patches')
+    parser.add_argument('-r', '--remove', dest='remove_patch', action='store_true', \
+            help='remove the specified patch from the stash')
+    parser.add_argument('-s', '--show', dest='show_patch', action='store_true', \
+            help='shows the contents of the specified patch from the stash')
+    parser.add_argument('--stat', action='store_true', \
+            help='when showing a patch, only show the number of added and removed lines per file')
+    parser.add_argument('--check', action='store_true', \
+            help='check whether the specified patch, or all patches, apply cleanly without modifying the working copy')
+    parser.add_argument('-a', '--apply', dest='apply_patch', action='store_true', \
+            help='apply the specified patch in the stash, and remove it in case it applied successfully, '
+                 'multiple patches are applied as a series that is rolled back in case any patch does not apply')
+    parser.add_argument('--repo', dest='repository', metavar='PATH', \
+            help='when listing, only list patches created in the repository containing PATH')
+    parser.add_argument('--since', type=parse_time, metavar='DATE', help='when listing, only list patches created at or after DATE')
+    parser.add_argument('--touches', metavar='PATH', help='when listing, only list patches that touch the file or directory PATH')
+    parser.add_argument('--status', action='store_true', \
+            help='when listing, show whether each patch applies exactly to the working copy, needs to be merged, '
+                 'or was created in another repository, without reading the patches')
+    parser.add_argument('--grep', metavar='PATTERN', \
+            help='show the hunks of all patches that add or remove a line matching the regular expression PATTERN')
+    parser.add_argument('--file', dest='file_pattern', metavar='GLOB', \
+            help='when searching, only search the changes to files matching GLOB')
+    parser.add_argument('--namespace', metavar='NAMESPACE', \
+            help='when listing or searching, only consider patches named NAMESPACE/<name>, '
+                 'including those in nested namespaces')
+    parser.add_argument('--sort', choices=PatchIndex.SORT_KEYS, default='name', help='when listing, sort patches on this field')
+    parser.add_argument('--codec', choices=get_codecs(), default=Stash.CODEC, help='codec used to store a new patch')
+    parser.add_argument('--format', choices=Stash.FORMATS, default=Stash.FORMAT, \
+            help='format used to store a new patch, snapshots store the changed files themselves')
+    parser.add_argument('--recompress', metavar='CODEC', choices=get_codecs(), \
+            help='store all patches in the stash again using CODEC')
+    parser.add_argument('--rebuild-index', dest='rebuild_index', action='store_true', \
+            help='regenerate the index of the stash from the stashed patches')
+    parser.add_argument('--profile', action='store_true', \
+            help='print the time spent in each operation and version control command to stderr')
+    parser.add_argument('--profile-output', dest='profile_output', metavar='FILE', \
+            help='write a trace of all operations and commands to FILE, in the Chrome trace event format')
+    parser.add_argument('--daemon', action='store_true', \
+            help='serve stash commands over a per-user Unix socket, so later invocations skip most of the start up costs')
+    parser.add_argument('patch_name', nargs='?', metavar='<patch name>', help='name of the patch to operate on')
+    parser.add_argument('paths', nargs='*', metavar='<path>', \
+            help='when stashing or showing a patch, only stash or show the changes to these files or directories, '
+                 'when applying, further patches to apply')
+    return parser
+
+def main(argv=None, get_stash=Stash):
+    """Executes the stash command described by the command-line arguments
+    *argv*, by default those of the current process. Stashes are created
+    for a path using *get_stash*, which allows a long running process to reuse
+    them, see :py:class:`~stash.server.StashServer`.
+    """
+    parser = create_parser()
+    args = parser.parse_intermixed_args(argv)
+
+    if args.daemon:
+        # Imported here, since serving is the exception.
+        from .server import StashServer
+        try:
+            server = StashServer(get_socket_path())
+        except StashException as e:
+            print("Error: %s." % e)
+            return 1
+        # Stop serving cleanly when terminated.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            server.server_close()
+        return
+
+    # Selecting a codec or format only applies to this command.
+    codec, patch_format = Stash.CODEC, Stash.FORMAT
+    tracer = trace.enable() if args.profile or args.profile_output else None
+
+    try:
+        if args.show_list:
+            repository = get_repository_root(args.repository) if args.repository is not None else None
+
+            # Paths to touched files are relative to the repository root.
+            touches = args.touches
+            if touches is not None:
+                root_path = get_repository_root(args.repository or os.getcwd())
+                touches = os.path.relpath(os.path.abspath(touches), root_path)
+
+            patch_infos = Stash.find_patches(repository, args.since, touches, args.sort, args.namespace)
+            if args.status:
+                print_states(get_stash(os.getcwd()).get_patch_states([patch_info.name for patch_info in patch_infos]))
+            else:
+                for patch_info in patch_infos:
+                    print(patch_info.name)
+        elif args.grep is not None:
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+            print_matches(Stash.grep_patches(args.grep, args.file_pattern, args.namespace), output)
+        elif args.recompress is not None:
+            patch_names = Stash.recompress(args.recompress)
+            print("Recompressed %d patch(es) using '%s'." % (len(patch_names), args.recompress))
+        elif args.rebuild_index:
+            Stash.rebuild_index()
+            print("Index of the stash has been rebuilt.")
+        elif args.remove_patch:
+            Stash.remove_patch(args.patch_name)
+            print("Patch '%s' successfully removed." % args.patch_name)
+        elif args.check:
+            stash = get_stash(os.getcwd())
+            print_check(stash.check_patches([args.patch_name] if args.patch_name is not None else None))
+        elif args.show_patch:
+            paths = get_repository_paths(args.paths) if args.paths else None
+            if args.stat:
+                print_stat(Stash.get_patch_stat(args.patch_name, paths))
+            else:
+                Stash.write_patch(args.patch_name, getattr(sys.stdout, 'buffer', sys.stdout), paths)
+        elif args.patch_name is not None:
+            Stash.CODEC = args.codec
+            Stash.FORMAT = args.format
+            stash = get_stash(os.getcwd())
+            if args.apply_patch and args.paths:
+                # Additional patch names form a series that is applied at once.
+                patch_names = [args.patch_name] + args.paths
+                failed_patch_name = stash.apply_patches(patch_names)
+                if failed_patch_name is None:
+                    print("Applying patches %s succeeded, stashed patches have been removed." % \
+                            ', '.join("'%s'" % patch_name for patch_name in patch_names))
+                else:
+                    print("Patch '%s' did not apply successfully, no patches have been applied." % failed_patch_name)
+            elif args.apply_patch:
+                if stash.apply_patch(args.patch_name):
+                    print("Applying patch '%s' succeeded, stashed patch has been removed." % args.patch_name)
+                else:
+                    # The patch did not apply cleanly, inform the user that the
+                    # patch will not be removed.
+                    print("Patch '%s' did not apply successfully, stashed patch will not be removed." % args.patch_name)
+            else:
+                # Check if patch already exists, if it does, issue a warning and
+                # give the user an option to overwrite the patch. The existing
+                # patch is replaced atomically once the new patch is written.
+                overwrite = False
+                while not overwrite and stash.has_patch(args.patch_name):
+                    yes_no_answer = input("Warning, patch '%s' already exists, overwrite [Y/n]? " % args.patch_name)
+                    if not yes_no_answer or yes_no_answer.lower() == 'y':
+                        overwrite = True
+                    elif yes_no_answer.lower() == 'n':
+                        args.patch_name = None
+                        while not args.patch_name:
+                            args.patch_name = input("Please provide a different patch name: ")
+
+                paths = get_repository_paths(args.paths) if args.paths else None
+                if stash.create_patch(args.patch_name, paths, overwrite):
+                    print("Done stashing changes for patch '%s'." % args.patch_name)
+                else:
+                    print("No changes in repository, patch '%s' not created." % args.patch_name)
+        else:
+            parser.print_help()
+    except StashException as e:
+        print("Error: %s." % e)
+    except IOError as e:
+        # Output that is piped to a command that exits early is not an error.
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        if tracer is not None:
+            if args.profile:
+                print_profile(tracer, sys.stderr)
+            if args.profile_output:
+                with open(args.profile_output, 'w') as f:
+                    tracer.write_chrome_trace(f)
+        trace.disable()
+        Stash.CODEC, Stash.FORMAT = codec, patch_format
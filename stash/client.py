@@ -0,0 +1,127 @@
+import errno
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+SOCKET_PATH = os.environ.get('STASH_SOCKET')
+"""Path of the Unix socket a :py:class:`~stash.server.StashServer` listens on,
+see :py:func:`get_socket_path`. Can be set using the environment variable
+``STASH_SOCKET``, setting it to an empty string disables the client.
+"""
+
+def get_socket_path():
+    """Returns the path of the Unix socket of the stash server of the current
+    user. Unless :py:data:`SOCKET_PATH` is set, the socket is located in a
+    directory only accessible by the user, in ``$XDG_RUNTIME_DIR`` or the
+    temporary directory.
+    """
+    if SOCKET_PATH is not None:
+        return SOCKET_PATH
+    directory = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(directory, 'stash-%d' % os.getuid(), 'socket')
+
+def send_message(connection, channel, data):
+    """Sends *data* to *connection* on *channel*, a single byte identifying the
+    kind of message. Each message consists of the channel, the length of the
+    data as a big-endian unsigned integer and the data itself, similar to the
+    protocol of a Mercurial command server.
+    """
+    connection.sendall(struct.pack('>cI', channel, len(data)) + data)
+
+def _read_exactly(connection, size):
+    """Reads exactly *size* bytes from *connection*.
+
+    :raises: :py:exc:`EOFError` in case the connection was closed before.
+    """
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed")
+        data += chunk
+    return data
+
+def read_message(connection):
+    """Reads a single message sent by :py:func:`send_message` from
+    *connection*. Returns a tuple containing the channel and the data. For
+    the input channel ``L``, the data is the maximum number of bytes that is
+    requested, the message carries no data of its own.
+    """
+    channel, length = struct.unpack('>cI', _read_exactly(connection, 5))
+    if channel == b'L':
+        return channel, length
+    return channel, _read_exactly(connection, length)
+
+def connect(socket_path):
+    """Returns a connection to the stash server listening on *socket_path*,
+    or ``None`` in case no server is running, or the socket is not owned by
+    the current user.
+    """
+    try:
+        directory_stat = os.stat(os.path.dirname(socket_path) or '.')
+    except OSError:
+        return None
+    if SOCKET_PATH is None and (directory_stat.st_uid != os.getuid() or directory_stat.st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except (OSError, IOError):
+        connection.close()
+        return None
+    return connection
+
+def run(argv, socket_path=None, stdin=None, stdout=None, stderr=None):
+    """Lets the stash server execute the stash command described by the
+    command-line arguments *argv*, as if it was executed in the current
+    working directory. Its output is written to the binary file objects
+    *stdout* and *stderr*, and lines of input are read from *stdin*, by
+    default those of the current process. Returns the exit status of the
+    command, or ``None`` in case no server is running on *socket_path*, by
+    default :py:func:`get_socket_path`.
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+    if not socket_path:
+        return None
+
+    connection = connect(socket_path)
+    if connection is None:
+        return None
+
+    stdin = stdin or getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = stdout or getattr(sys.stdout, 'buffer', sys.stdout)
+    stderr = stderr or getattr(sys.stderr, 'buffer', sys.stderr)
+    try:
+        request = {'argv': argv, 'cwd': os.getcwd()}
+        send_message(connection, b'c', json.dumps(request).encode('utf-8'))
+        while True:
+            channel, data = read_message(connection)
+            if channel == b'o':
+                try:
+                    stdout.write(data)
+                except IOError as e:
+                    # Output that is piped to a command that exits early is
+                    # not an error.
+                    if e.errno != errno.EPIPE:
+                        raise
+                    return 0
+            elif channel == b'e':
+                stderr.write(data)
+            elif channel == b'L':
+                # Flush any prompt before waiting for the user.
+                stdout.flush()
+                stderr.flush()
+                send_message(connection, b'l', stdin.readline(data))
+            elif channel == b'r':
+                stdout.flush()
+                return struct.unpack('>i', data)[0]
+    except (EOFError, OSError, IOError) as e:
+        stderr.write(("Error: lost connection to stash server: %s.\n" % e).encode('utf-8'))
+        return 1
+    finally:
+        connection.close()
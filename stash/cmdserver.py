@@ -0,0 +1,127 @@
+import os
+import struct
+import subprocess
+import sys
+
+from .exception import StashException
+
+class CommandServer(object):
+    """Client for a Mercurial command server (``hg serve --cmdserver pipe``).
+
+    A command server is a single long running ``hg`` process that executes
+    commands sent to it over its standard input. Using a command server avoids
+    paying the start up costs of Mercurial for every command that is executed
+    on a repository.
+    """
+
+    def __init__(self, path):
+        """Starts a command server for the repository located at *path*.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case the command
+            server could not be started.
+        """
+        # Make sure the output of Mercurial is not influenced by any user
+        # configuration, similar to what happens for scripts.
+        environment = dict(os.environ)
+        environment['HGPLAIN'] = '1'
+
+        try:
+            self._process = subprocess.Popen(['hg', 'serve', '--cmdserver', 'pipe', '--config', 'ui.interactive=False'],
+                                             cwd=path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
+        except OSError as e:
+            raise StashException("unable to start Mercurial command server: %s" % e)
+
+        # The server announces its capabilities and encoding in a hello
+        # message that is sent on the output channel.
+        try:
+            channel, hello = self._read_channel()
+        except StashException:
+            self.close()
+            raise
+
+        capabilities = []
+        self.encoding = 'utf-8'
+        for line in hello.decode('ascii', 'replace').splitlines():
+            key, _, value = line.partition(': ')
+            if key == 'capabilities':
+                capabilities = value.split()
+            elif key == 'encoding':
+                self.encoding = value
+
+        if channel != b'o' or 'runcommand' not in capabilities:
+            self.close()
+            raise StashException("Mercurial command server does not support 'runcommand'")
+
+        super(CommandServer, self).__init__()
+
+    def _read_channel(self):
+        """Reads a single message from the server. Returns a tuple containing
+        the channel identifier and the message data. For input channels, the
+        data is the number of bytes requested by the server.
+        """
+        header = self._process.stdout.read(5)
+        if len(header) < 5:
+            raise StashException("Mercurial command server terminated unexpectedly")
+
+        channel, length = struct.unpack('>cI', header)
+
+        # Input channels only announce the maximum amount of data the server is
+        # willing to receive, they carry no data of their own.
+        if channel in (b'I', b'L'):
+            return channel, length
+
+        return channel, self._process.stdout.read(length)
+
+    def close(self):
+        """Stops the command server."""
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.stdout.close()
+            except IOError:
+                pass
+            self._process.wait()
+            self._process = None
+
+    def runcommand(self, args, stdout=None):
+        """Runs the Mercurial command described by the argument list *args*,
+        for example ``['status', '-q']``. Returns a tuple containing the return
+        code and the output of the command as bytes. In case a file object is
+        passed as *stdout*, all output is written to that file instead, and
+        ``None`` is returned as output.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case
+            communicating with the server failed.
+        """
+        if self._process is None:
+            raise StashException("Mercurial command server is not running")
+
+        data = b'\0'.join(arg.encode(self.encoding) for arg in args)
+        try:
+            self._process.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+            self._process.stdin.flush()
+        except IOError as e:
+            raise StashException("unable to send command to Mercurial command server: %s" % e)
+
+        output = []
+        while True:
+            channel, data = self._read_channel()
+            if channel == b'o':
+                if stdout is None:
+                    output.append(data)
+                else:
+                    stdout.write(data)
+            elif channel == b'e':
+                # Pass error output on to the user, similar to what happens
+                # when executing a command directly.
+                getattr(sys.stderr, 'buffer', sys.stderr).write(data)
+            elif channel == b'r':
+                return_code = struct.unpack('>i', data)[0]
+                return return_code, None if stdout is not None else b''.join(output)
+            elif channel in (b'I', b'L'):
+                # Commands are never interactive, signal end of input.
+                self._process.stdin.write(struct.pack('>I', 0))
+                self._process.stdin.flush()
+            elif channel.isupper():
+                # Unknown required channels can not be handled properly.
+                raise StashException("unexpected message on channel '%s' of Mercurial command server" % channel.decode('ascii'))
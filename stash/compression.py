@@ -0,0 +1,89 @@
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+
+try:
+    import lzma
+except ImportError:
+    # The lzma module is only available as of Python 3.3.
+    lzma = None
+
+from .exception import StashException
+
+CHUNK_SIZE = 1 << 16
+"""Number of bytes that are copied at once when (re)compressing patches."""
+
+_MAGIC_NUMBERS = [
+    ('gzip', b'\x1f\x8b'),
+    ('bz2', b'BZh'),
+    ('lzma', b'\xfd7zXZ\x00'),
+]
+"""Magic numbers that identify the compressed formats."""
+
+def get_codecs():
+    """Returns the names of all codecs that can be used to store patches. The
+    codec ``'none'`` stores patches without compression.
+    """
+    return ['none', 'gzip', 'bz2'] + (['lzma'] if lzma is not None else [])
+
+def detect_codec(path):
+    """Returns the name of the codec that was used to store the patch at
+    *path*, based on its first bytes.
+    """
+    with open(path, 'rb') as patch_file:
+        header = patch_file.read(6)
+
+    for codec, magic_number in _MAGIC_NUMBERS:
+        if header.startswith(magic_number):
+            return codec
+    return 'none'
+
+def open_patch(path, mode='rb', codec=None):
+    """Opens the patch located at *path* as a binary file object, in which
+    data is transparently (de)compressed while it is being read or written.
+    When reading, the codec is detected automatically. When writing (*mode*
+    ``'wb'``), the patch is stored using *codec*.
+
+    :raises: :py:exc:`~stash.exception.StashException` in case *codec* is not
+        supported.
+    """
+    if mode == 'rb':
+        codec = detect_codec(path)
+    elif codec is None:
+        codec = 'none'
+
+    if codec == 'none':
+        return open(path, mode)
+    elif codec == 'gzip':
+        return gzip.GzipFile(path, mode)
+    elif codec == 'bz2':
+        return bz2.BZ2File(path, mode)
+    elif codec == 'lzma' and lzma is not None:
+        return lzma.LZMAFile(path, mode)
+
+    raise StashException("unsupported codec '%s'" % codec)
+
+def recompress(path, codec):
+    """Stores the patch located at *path* again using *codec*. The patch is
+    decompressed and compressed again in a streaming fashion, and is replaced
+    atomically. Returns ``True`` in case the patch was recompressed, and
+    ``False`` in case it was already stored using *codec*.
+    """
+    if detect_codec(path) == codec:
+        return False
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.recompress.')
+    os.close(handle)
+    try:
+        with open_patch(path) as source_file:
+            with open_patch(temp_path, 'wb', codec) as target_file:
+                shutil.copyfileobj(source_file, target_file, CHUNK_SIZE)
+        shutil.copystat(path, temp_path)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+    return True
@@ -0,0 +1,474 @@
+import fnmatch
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+from .compression import detect_codec, open_patch
+from .exception import StashException
+from .patch import parse_patch
+from .snapshot import Snapshot, is_snapshot
+
+HASH_CHUNK_SIZE = 1 << 16
+"""Number of bytes that are read at once when hashing a file."""
+
+RACY_INTERVAL = 2.0
+"""Files modified less than this number of seconds before they were hashed are
+not added to the hash cache, since a later modification within the resolution
+of the file system timestamps would go unnoticed.
+"""
+
+TOKEN_REGEX = re.compile(b'[A-Za-z0-9_]+')
+"""Regular expression matching the tokens in changed lines that are indexed,
+see :py:meth:`PatchIndex.search`.
+"""
+
+MIN_SUBSTRING_LENGTH = 3
+"""Minimum length of a word in a search pattern that may occur anywhere inside
+a token, shorter words select too many tokens to be useful.
+"""
+
+class PatchInfo(object):
+    """Metadata of a single stashed patch, as stored in the
+    :py:class:`PatchIndex`.
+    """
+
+    def __init__(self, name, size, created, repository=None, vcs=None, revision=None, codec=None):
+        self.name = name
+        """Name of the patch."""
+
+        self.size = size
+        """Size of the patch in bytes."""
+
+        self.created = created
+        """Time the patch was created, in seconds since the epoch."""
+
+        self.repository = repository
+        """Root path of the repository the patch was created in, if known."""
+
+        self.vcs = vcs
+        """Name of the version control system of the repository, if known."""
+
+        self.revision = revision
+        """Revision of the repository the patch was created against, if known."""
+
+        self.codec = codec
+        """Codec the patch is stored with, see
+        :py:func:`~stash.compression.get_codecs`, or ``None`` for snapshots.
+        """
+
+        super(PatchInfo, self).__init__()
+
+def _scan_patch(path):
+    """Returns a tuple containing a sorted list of all files touched by the
+    patch or snapshot located at *path*, or ``None`` in case they can not be
+    determined, and the set of tokens in the lines changed by the patch. The
+    patch is read once. Snapshots contain no changed lines.
+    """
+    if is_snapshot(path):
+        try:
+            return Snapshot(path).file_names, set()
+        except StashException:
+            return None, set()
+
+    file_names, tokens = set(), set()
+    with open_patch(path) as patch_file:
+        for file_patch in parse_patch(patch_file):
+            file_names.update(file_patch.file_names)
+            for hunk in file_patch.hunks:
+                for tag, contents in hunk.lines:
+                    if tag != b' ':
+                        tokens.update(TOKEN_REGEX.findall(contents))
+    return sorted(file_names) if file_names else None, set(token.decode('ascii') for token in tokens)
+
+def _skip_class(pattern, position):
+    """Returns the position in the regular expression *pattern* following the
+    character class starting at *position*.
+    """
+    position += 1
+    if pattern[position:position + 1] == '^':
+        position += 1
+    if pattern[position:position + 1] == ']':
+        position += 1
+    while position < len(pattern) and pattern[position] != ']':
+        position += 2 if pattern[position] == '\\' else 1
+    return position + 1
+
+def get_search_words(pattern):
+    """Returns a list of words that occur in every match of the regular
+    expression *pattern*, as tuples containing the word, and whether the word
+    is known to start and to end at the boundary of a token (see
+    :py:data:`TOKEN_REGEX`). Only literal text outside groups is taken into
+    account, which may result in an empty list. Patterns using flags, which
+    change the meaning of literal text, result in an empty list as well.
+    """
+    if re.compile(pattern).flags & (re.IGNORECASE | re.VERBOSE) or re.search(r'\(\?[aiLmsux-]', pattern):
+        return []
+
+    runs, run, depth, position = [], '', 0, 0
+    while position < len(pattern):
+        character = pattern[position]
+        literal = None
+        if character == '\\':
+            escaped = pattern[position + 1:position + 2]
+            position += 2
+            if escaped and not escaped.isalnum():
+                literal = escaped
+            elif escaped == 'N' and pattern[position:position + 1] == '{':
+                position = pattern.find('}', position) + 1 or len(pattern)
+            elif escaped in 'xuU' or escaped.isdigit():
+                # Escapes such as \x41, \101 or \u0041 are followed by a
+                # payload, skip any alphanumeric characters that may be part
+                # of it.
+                while position < len(pattern) and pattern[position].isalnum():
+                    position += 1
+        elif character == '[':
+            position = _skip_class(pattern, position)
+        elif character == '{' and re.match(r'\{\d*(,\d*)?\}', pattern[position:]):
+            # The preceding character may occur zero times.
+            run = run[:-1]
+            position = pattern.index('}', position) + 1
+        elif character in '*?':
+            run = run[:-1]
+            position += 1
+        elif character == '|' and depth == 0:
+            # Alternatives have no text in common.
+            return []
+        else:
+            if character == '(':
+                depth += 1
+            elif character == ')':
+                depth -= 1
+            elif character not in '|.^$+':
+                literal = character
+            position += 1
+
+        if literal is not None and depth == 0:
+            run += literal
+        else:
+            # Unknown text may follow, a repetition (+) leaves the run intact.
+            if run:
+                runs.append(run)
+            run = ''
+    if run:
+        runs.append(run)
+
+    words = []
+    for run in runs:
+        for match in re.finditer('[A-Za-z0-9_]+', run):
+            word = (match.group(), match.start() > 0, match.end() < len(run))
+            if word[1] or word[2] or len(word[0]) >= MIN_SUBSTRING_LENGTH:
+                words.append(word)
+    return words
+
+class PatchIndex(object):
+    """Index containing metadata about all patches in a stash, stored in a
+    SQLite database in the stash directory. The index makes it possible to
+    list and filter patches without reading the patches themselves.
+
+    Patches that are added to or removed from the stash directory without
+    updating the index, are detected and indexed again when listing patches.
+    """
+
+    FILE_NAME = '.index.sqlite'
+    """Name of the index database in the stash directory."""
+
+    SORT_KEYS = ('name', 'created', 'size')
+    """Fields patches can be sorted on."""
+
+    def __init__(self, stash_path, get_path=None, fetch=None):
+        """Opens the index for the stash located at *stash_path*, creating it
+        in case it does not yet exist. *get_path* is a function returning the
+        path of a patch given its name, see
+        :py:meth:`~stash.store.PatchStore.get_path`, by default patches are
+        located directly in *stash_path*. *fetch* is a function making sure
+        the patch is present at that path, see
+        :py:meth:`~stash.store.PatchStore.fetch`, it is only called for
+        patches that are missing from the stash directory.
+        """
+        self.stash_path = stash_path
+        self._get_path = get_path or (lambda patch_name: os.path.join(stash_path, patch_name))
+        self._fetch = fetch
+        self._connection = sqlite3.connect(os.path.join(stash_path, self.FILE_NAME))
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS patches (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                                     'created REAL, repository TEXT, vcs TEXT, revision TEXT)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS files (patch TEXT, file_name TEXT, PRIMARY KEY (patch, file_name))')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS files_by_name ON files (file_name)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS preimages (patch TEXT, file_name TEXT, hash TEXT, '
+                                     'PRIMARY KEY (patch, file_name))')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER, '
+                                     'mtime INTEGER, inode INTEGER, hash TEXT)')
+
+            # Add columns that are missing in indices created by older versions.
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(patches)')]
+            if 'codec' not in columns:
+                self._connection.execute('ALTER TABLE patches ADD COLUMN codec TEXT')
+
+            # Patches indexed by older versions are indexed again to determine
+            # their tokens, the next time the index is synchronized.
+            tables = [row[0] for row in self._connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            if 'tokens' not in tables:
+                self._connection.execute('CREATE TABLE tokens (token TEXT, patch TEXT, PRIMARY KEY (token, patch))')
+                self._connection.execute('CREATE INDEX tokens_by_patch ON tokens (patch)')
+                self._connection.execute('UPDATE patches SET size = -1')
+
+        self._connection.create_function('fnmatch', 2, fnmatch.fnmatchcase)
+
+        super(PatchIndex, self).__init__()
+
+    def close(self):
+        """Closes the index."""
+        self._connection.close()
+
+    def _insert(self, patch_name, created, repository, vcs, revision, file_names):
+        """Inserts or replaces the entry for *patch_name*, without committing
+        the transaction. The patch is read to determine its tokens, and its
+        file names in case *file_names* is ``None``.
+        """
+        patch_path = self._get_path(patch_name)
+        patch_stat = os.stat(patch_path)
+        if created is None:
+            created = patch_stat.st_mtime
+
+        scanned_file_names, tokens = _scan_patch(patch_path)
+        if file_names is None:
+            file_names = scanned_file_names
+
+        self._connection.execute('DELETE FROM files WHERE patch = ?', (patch_name,))
+        self._connection.execute('DELETE FROM tokens WHERE patch = ?', (patch_name,))
+        codec = detect_codec(patch_path) if not is_snapshot(patch_path) else None
+        self._connection.execute('INSERT OR REPLACE INTO patches (name, size, mtime, created, repository, vcs, revision, codec) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (patch_name, patch_stat.st_size, patch_stat.st_mtime, created, repository, vcs, revision, codec))
+        self._connection.executemany('INSERT OR IGNORE INTO files VALUES (?, ?)',
+                                     ((patch_name, file_name) for file_name in file_names or []))
+        self._connection.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?)', ((token, patch_name) for token in tokens))
+
+    def add(self, patch_name, repository=None, vcs=None, revision=None, file_names=None, preimages=None):
+        """Adds the patch *patch_name* that is present in the stash directory
+        to the index. *repository* is the root path of the repository the patch
+        was created in, *vcs* the name of its version control system, and
+        *revision* the revision the patch was created against. *file_names* is
+        the list of files touched by the patch, in case it is not given, the
+        file names are determined from the patch itself. *preimages* is a
+        dictionary mapping each touched file to the hash of its contents before
+        the patch is applied, or ``None`` for files that do not exist yet, see
+        :py:meth:`hash_files`.
+        """
+        with self._connection:
+            self._insert(patch_name, time.time(), repository, vcs, revision, file_names)
+            self._connection.execute('DELETE FROM preimages WHERE patch = ?', (patch_name,))
+            self._connection.executemany('INSERT INTO preimages VALUES (?, ?, ?)',
+                                         ((patch_name, file_name, digest) for file_name, digest in (preimages or {}).items()))
+
+    def remove(self, patch_name):
+        """Removes the patch *patch_name* from the index."""
+        with self._connection:
+            self._delete(patch_name)
+
+    def _delete(self, patch_name):
+        """Deletes all entries for *patch_name*, without committing the
+        transaction.
+        """
+        self._connection.execute('DELETE FROM files WHERE patch = ?', (patch_name,))
+        self._connection.execute('DELETE FROM tokens WHERE patch = ?', (patch_name,))
+        self._connection.execute('DELETE FROM preimages WHERE patch = ?', (patch_name,))
+        self._connection.execute('DELETE FROM patches WHERE name = ?', (patch_name,))
+
+    def _update(self, patch_names, indexed):
+        """Indexes the patches in *patch_names* that are missing from
+        *indexed*, a dictionary mapping the names of indexed patches to their
+        entries, or that were modified since they were indexed, without
+        committing the transaction. The patches are removed from *indexed*.
+        Patches missing from the stash directory are fetched, those that were
+        removed by another process after they were listed are removed from the
+        index as well.
+        """
+        for patch_name in patch_names:
+            patch_path = self._get_path(patch_name)
+            entry = indexed.pop(patch_name, None)
+            try:
+                if self._fetch is not None and not os.path.lexists(patch_path):
+                    self._fetch(patch_name)
+                patch_stat = os.stat(patch_path)
+                if entry is None:
+                    self._insert(patch_name, None, None, None, None, None)
+                elif entry[0] != patch_stat.st_size or entry[1] != patch_stat.st_mtime:
+                    self._insert(patch_name, entry[2], entry[3], entry[4], entry[5], None)
+            except (OSError, StashException):
+                self._delete(patch_name)
+
+    def update(self, patch_names):
+        """Makes sure the patches in *patch_names*, which are present in the
+        stash directory, are indexed and up to date, without considering any
+        other patches. Patches that were modified since they were indexed, are
+        indexed again, while retaining their metadata.
+        """
+        indexed = {}
+        for patch_name in patch_names:
+            row = self._connection.execute('SELECT size, mtime, created, repository, vcs, revision FROM patches WHERE name = ?',
+                                           (patch_name,)).fetchone()
+            if row is not None:
+                indexed[patch_name] = row
+
+        with self._connection:
+            self._update(patch_names, indexed)
+
+    def synchronize(self, patch_names, namespace=None):
+        """Makes sure the index contains exactly the patches in *patch_names*,
+        which are all patches present in the stash directory, or all patches
+        in *namespace* in case it is given. Patches that were modified since
+        they were indexed, are indexed again, while retaining their metadata.
+        """
+        query = 'SELECT name, size, mtime, created, repository, vcs, revision FROM patches'
+        parameters = []
+        if namespace:
+            query += ' WHERE substr(name, 1, ?) = ?'
+            parameters.extend([len(namespace) + 1, namespace + '/'])
+        indexed = dict((row[0], row[1:]) for row in self._connection.execute(query, parameters))
+
+        with self._connection:
+            self._update(patch_names, indexed)
+            for patch_name in indexed:
+                self._delete(patch_name)
+
+    def rebuild(self, patch_names):
+        """Discards the contents of the index, and indexes all patches in
+        *patch_names* again. Metadata that can not be determined from the
+        patches themselves is retained.
+        """
+        with self._connection:
+            self._connection.execute('DELETE FROM files')
+            self._connection.execute('DELETE FROM tokens')
+            self._connection.execute('UPDATE patches SET size = -1')
+        self.synchronize(patch_names)
+
+    def get_patch_info(self, patch_name):
+        """Returns the :py:class:`PatchInfo` for patch *patch_name*, or
+        ``None`` in case the patch is not indexed.
+        """
+        row = self._connection.execute('SELECT name, size, created, repository, vcs, revision, codec FROM patches WHERE name = ?',
+                                       (patch_name,)).fetchone()
+        return PatchInfo(*row) if row is not None else None
+
+    def get_preimages(self, patch_name):
+        """Returns a dictionary mapping each file touched by patch *patch_name*
+        to the hash of its contents before the patch is applied (``None`` for
+        files created by the patch), or ``None`` in case these were not
+        recorded.
+        """
+        preimages = dict(self._connection.execute('SELECT file_name, hash FROM preimages WHERE patch = ?', (patch_name,)))
+        return preimages or None
+
+    def hash_files(self, paths):
+        """Returns a list containing the SHA-1 hash of the contents of each
+        file in *paths*, or ``None`` for files that do not exist. Hashes are
+        cached by path, and are only computed again in case the size,
+        modification time or inode of a file changed.
+        """
+        now = time.time()
+        hashes = []
+        with self._connection:
+            for path in paths:
+                path = os.path.abspath(path)
+                try:
+                    path_stat = os.lstat(path)
+                except OSError:
+                    hashes.append(None)
+                    continue
+
+                signature = (path_stat.st_size, getattr(path_stat, 'st_mtime_ns', int(path_stat.st_mtime * 1e9)), path_stat.st_ino)
+                row = self._connection.execute('SELECT size, mtime, inode, hash FROM file_hashes WHERE path = ?', (path,)).fetchone()
+                if row is not None and tuple(row[:3]) == signature:
+                    hashes.append(row[3])
+                    continue
+
+                digest = hashlib.sha1()
+                if os.path.islink(path):
+                    digest.update(os.readlink(path).encode('utf-8', 'surrogateescape'))
+                else:
+                    with open(path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                            digest.update(chunk)
+                hashes.append(digest.hexdigest())
+
+                if path_stat.st_mtime < now - RACY_INTERVAL:
+                    self._connection.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)',
+                                             (path,) + signature + (hashes[-1],))
+                else:
+                    self._connection.execute('DELETE FROM file_hashes WHERE path = ?', (path,))
+        return hashes
+
+    def get_file_names(self, patch_name):
+        """Returns a sorted list of all files touched by patch *patch_name*."""
+        return [row[0] for row in self._connection.execute('SELECT file_name FROM files WHERE patch = ? ORDER BY file_name', (patch_name,))]
+
+    def find(self, repository=None, since=None, touches=None, sort='name', namespace=None):
+        """Returns a list of :py:class:`PatchInfo` instances for all patches
+        that were created in the repository with root path *repository*,
+        created at or after time *since* (in seconds since the epoch), that
+        touch the file or directory *touches* (relative to the repository
+        root), and that are part of *namespace* or a namespace nested in it.
+        All criteria are optional. The result is sorted on the field *sort*,
+        see :py:attr:`SORT_KEYS`.
+        """
+        query = 'SELECT name, size, created, repository, vcs, revision, codec FROM patches'
+        conditions, parameters = [], []
+        if namespace:
+            conditions.append('substr(name, 1, ?) = ?')
+            parameters.extend([len(namespace) + 1, namespace + '/'])
+        if repository is not None:
+            conditions.append('repository = ?')
+            parameters.append(repository)
+        if since is not None:
+            conditions.append('created >= ?')
+            parameters.append(since)
+        if touches:
+            touches = touches.strip('/')
+            conditions.append("name IN (SELECT patch FROM files WHERE file_name = ? OR substr(file_name, 1, ?) = ?)")
+            parameters.extend([touches, len(touches) + 1, touches + '/'])
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        if sort not in self.SORT_KEYS:
+            raise StashException("invalid sort key '%s'" % sort)
+        query += ' ORDER BY %s, name' % sort
+
+        return [PatchInfo(*row) for row in self._connection.execute(query, parameters)]
+
+    def search(self, pattern, file_pattern=None, namespace=None):
+        """Returns the sorted names of the patches that may change lines
+        matching the regular expression *pattern*, in files matching the glob
+        pattern *file_pattern*, in *namespace*. Only the index is consulted:
+        the returned patches contain the words every match contains (see
+        :py:func:`get_search_words`), and need to be read to find the actual
+        matches. Snapshots contain no changed lines and are never returned.
+        """
+        query = 'SELECT name FROM patches WHERE codec IS NOT NULL'
+        parameters = []
+        for word, starts_token, ends_token in get_search_words(pattern):
+            if starts_token and ends_token:
+                condition = 'token = ?'
+                parameters.append(word)
+            elif starts_token:
+                # Tokens consist of ASCII characters below DEL.
+                condition = 'token >= ? AND token < ?'
+                parameters.extend([word, word + '\x7f'])
+            elif ends_token:
+                condition = 'substr(token, ?) = ?'
+                parameters.extend([-len(word), word])
+            else:
+                condition = 'instr(token, ?) > 0'
+                parameters.append(word)
+            query += ' AND name IN (SELECT patch FROM tokens WHERE %s)' % condition
+        if file_pattern:
+            query += ' AND name IN (SELECT patch FROM files WHERE fnmatch(file_name, ?))'
+            parameters.append(file_pattern)
+        if namespace:
+            query += ' AND substr(name, 1, ?) = ?'
+            parameters.extend([len(namespace) + 1, namespace + '/'])
+        query += ' ORDER BY name'
+
+        return [row[0] for row in self._connection.execute(query, parameters)]
@@ -0,0 +1,836 @@
+import base64
+import io
+import multiprocessing
+import os
+import re
+import stat
+import tempfile
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .compression import open_patch
+from .exception import StashException
+
+HUNK_HEADER_REGEX = re.compile(br'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+"""Regular expression matching the header of a hunk in a unified diff."""
+
+DEFAULT_FUZZ = 2
+"""Default number of context lines that may be ignored at the start and end of
+a hunk when searching for the location to apply the hunk at, similar to the
+default of ``patch``.
+"""
+
+CONCURRENT_APPLY_SIZE = 4 << 20
+"""Size in bytes of a patch above which it is applied by multiple processes,
+see :py:func:`apply_patch`. Starting the pool of worker processes, and parsing
+each change twice, only pays off in case applying the patch takes about a
+second, smaller patches are applied by the calling process.
+"""
+
+BATCH_SIZE = 256 << 10
+"""Size in bytes of the changes that are applied at once by a worker process,
+in case a patch is applied by multiple processes, see :py:func:`apply_patch`.
+"""
+
+class HunkStatus(object):
+    """Enum for all possible outcomes of applying a single hunk."""
+    Applied, Fuzzy, Conflict = range(3)
+
+class Hunk(object):
+    """A single hunk of a unified diff."""
+
+    def __init__(self, old_start, old_count, new_start, new_count):
+        """Creates an empty hunk based on the ranges in its header."""
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+
+        self.lines = []
+        """List of tuples containing the line type (``b' '``, ``b'-'`` or
+        ``b'+'``) and the line contents, including its line ending.
+        """
+
+        self._old_line_count = 0
+        self._new_line_count = 0
+
+        super(Hunk, self).__init__()
+
+    def _add_line(self, line):
+        """Adds the hunk *line* as read from a patch."""
+        if line.startswith(b'\\'):
+            # The previous line has no line ending.
+            if self.lines:
+                tag, contents = self.lines[-1]
+                self.lines[-1] = (tag, contents.rstrip(b'\r\n'))
+            return
+
+        if line.startswith((b'-', b'+', b' ')):
+            tag, contents = line[:1], line[1:]
+        else:
+            # Some tools strip the space from empty context lines.
+            tag, contents = b' ', line
+
+        self.lines.append((tag, contents))
+        if tag != b'+':
+            self._old_line_count += 1
+        if tag != b'-':
+            self._new_line_count += 1
+
+    def _is_incomplete(self):
+        """Returns whether not all lines of the hunk have been read yet."""
+        return self._old_line_count < self.old_count or self._new_line_count < self.new_count
+
+    @property
+    def old_lines(self):
+        """Lines that are replaced by this hunk."""
+        return [contents for tag, contents in self.lines if tag != b'+']
+
+    @property
+    def new_lines(self):
+        """Lines that replace the old lines of this hunk."""
+        return [contents for tag, contents in self.lines if tag != b'-']
+
+    @property
+    def leading_context(self):
+        """Number of context lines at the start of the hunk."""
+        count = 0
+        while count < len(self.lines) and self.lines[count][0] == b' ':
+            count += 1
+        return count
+
+    @property
+    def trailing_context(self):
+        """Number of context lines at the end of the hunk."""
+        count = 0
+        while count < len(self.lines) and self.lines[-count - 1][0] == b' ':
+            count += 1
+        return count
+
+class FilePatch(object):
+    """All changes a patch makes to a single file."""
+
+    def __init__(self):
+        """Creates an empty file patch."""
+        self.old_name = None
+        """Name of the file before the patch, or ``None`` for new files."""
+
+        self.new_name = None
+        """Name of the file after the patch, or ``None`` for removed files."""
+
+        self.is_new = False
+        self.is_removed = False
+        self.is_copy = False
+
+        self.new_mode = None
+        """New mode of the file, including its type, in case it is changed."""
+
+        self.hunks = []
+
+        self.binary = None
+        """In case of a binary change, a tuple containing the method
+        (``b'literal'`` or ``b'delta'``) and the decompressed data. For binary
+        changes without any data, ``b'unknown'`` is used as method.
+        """
+
+        self.raw_lines = None
+        """Lines of the patch describing this file, in case these were
+        requested while parsing.
+        """
+
+        self._has_header = False
+
+        super(FilePatch, self).__init__()
+
+    @property
+    def file_names(self):
+        """All file names touched by this file patch."""
+        return set(file_name for file_name in (self.old_name, self.new_name) if file_name)
+
+class HunkResult(object):
+    """The outcome of applying a single hunk."""
+
+    def __init__(self, status, offset=0, fuzz=0):
+        """Creates a hunk result with the given *status*. *offset* is the
+        number of lines the hunk was moved, *fuzz* the number of context lines
+        that were ignored.
+        """
+        self.status = status
+        self.offset = offset
+        self.fuzz = fuzz
+
+        super(HunkResult, self).__init__()
+
+class FileResult(object):
+    """The outcome of applying a :py:class:`FilePatch`."""
+
+    def __init__(self, file_patch):
+        """Creates an empty result for applying *file_patch*."""
+        self.old_name = file_patch.old_name
+        self.new_name = file_patch.new_name
+
+        self.hunks = []
+        """List of :py:class:`HunkResult` instances, one for each hunk."""
+
+        self.error = None
+        """Description of the reason the file could not be patched at all."""
+
+        self.added = False
+        """Whether the patch created the file :py:attr:`new_name`."""
+
+        self.removed = False
+        """Whether the patch removed the file :py:attr:`old_name`."""
+
+        super(FileResult, self).__init__()
+
+    @property
+    def succeeded(self):
+        """Whether the file was patched without any conflicts."""
+        return self.error is None and all(hunk.status != HunkStatus.Conflict for hunk in self.hunks)
+
+    @property
+    def status(self):
+        """The :py:class:`HunkStatus` of the least successful hunk, where a
+        file that could not be patched at all is considered to conflict.
+        """
+        if self.error is not None:
+            return HunkStatus.Conflict
+        return max([hunk.status for hunk in self.hunks] + [HunkStatus.Applied])
+
+class PatchResult(object):
+    """The outcome of applying a complete patch."""
+
+    def __init__(self):
+        """Creates an empty patch result."""
+        self.files = []
+        """List of :py:class:`FileResult` instances, one for each file."""
+
+        super(PatchResult, self).__init__()
+
+    @property
+    def succeeded(self):
+        """Whether all files were patched without any conflicts."""
+        return all(file_result.succeeded for file_result in self.files)
+
+    @property
+    def added_file_names(self):
+        """Sorted list of all files that were created by the patch."""
+        return sorted(file_result.new_name for file_result in self.files if file_result.added)
+
+    @property
+    def removed_file_names(self):
+        """Sorted list of all files that were removed by the patch."""
+        return sorted(file_result.old_name for file_result in self.files if file_result.removed)
+
+QUOTED_ESCAPES = {b'a': b'\a', b'b': b'\b', b't': b'\t', b'n': b'\n', b'v': b'\v', b'f': b'\f', b'r': b'\r',
+                  b'"': b'"', b'\\': b'\\'}
+"""Characters following a backslash in a file name quoted by git, mapped to
+the characters they represent.
+"""
+
+def _split_quoted(data):
+    """Splits the file name quoted by git, in C style, at the start of *data*
+    from the remainder of *data*. Returns a tuple containing the unquoted file
+    name and the remainder.
+
+    :raises: :py:exc:`~stash.exception.StashException` in case the quoted file
+        name is not terminated.
+    """
+    file_name = bytearray()
+    position = 1
+    while position < len(data):
+        character = data[position:position + 1]
+        if character == b'"':
+            return bytes(file_name), data[position + 1:]
+        if character == b'\\':
+            escaped = data[position + 1:position + 2]
+            if escaped.isdigit():
+                # Bytes are escaped as three octal digits.
+                file_name.append(int(data[position + 1:position + 4], 8) & 0xff)
+                position += 4
+                continue
+            file_name += QUOTED_ESCAPES.get(escaped, escaped)
+            position += 2
+            continue
+        file_name += character
+        position += 1
+    raise StashException('unterminated quoted file name %r' % data)
+
+def _unquote_file_name(file_name):
+    """Returns the raw *file_name* found in a patch without the quotes and
+    escapes git adds to file names containing special characters.
+    """
+    if file_name.startswith(b'"'):
+        return _split_quoted(file_name)[0]
+    return file_name
+
+def _decode_file_name(file_name):
+    """Decodes the raw, possibly quoted, *file_name* found in a patch to a
+    string, such that encoding it again results in the original file name.
+    """
+    return _unquote_file_name(file_name).decode('utf-8', 'surrogateescape')
+
+def _parse_file_name(header):
+    """Parses the file name from the remainder of a ``---`` or ``+++`` line
+    in *header*. The first path component (``a/`` or ``b/``) is stripped, as
+    is done by ``patch -p1``. Returns ``None`` in case the header refers to
+    ``/dev/null``.
+    """
+    # Anything following a tab is a time stamp or revision annotation. Quoted
+    # file names contain no tabs.
+    file_name = _unquote_file_name(header.rstrip(b'\r\n').split(b'\t')[0])
+    if file_name == b'/dev/null':
+        return None
+    return _decode_file_name(file_name.split(b'/', 1)[-1])
+
+def _parse_git_file_name(header):
+    """Parses the file name from the remainder of a ``diff --git`` line in
+    *header*, in case both file names in the header are equal. Returns ``None``
+    otherwise, in which case the file names should be determined from other
+    header lines.
+    """
+    header = header.rstrip(b'\r\n')
+    if header.startswith(b'"'):
+        old_name, remainder = _split_quoted(header)
+        if not remainder.startswith(b' '):
+            return None
+        new_name = _unquote_file_name(remainder[1:])
+        if old_name.startswith(b'a/') and new_name == b'b/' + old_name[2:]:
+            return _decode_file_name(old_name[2:])
+        return None
+
+    length = (len(header) - 5) // 2
+    file_name = header[2:2 + length]
+    if header == b'a/' + file_name + b' b/' + file_name:
+        return _decode_file_name(file_name)
+    return None
+
+def _decode_binary(lines):
+    """Decodes the base 85 encoded, zlib compressed *lines* of a git binary
+    patch.
+    """
+    data = []
+    for line in lines:
+        # The first character encodes the number of bytes on the line.
+        length = line[0:1]
+        length = ord(length) - ord('A') + 1 if length <= b'Z' else ord(length) - ord('a') + 27
+        data.append(base64.b85decode(line[1:].rstrip(b'\r\n'))[:length])
+    return zlib.decompress(b''.join(data))
+
+def _apply_delta(source, delta):
+    """Applies the git binary *delta* on *source*, and returns the result."""
+    def read_size(position):
+        size, shift = 0, 0
+        while True:
+            byte = bytearray(delta[position:position + 1])[0]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            position += 1
+            if not byte & 0x80:
+                return size, position
+
+    source_size, position = read_size(0)
+    target_size, position = read_size(position)
+    if source_size != len(source):
+        raise StashException('binary delta does not match the original file')
+
+    delta = bytearray(delta)
+    result = bytearray()
+    while position < len(delta):
+        command = delta[position]
+        position += 1
+        if command & 0x80:
+            # Copy a range of the source, the offset and size are encoded in the
+            # bytes that are flagged in the command.
+            offset, size = 0, 0
+            for i in range(4):
+                if command & (1 << i):
+                    offset |= delta[position] << (8 * i)
+                    position += 1
+            for i in range(3):
+                if command & (1 << (4 + i)):
+                    size |= delta[position] << (8 * i)
+                    position += 1
+            result.extend(source[offset:offset + (size or 0x10000)])
+        elif command:
+            # Insert the data following the command.
+            result.extend(delta[position:position + command])
+            position += command
+        else:
+            raise StashException('invalid binary delta')
+
+    if len(result) != target_size:
+        raise StashException('binary delta results in an unexpected size')
+    return bytes(result)
+
+def parse_patch(patch_file, raw=False):
+    """Parses the unified diff read from the binary file object *patch_file*,
+    which may be in git format. Generates a :py:class:`FilePatch` for each file
+    in the patch. The patch is read in a streaming fashion, only the changes
+    for a single file are held in memory at any time.
+
+    In case *raw* is set, the lines of the patch that describe each file are
+    stored in the :py:attr:`FilePatch.raw_lines` attribute of each file patch,
+    such that concatenating these for all file patches results in the original
+    patch (except for any lines preceding the first file).
+    """
+    file_patch = None
+    hunk = None
+    binary_method, binary_lines, binary_blocks = None, [], 0
+
+    # Lines that can not be attributed to a file yet, these either belong to
+    # the header of the next file, or to the current file.
+    pending_lines = []
+
+    def keep_line(file_patch, line):
+        if raw:
+            if file_patch.raw_lines is None:
+                file_patch.raw_lines = []
+            file_patch.raw_lines.extend(pending_lines)
+            file_patch.raw_lines.append(line)
+            del pending_lines[:]
+
+    for line in patch_file:
+        if hunk is not None:
+            if hunk._is_incomplete() or line.startswith(b'\\'):
+                hunk._add_line(line)
+                keep_line(file_patch, line)
+                continue
+            hunk = None
+
+        if binary_blocks:
+            # Only the first block of a binary patch is of interest, the second
+            # block contains the reverse patch.
+            if line.strip():
+                if binary_method is None:
+                    binary_method = line.split()[0]
+                elif binary_blocks == 1:
+                    binary_lines.append(line)
+                keep_line(file_patch, line)
+                continue
+
+            if binary_blocks == 1:
+                file_patch.binary = (binary_method, _decode_binary(binary_lines))
+                binary_method, binary_lines = None, []
+                binary_blocks = 2
+            else:
+                binary_method, binary_blocks = None, 0
+            keep_line(file_patch, line)
+            continue
+
+        recognized = True
+        match = HUNK_HEADER_REGEX.match(line)
+        if match and file_patch is not None:
+            hunk = Hunk(int(match.group(1)), int(match.group(2)) if match.group(2) is not None else 1,
+                        int(match.group(3)), int(match.group(4)) if match.group(4) is not None else 1)
+            file_patch.hunks.append(hunk)
+        elif line.startswith(b'diff --git '):
+            if file_patch is not None:
+                yield file_patch
+            file_patch = FilePatch()
+            file_patch.old_name = file_patch.new_name = _parse_git_file_name(line[11:])
+        elif line.startswith(b'--- '):
+            # Without git headers, a new file starts at its '---' line.
+            if file_patch is None or file_patch.hunks or file_patch.binary or file_patch._has_header:
+                if file_patch is not None:
+                    yield file_patch
+                file_patch = FilePatch()
+            file_patch._has_header = True
+            file_patch.old_name = _parse_file_name(line[4:])
+            file_patch.is_new = file_patch.old_name is None
+        elif file_patch is None:
+            recognized = False
+        elif line.startswith(b'+++ '):
+            file_patch.new_name = _parse_file_name(line[4:])
+            file_patch.is_removed = file_patch.new_name is None
+        elif line.startswith(b'new file mode '):
+            file_patch.is_new = True
+            file_patch.old_name = None
+            file_patch.new_mode = int(line.split()[-1], 8)
+        elif line.startswith(b'deleted file mode '):
+            file_patch.is_removed = True
+            file_patch.new_name = None
+        elif line.startswith(b'new mode '):
+            file_patch.new_mode = int(line.split()[-1], 8)
+        elif line.startswith((b'rename from ', b'copy from ')):
+            file_patch.old_name = _decode_file_name(line.rstrip(b'\r\n').split(b' ', 2)[2])
+            file_patch.is_copy = line.startswith(b'copy')
+        elif line.startswith((b'rename to ', b'copy to ')):
+            file_patch.new_name = _decode_file_name(line.rstrip(b'\r\n').split(b' ', 2)[2])
+        elif line.startswith(b'GIT binary patch'):
+            binary_blocks = 1
+        elif line.startswith(b'Binary files '):
+            file_patch.binary = (b'unknown', None)
+        else:
+            recognized = False
+
+        if recognized:
+            keep_line(file_patch, line)
+        elif raw:
+            # Lines that are not recognized as part of a file header or hunk,
+            # for example 'Index:' lines, might introduce the next file.
+            pending_lines.append(line)
+
+    if binary_blocks == 1:
+        file_patch.binary = (binary_method, _decode_binary(binary_lines))
+    if file_patch is not None:
+        if raw:
+            file_patch.raw_lines.extend(pending_lines)
+        yield file_patch
+
+def match_paths(file_names, paths):
+    """Returns whether any of the *file_names* is equal to, or is located in
+    one of the directories in *paths*.
+    """
+    for path in paths:
+        path = path.rstrip('/')
+        for file_name in file_names:
+            if not path or path == '.' or file_name == path or file_name.startswith(path + '/'):
+                return True
+    return False
+
+def get_file_names(patch_path):
+    """Returns a sorted list of the names of all files that are touched by
+    the patch located at *patch_path*, relative to the repository root.
+    Returns ``None`` in case no file names could be determined, for example
+    because the patch is not a unified diff. The patch may be compressed.
+    """
+    file_names = set()
+    patch_file = open_patch(patch_path)
+    try:
+        for file_patch in parse_patch(patch_file):
+            file_names.update(file_patch.file_names)
+    finally:
+        patch_file.close()
+
+    return sorted(file_names) if file_names else None
+
+def _find_hunk(lines, old_lines, expected, minimum):
+    """Returns the position in *lines* closest to *expected* at which all
+    *old_lines* are found, not before position *minimum*. Returns ``None`` in
+    case the lines could not be found.
+    """
+    maximum = len(lines) - len(old_lines)
+    if maximum < minimum:
+        return None
+    expected = min(max(expected, minimum), maximum)
+
+    count = len(old_lines)
+    first_line = old_lines[0] if old_lines else None
+    for distance in range(max(expected - minimum, maximum - expected) + 1):
+        for position in (expected - distance, expected + distance):
+            if minimum <= position <= maximum and (first_line is None or lines[position] == first_line) \
+                    and lines[position:position + count] == old_lines:
+                return position
+    return None
+
+def apply_hunks(lines, hunks, fuzz=DEFAULT_FUZZ):
+    """Applies all *hunks* to the list of *lines*, which is modified in place.
+    Up to *fuzz* context lines at the start and end of a hunk may be ignored
+    when searching for the location of the hunk. Hunks that can not be applied
+    are merged in place using conflict markers. Returns a list containing a
+    :py:class:`HunkResult` for each hunk.
+    """
+    results = []
+    shift, minimum = 0, 0
+    for hunk in hunks:
+        old_lines, new_lines = hunk.old_lines, hunk.new_lines
+
+        # A hunk without old lines inserts its lines after line 'old_start'.
+        expected = hunk.old_start - (1 if hunk.old_count else 0) + shift
+
+        position, previous_trim = None, None
+        for used_fuzz in range(fuzz + 1):
+            leading = min(used_fuzz, hunk.leading_context)
+            trailing = min(used_fuzz, hunk.trailing_context)
+            if (leading, trailing) == previous_trim:
+                # There is no more context that can be ignored.
+                break
+            previous_trim = (leading, trailing)
+
+            old_trimmed = old_lines[leading:len(old_lines) - trailing]
+            new_trimmed = new_lines[leading:len(new_lines) - trailing]
+            position = _find_hunk(lines, old_trimmed, expected + leading, minimum)
+            if position is not None:
+                lines[position:position + len(old_trimmed)] = new_trimmed
+                offset = position - leading - expected
+                results.append(HunkResult(HunkStatus.Fuzzy if leading or trailing else HunkStatus.Applied, offset, used_fuzz))
+                shift += offset + len(new_trimmed) - len(old_trimmed)
+                minimum = position + len(new_trimmed)
+                break
+
+        if position is None:
+            # Insert the new lines surrounded by conflict markers, similar to
+            # 'patch --merge'.
+            conflict = [b'<<<<<<<\n', b'=======\n']
+            conflict.extend(line if line.endswith(b'\n') else line + b'\n' for line in new_lines)
+            conflict.append(b'>>>>>>>\n')
+
+            position = min(max(expected, minimum), len(lines))
+            lines[position:position] = conflict
+            results.append(HunkResult(HunkStatus.Conflict))
+            shift += len(conflict)
+            minimum = position + len(conflict)
+
+    return results
+
+def _is_safe_file_name(file_name):
+    """Returns whether *file_name* refers to a location inside the root
+    directory a patch is applied in.
+    """
+    return not os.path.isabs(file_name) and os.pardir not in file_name.split('/')
+
+def _write_file(path, data, mode=None):
+    """Atomically replaces the contents of the file at *path* by *data*. In
+    case *mode* is not specified, the permissions of the existing file are
+    retained.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        # Other processes may be creating the same directory.
+        os.makedirs(directory, exist_ok=True)
+
+    if mode is None:
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = None
+
+    handle, temp_path = tempfile.mkstemp(dir=directory or None, prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(data)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        else:
+            # Use the default permissions for new files.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0o666 & ~umask)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+def _write_link(path, target):
+    """Atomically replaces the file at *path* by a symbolic link pointing to
+    *target*, given as bytes.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    while True:
+        temp_path = os.path.join(directory, '.%s.%s' % (os.path.basename(path), os.urandom(4).hex()))
+        try:
+            os.symlink(target, os.fsencode(temp_path))
+            break
+        except FileExistsError:
+            continue
+    try:
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+def apply_file_patch(file_patch, root_path, fuzz=DEFAULT_FUZZ, dry_run=False):
+    """Applies *file_patch* to the files in the directory *root_path*. Returns
+    a :py:class:`FileResult` describing the outcome. In case *dry_run* is set,
+    the file is patched in memory only, and no files are modified.
+    """
+    result = FileResult(file_patch)
+    for file_name in file_patch.file_names:
+        if not _is_safe_file_name(file_name):
+            result.error = "file '%s' is outside of the repository" % file_name
+            return result
+
+    old_path = os.path.join(root_path, file_patch.old_name) if file_patch.old_name else None
+    new_path = os.path.join(root_path, file_patch.new_name) if file_patch.new_name else None
+
+    # Only regular files and symbolic links are supported. Permission bits are
+    # only applied to regular files.
+    file_type = stat.S_IFMT(file_patch.new_mode) if file_patch.new_mode is not None else None
+    if file_type not in (None, stat.S_IFREG, stat.S_IFLNK):
+        result.error = "file '%s' has an unsupported mode %o" % (file_patch.new_name or file_patch.old_name, file_patch.new_mode)
+        return result
+    mode = stat.S_IMODE(file_patch.new_mode) if file_type == stat.S_IFREG else None
+
+    # Read the original contents of the file. The contents of a symbolic link
+    # are its target.
+    if file_patch.is_new:
+        if os.path.lexists(new_path):
+            result.error = "file '%s' to be created already exists" % file_patch.new_name
+            return result
+        data = b''
+        is_link = file_type == stat.S_IFLNK
+    else:
+        try:
+            is_link = file_type == stat.S_IFLNK or (file_type is None and os.path.islink(old_path))
+            if os.path.islink(old_path):
+                data = os.fsencode(os.readlink(old_path))
+            else:
+                with open(old_path, 'rb') as old_file:
+                    data = old_file.read()
+        except (IOError, OSError):
+            result.error = "file '%s' to be patched does not exist" % file_patch.old_name
+            return result
+
+    # Determine the new contents of the file.
+    if file_patch.binary is not None:
+        method, binary_data = file_patch.binary
+        try:
+            if method == b'literal':
+                data = binary_data
+            elif method == b'delta':
+                data = _apply_delta(data, binary_data)
+            else:
+                result.error = "binary file '%s' has no data in the patch" % (file_patch.new_name or file_patch.old_name)
+                return result
+        except StashException as e:
+            result.error = str(e)
+            return result
+    elif file_patch.hunks:
+        # Only newlines separate lines in a diff, carriage returns are part of
+        # the line contents.
+        lines = data.split(b'\n')
+        lines = [line + b'\n' for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+        result.hunks = apply_hunks(lines, file_patch.hunks, fuzz)
+        data = b''.join(lines)
+
+    # Write the results.
+    if file_patch.is_removed:
+        if not result.succeeded:
+            # Keep the file including any conflicts.
+            if not dry_run and not is_link:
+                _write_file(old_path, data)
+        elif data:
+            result.error = "file '%s' to be removed is not empty after patching" % file_patch.old_name
+        else:
+            if not dry_run:
+                os.unlink(old_path)
+            result.removed = True
+        return result
+
+    if dry_run:
+        pass
+    elif is_link:
+        # A link with conflicts is left untouched.
+        if result.succeeded and (new_path != old_path or file_patch.hunks or file_type is not None):
+            _write_link(new_path, data)
+    elif new_path != old_path or file_patch.hunks or file_patch.binary is not None:
+        _write_file(new_path, data, mode)
+    elif mode is not None:
+        os.chmod(new_path, mode)
+
+    result.added = new_path != old_path
+    if old_path is not None and old_path != new_path and not file_patch.is_copy:
+        if not dry_run:
+            os.unlink(old_path)
+        result.removed = True
+
+    return result
+
+def get_process_context():
+    """Returns the :py:mod:`multiprocessing` context used to start worker
+    processes. Forking a process in which other threads are running, like those
+    of a repository or a stash server, may deadlock the child, so workers are
+    started by a fork server where possible, and spawned otherwise.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+def _apply_batch(data, root_path, fuzz, dry_run):
+    """Applies the patch *data*, containing the changes to a batch of files,
+    to the files in *root_path*. Returns a list of :py:class:`FileResult`
+    instances. Used by worker processes of :py:func:`apply_patch`.
+    """
+    return [apply_file_patch(file_patch, root_path, fuzz, dry_run) for file_patch in parse_patch(io.BytesIO(data))]
+
+def _apply_file_patches_concurrently(file_patches, root_path, fuzz, dry_run, processes):
+    """Applies all *file_patches*, parsed including their raw lines, using a
+    pool of *processes* processes. Returns a list of :py:class:`FileResult`
+    instances in the order of *file_patches*.
+
+    File patches are sent to the workers in batches of about
+    :py:data:`BATCH_SIZE` bytes, once the file patches read so far add up to
+    :py:data:`CONCURRENT_APPLY_SIZE` bytes. Batches that were not sent are
+    applied by the calling process. Batches never touch the same files, so
+    they can be applied in any order. A file patch touching a file in an
+    earlier batch is deferred, together with all later file patches touching
+    the same files, and applied in order after all batches.
+    """
+    results = []
+    executor = None
+    futures = []
+    batches, batch, batch_size, batched_names = [], [], 0, set()
+    total_size = 0
+    deferred, deferred_names = [], set()
+    try:
+        for index, file_patch in enumerate(file_patches):
+            results.append(None)
+            file_names = file_patch.file_names
+            if file_names & batched_names or file_names & deferred_names:
+                deferred.append((index, file_patch))
+                deferred_names.update(file_names)
+                continue
+
+            size = sum(len(line) for line in file_patch.raw_lines or [])
+            batch.append((index, file_patch))
+            batch_size += size
+            total_size += size
+            if batch_size >= BATCH_SIZE:
+                batches.append(batch)
+                batched_names.update(name for _, batch_file_patch in batch for name in batch_file_patch.file_names)
+                batch, batch_size = [], 0
+
+            if batches and total_size >= CONCURRENT_APPLY_SIZE:
+                if executor is None:
+                    executor = ProcessPoolExecutor(max_workers=processes, mp_context=get_process_context())
+                for full_batch in batches:
+                    data = b''.join(line for _, batch_file_patch in full_batch for line in batch_file_patch.raw_lines or [])
+                    futures.append(([index for index, _ in full_batch],
+                                    executor.submit(_apply_batch, data, root_path, fuzz, dry_run)))
+                batches = []
+
+        # The remaining batches do not touch any of the files being patched by
+        # the workers.
+        for remaining_batch in batches + [batch]:
+            for index, file_patch in remaining_batch:
+                results[index] = apply_file_patch(file_patch, root_path, fuzz, dry_run)
+        for indices, future in futures:
+            for index, file_result in zip(indices, future.result()):
+                results[index] = file_result
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for index, file_patch in deferred:
+        results[index] = apply_file_patch(file_patch, root_path, fuzz, dry_run)
+    return results
+
+def apply_patch(patch_path, root_path, fuzz=DEFAULT_FUZZ, dry_run=False, processes=1):
+    """Applies the patch located at *patch_path* to the files in the directory
+    *root_path*, stripping the first path component of all file names (like
+    ``patch -p1``). The patch may be compressed. Hunks that do not apply are
+    merged in place using conflict markers. Returns a :py:class:`PatchResult`
+    describing the outcome for each file and hunk. In case *dry_run* is set,
+    the outcome is determined in memory only, and no files are modified.
+
+    In case *processes* is larger than one, the changes to independent files
+    of patches larger than :py:data:`CONCURRENT_APPLY_SIZE` bytes are applied
+    concurrently, by a pool of *processes* processes.
+    """
+    result = PatchResult()
+    patch_file = open_patch(patch_path)
+    try:
+        if processes > 1:
+            result.files = _apply_file_patches_concurrently(parse_patch(patch_file, raw=True), root_path, fuzz, dry_run,
+                                                            processes)
+        else:
+            for file_patch in parse_patch(patch_file):
+                result.files.append(apply_file_patch(file_patch, root_path, fuzz, dry_run))
+    finally:
+        patch_file.close()
+    return result
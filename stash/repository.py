@@ -1,16 +1,112 @@
-import inspect
+import contextlib
+import io
 import os
+import shutil
+import struct
 import subprocess
-import sys
+import tempfile
+import threading
 
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
 
+from .cmdserver import CommandServer
+from .compression import CHUNK_SIZE, detect_codec, open_patch
 from .exception import StashException
+from .patch import DEFAULT_FUZZ, FileResult, HunkResult, HunkStatus, PatchResult, apply_patch, parse_patch
+from .rootcache import RootPathCache, get_signatures, signatures_match
+from .trace import get_tracer, traced
+from .watcher import create_watcher
+
+def get_argument_limit():
+    """Returns the maximum number of bytes that can be used for the
+    command-line arguments of a new process, taking into account the space
+    that is taken by the environment.
+    """
+    try:
+        limit = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        limit = -1
+    if limit <= 0:
+        # Fall back to a limit that is supported by all common platforms.
+        limit = 32768
+
+    pointer_size = struct.calcsize('P')
+    environment_size = sum(len(key) + len(value) + 2 + pointer_size for key, value in os.environ.items())
+
+    # Leave some room for any variables added by the process itself.
+    return max(limit - environment_size - 4096, 4096)
+
+def split_arguments(command, arguments, limit=None):
+    """Splits the list of *arguments* into chunks, such that *command*
+    followed by a single chunk of arguments fits within the operating system
+    limit on the size of command-line arguments, or *limit* in case it is
+    specified. Yields all chunks in order.
+    """
+    if limit is None:
+        limit = get_argument_limit()
+
+    # Each argument takes up its encoded size, a terminating null character,
+    # and a pointer in the argument vector.
+    pointer_size = struct.calcsize('P')
+    def size(argument):
+        return len(argument.encode('utf-8', 'surrogateescape')) + 1 + pointer_size
+
+    command_size = sum(size(argument) for argument in command)
+    chunk, chunk_size = [], command_size
+    for argument in arguments:
+        argument_size = size(argument)
+        if chunk and chunk_size + argument_size > limit:
+            yield chunk
+            chunk, chunk_size = [], command_size
+        chunk.append(argument)
+        chunk_size += argument_size
+
+    if chunk:
+        yield chunk
+
+def _tell(output):
+    """Returns the current position in the file object *output*, or ``None``
+    in case it can not be determined.
+    """
+    try:
+        return output.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+_REPOSITORY_CLASSES = []
+"""All registered repository implementations, in order of registration."""
+
+def register_repository(repository_cls):
+    """Class decorator that registers the concrete repository implementation
+    *repository_cls*, such that :py:meth:`Repository.__new__` detects its
+    repositories. When markers of several version control systems are found
+    in the same directory, the implementation that was registered first is
+    used.
+    """
+    _REPOSITORY_CLASSES.append(repository_cls)
+    return repository_cls
+
+def get_repository_classes():
+    """Returns a list of all registered repository implementations."""
+    return list(_REPOSITORY_CLASSES)
+
+@contextlib.contextmanager
+def _no_watcher():
+    """Context manager used instead of
+    :py:meth:`~stash.watcher.Watcher.own_changes` in case the working copy is
+    not watched.
+    """
+    yield
 
 class FileStatus(object):
     """Enum for all possible file states that are handled by stash."""
     Added, Removed = range(2)
 
+class FileChange(object):
+    """Enum for all kinds of changes to version controlled files."""
+    Modified, Added, Removed = range(3)
+
 class Repository(object):
     """Abstract class that defines an interface for all functionality required
     by :py:class:`~stash.stash.Stash` to properly interface with a version
@@ -18,6 +114,52 @@ class Repository(object):
     """
     __metaclass__ = ABCMeta
 
+    VCS_NAME = None
+    """Short name of the version control system, used to identify the type of
+    repository a patch was created in.
+    """
+
+    MARKER = None
+    """Name of the file or directory that is present in the root directory of
+    a repository.
+    """
+
+    STATE_FILES = []
+    """Names of the files in the :py:attr:`MARKER` directory that change when
+    the state of files in the working copy is changed without modifying the
+    files themselves, for example by adding a file, see :py:meth:`watch`.
+    """
+
+    ROOT_CACHE_PATH = os.environ.get('STASH_ROOT_CACHE') or None
+    """Path of a file in which detected root paths are cached across
+    processes, see :py:class:`~stash.rootcache.RootPathCache`. Can be set using
+    the environment variable ``STASH_ROOT_CACHE``, by default root paths are
+    only cached within a process.
+    """
+
+    MAX_WORKERS = min(4, (os.cpu_count() or 1) - 1)
+    """Maximum number of queries that are executed concurrently by the
+    asynchronous variants of the query methods, such as
+    :py:meth:`status_async`, in addition to the calling thread. Starting a
+    version control command is mostly CPU bound, so by default one less than
+    the number of CPUs is used, up to at most four, since more concurrent
+    commands mostly contend for the same repository metadata. In case it is
+    set to ``0``, those methods execute the query immediately in the calling
+    thread.
+    """
+
+    APPLY_PROCESSES = os.cpu_count() or 1
+    """Number of processes used to apply the changes to independent files of
+    large patches concurrently, see :py:func:`~stash.patch.apply_patch`. In
+    case it is ``1``, patches are always applied by the calling process.
+    """
+
+    _root_paths = {}
+    """Root paths detected within this process, by start path and the
+    repository implementations that were looked for, together with the
+    signatures of the directories from the start path up to the root path.
+    """
+
     def __init__(self, path, create=False):
         """Creating a concrete repository instance is done using the factory
         method :py:meth:`~stash.repository.Repository.__new__`. After the
@@ -25,9 +167,18 @@ class Repository(object):
         specifying a *path* within the repository.
         """
 
-        self.root_path = self.get_root_path(path)
+        # The factory has already detected the repository, reuse its result.
+        repository_cls, root_path = self._find_root_path(path, _REPOSITORY_CLASSES)
+        if repository_cls is None or not isinstance(self, repository_cls):
+            root_path = self.get_root_path(path)
+
+        self.root_path = root_path
         """Root path of the repository."""
 
+        self._executor = None
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+
         # In case no valid repository could be found, and one should be created,
         # do so.
         if create and self.root_path is None:
@@ -41,8 +192,9 @@ class Repository(object):
 
             # Finally, create the repository.
             self.init()
+            Repository._root_paths.clear()
 
-        super(Repository, self).__init__(self)
+        super(Repository, self).__init__()
 
     def __new__(cls, path, create=False):
         """Factory that will return the right repository wrapper depending on
@@ -51,40 +203,243 @@ class Repository(object):
         :raises: :py:exc:`~stash.exception.StashException` in case no repository is
             found at *path*.
         """
-        # Iterate over all repository implementations, and for each
-        # implementation, determine whether it can find a root path for the
-        # repository specified at the specified path.
+        # Look for the markers of all registered repository implementations
+        # at once, and create an instance of the implementation of the nearest
+        # repository.
         if cls == Repository:
-            for name, repository_cls in inspect.getmembers(sys.modules[cls.__module__]):
-                if inspect.isclass(repository_cls) and Repository in repository_cls.__bases__:
-                    repository_root = repository_cls.get_root_path(path)
-                    if repository_root is not None:
-                        # A root path for the current repository implementation
-                        # could be found, create an instance of this class.
-                        return super(Repository, repository_cls).__new__(repository_cls)
-
-            raise StashException("no valid repository found at '%s'" % path)
+            repository_cls = cls._find_root_path(path, _REPOSITORY_CLASSES)[0]
+            if repository_cls is None:
+                raise StashException("no valid repository found at '%s'" % path)
+            return super(Repository, repository_cls).__new__(repository_cls)
         else:
-            return super(Repository, cls).__new__(cls, path, create)
+            return super(Repository, cls).__new__(cls)
+
+    @classmethod
+    def _find_root_path(cls, path, repository_classes):
+        """Walks up from *path* to the file system root once, checking each
+        directory for the markers of all *repository_classes* using a single
+        ``lstat`` per marker. Returns a tuple containing the implementation and
+        the absolute root path of the nearest repository, or ``(None, None)``
+        in case *path* is not part of any of those repositories.
+
+        Results are cached within the process, and in case
+        :py:attr:`ROOT_CACHE_PATH` is set, across processes as well. A cached
+        result is only used as long as none of the directories from *path* up
+        to and including the root path changed, so that both removed
+        repositories and repositories created in between are detected.
+        """
+        path = os.path.abspath(path)
+        key = (path, tuple(repository_classes))
+
+        result = cls._root_paths.get(key)
+        if result is not None and signatures_match(result[2]):
+            return result[:2]
+
+        root_cache = RootPathCache(cls.ROOT_CACHE_PATH) if cls.ROOT_CACHE_PATH else None
+        cache_key = ','.join(repository_cls.VCS_NAME for repository_cls in repository_classes)
+        if root_cache is not None:
+            vcs, root_path = root_cache.get(cache_key, path)
+            for repository_cls in repository_classes:
+                if repository_cls.VCS_NAME == vcs:
+                    cls._remember_root_path(key, repository_cls, root_path)
+                    return repository_cls, root_path
+
+        directory = path
+        while True:
+            for repository_cls in repository_classes:
+                if os.path.lexists(os.path.join(directory, repository_cls.MARKER)):
+                    cls._remember_root_path(key, repository_cls, directory)
+                    if root_cache is not None:
+                        root_cache.set(cache_key, path, repository_cls.VCS_NAME, directory)
+                    return repository_cls, directory
 
-    def _execute(self, command, stdin=None, stdout=subprocess.PIPE):
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None, None
+            directory = parent
+
+    @classmethod
+    def _remember_root_path(cls, key, repository_cls, root_path):
+        """Caches the root path *root_path* of the repository of type
+        *repository_cls* found for *key* within this process, unless the
+        directories in between can not be accessed.
+        """
+        signatures = get_signatures(key[0], root_path)
+        if signatures is not None:
+            cls._root_paths[key] = (repository_cls, root_path, signatures)
+
+    def _execute(self, command, stdin=None, stdout=subprocess.PIPE, stderr=None, env=None):
         """Executes the specified command relative to the repository root.
-        Returns a tuple containing the return code and the process output.
+        *command* is a list containing the program and its arguments, no shell
+        is involved. Returns a tuple containing the return code and the
+        process output. In case a file object is passed as *stdout*, the
+        output of the process is written to that file instead, and ``None`` is
+        returned as output. In case a dictionary *env* is given, it is used as
+        the environment of the process. In case tracing is enabled, the command
+        is recorded by the active :py:class:`~stash.trace.Tracer`.
+        """
+        tracer = get_tracer()
+        if tracer is None:
+            with self._own_changes():
+                return self._run(command, stdin, stdout, stderr, env)
+
+        start, position = tracer.now(), _tell(stdout)
+        with self._own_changes():
+            return_code, output = self._run(command, stdin, stdout, stderr, env)
+        tracer.add_command(command, start, return_code, self._get_output_size(output, stdout, position))
+        return return_code, output
+
+    def _own_changes(self):
+        """Returns a context manager for executing a command of the version
+        control system, see :py:meth:`~stash.watcher.Watcher.own_changes`.
+        """
+        watcher = self._watcher
+        return watcher.own_changes() if watcher is not None else _no_watcher()
+
+    def watch(self):
+        """Starts watching the working copy for changes, see
+        :py:mod:`stash.watcher`. Afterwards, queries on the complete working
+        copy, such as :py:meth:`status` without file names, only examine the
+        paths that may have changed. This is only worthwhile in a long running
+        process, since the watcher is seeded by querying the complete working
+        copy once.
+        """
+        if self._watcher is None:
+            self._watcher = create_watcher(self.root_path, self.MARKER, self.STATE_FILES)
+
+    def _get_scan_paths(self, paths):
+        """Returns the paths a query of the working copy needs to examine, in
+        order to find all changes to *paths*. In case the working copy is
+        watched and *paths* is ``None``, these are the paths that may have
+        changed. Otherwise *paths* is returned, where ``None`` means the
+        complete working copy.
+        """
+        if paths is not None or self._watcher is None:
+            return paths
+
+        with self._watcher_lock:
+            watcher = self._watcher
+            if watcher is None:
+                return None
+            if watcher.broken:
+                self._watcher = None
+                watcher.close()
+                return None
+
+            dirty_paths = watcher.get_dirty_paths()
+            if dirty_paths is None:
+                # Determine the changed paths by querying the complete working
+                # copy, without the watcher.
+                generation = watcher.generation
+                self._watcher = None
+                try:
+                    with watcher.own_changes():
+                        changed = [file_name for _, file_name in self.status()] + [file_name for _, file_name in self.get_changes()]
+                finally:
+                    self._watcher = watcher
+                watcher.reset(changed, generation)
+                dirty_paths = watcher.get_dirty_paths()
+            return dirty_paths
+
+    @staticmethod
+    def _get_output_size(output, stdout, position):
+        """Returns the number of bytes a command has produced, given its
+        decoded *output*, or the file object *stdout* the output was written
+        to starting at *position*. Returns ``None`` in case the size can not be
+        determined.
+        """
+        if output is not None:
+            return len(output.encode('utf-8'))
+        end = _tell(stdout)
+        if position is None or end is None:
+            return None
+        return end - position
+
+    def _run(self, command, stdin, stdout, stderr, env=None):
+        """Executes *command* without tracing, see :py:meth:`_execute`."""
+        if stdout is not subprocess.PIPE and not isinstance(stdout, (io.FileIO, io.BufferedWriter, io.BufferedRandom)):
+            # The output needs to pass through the file object, for example to
+            # be compressed, copy it in chunks.
+            process = subprocess.Popen(command, cwd=self.root_path, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr, env=env)
+            shutil.copyfileobj(process.stdout, stdout, CHUNK_SIZE)
+            process.stdout.close()
+            return (process.wait(), None)
+
+        process = subprocess.Popen(command, cwd=self.root_path, stdin=stdin, stdout=stdout, stderr=stderr, env=env)
+        if stdout is not subprocess.PIPE:
+            # The output is written directly to the specified file by the
+            # process itself.
+            return (process.wait(), None)
+        output = process.communicate()[0]
+        return (process.returncode, output.decode('utf-8'))
+
+    def _submit(self, function, *args):
+        """Executes *function* with *args* in a thread of the repository, and
+        returns a :py:class:`concurrent.futures.Future` for its result. In case
+        :py:attr:`MAX_WORKERS` is ``0``, *function* is executed immediately.
+        """
+        if not self.MAX_WORKERS:
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        return self._executor.submit(function, *args)
+
+    def _execute_chunked(self, command, arguments, stdout=subprocess.PIPE, stderr=None):
+        """Executes *command* for all *arguments*, which are appended to the
+        command. The arguments are divided over as few processes as the
+        operating system limit on the size of command-line arguments allows.
+        Returns a tuple containing the first non-zero return code (or zero),
+        and the combined output of all processes. In case a file object is
+        passed as *stdout*, the output of all processes is written to that
+        file instead, and ``None`` is returned as output.
         """
-        process = subprocess.Popen(command, shell=True, cwd=self.root_path, stdin=stdin, stdout=stdout)
-        return (process.wait(), None if stdout is not subprocess.PIPE else process.communicate()[0].decode('utf-8'))
+        return_code, output = 0, []
+        for chunk in split_arguments(command, arguments):
+            chunk_return_code, chunk_output = self._execute(command + chunk, stdout=stdout, stderr=stderr)
+            return_code = return_code or chunk_return_code
+            output.append(chunk_output)
+        return return_code, ''.join(output) if stdout is subprocess.PIPE else None
 
     @abstractmethod
     def add(self, file_names):
-        """Adds all files in *file_names* to the repository."""
+        """Adds all files in *file_names* to the repository. There is no limit
+        on the number of files that can be specified.
+        """
         pass
 
-    def apply_patch(self, patch_path):
-        """Applies the patch located at *patch_path*. Returns the return code of
-        the patch command.
+    @traced
+    def apply_patch(self, patch_path, fuzz=DEFAULT_FUZZ):
+        """Applies the patch located at *patch_path* to the working copy.
+        Hunks that do not apply cleanly are merged in place using conflict
+        markers. Returns a :py:class:`~stash.patch.PatchResult` describing the
+        outcome for each file and hunk in the patch.
+        """
+        return apply_patch(patch_path, self.root_path, fuzz, processes=self.APPLY_PROCESSES)
+
+    def check_patch(self, patch_path, fuzz=DEFAULT_FUZZ):
+        """Determines whether the patch located at *patch_path* applies to the
+        working copy, without modifying it. Returns a
+        :py:class:`~stash.patch.PatchResult` describing the outcome
+        :py:meth:`apply_patch` would have.
+        """
+        return apply_patch(patch_path, self.root_path, fuzz, dry_run=True, processes=self.APPLY_PROCESSES)
+
+    def close(self):
+        """Releases all resources that are held by the repository, for
+        example processes that are kept alive to execute commands.
         """
-        # Do not create .orig backup files, and merge files in place.
-        return self._execute('patch -p1 --no-backup-if-mismatch --merge', stdout=open(os.devnull, 'w'), stdin=open(patch_path, 'r'))[0]
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
 
     @abstractmethod
     def commit(self, message):
@@ -93,9 +448,59 @@ class Repository(object):
         """
         pass
 
+    def diff(self, paths=None):
+        """Returns a diff text for all changes in the repository, or only for
+        the changes to the files and directories in *paths* in case it is
+        given.
+        """
+        patch_file = tempfile.TemporaryFile()
+        try:
+            self.write_diff(patch_file, paths)
+            patch_file.seek(0)
+            return patch_file.read().decode('utf-8')
+        finally:
+            patch_file.close()
+
+    def diff_async(self, paths=None):
+        """Asynchronous variant of :py:meth:`diff`, returns a
+        :py:class:`concurrent.futures.Future` for its result.
+        """
+        return self._submit(self.diff, paths)
+
+    def write_diff_async(self, patch_file, paths=None):
+        """Asynchronous variant of :py:meth:`write_diff`, returns a
+        :py:class:`concurrent.futures.Future` for its result. *patch_file*
+        should not be used until the result is available.
+        """
+        return self._submit(self.write_diff, patch_file, paths)
+
+    def get_revision_async(self):
+        """Asynchronous variant of :py:meth:`get_revision`, returns a
+        :py:class:`concurrent.futures.Future` for its result.
+        """
+        return self._submit(self.get_revision)
+
+    def status_async(self, file_names=None):
+        """Asynchronous variant of :py:meth:`status`, returns a
+        :py:class:`concurrent.futures.Future` for its result.
+        """
+        return self._submit(self.status, file_names)
+
+    @abstractmethod
+    def get_changes(self, paths=None):
+        """Returns a sorted list of tuples containing the
+        :py:class:`FileChange` and the name of each file that is modified,
+        added or removed (including files that are missing) in the working
+        copy. In case a list of *paths* is given, only the changes to those
+        files and the files in those directories are returned.
+        """
+        pass
+
     @abstractmethod
-    def diff(self):
-        """Returns a diff text for all changes in the repository."""
+    def get_revision(self):
+        """Returns an identifier for the revision the working copy is based
+        on.
+        """
         pass
 
     @abstractmethod
@@ -105,7 +510,17 @@ class Repository(object):
 
     @abstractmethod
     def remove(self, file_names):
-        """Removes all files in *file_names* from the repository."""
+        """Removes all files in *file_names* from the repository. There is no
+        limit on the number of files that can be specified.
+        """
+        pass
+
+    @abstractmethod
+    def revert(self, file_names):
+        """Reverts all changes to the files in *file_names* without creating
+        any backup files. Directories in *file_names* are reverted
+        recursively.
+        """
         pass
 
     @abstractmethod
@@ -115,127 +530,509 @@ class Repository(object):
         """
         pass
 
-    @classmethod
     @abstractmethod
+    def write_diff(self, patch_file, paths=None):
+        """Writes a diff for all changes in the repository to the binary file
+        object *patch_file*. The diff is copied directly from the version
+        control system to the file, without holding it in memory. In case a
+        list of *paths* (relative to the repository root) is given, only
+        changes to those files and the files in those directories are
+        included. Returns the return code of the diff command.
+        """
+        pass
+
+    @classmethod
     def get_root_path(cls, path):
-        """Returns the root path for the repository location *path*. In case
+        """Returns the absolute root path for the repository location *path*,
+        which is the nearest directory containing :py:attr:`MARKER`. In case
         *path* is not part of a repository, `None` is returned.
         """
-        pass
+        return cls._find_root_path(path, [cls])[1]
 
     @abstractmethod
-    def status(self):
-        """Returns the current status of all files in the repository."""
+    def status(self, file_names=None):
+        """Returns the current status of all files in the repository. In case
+        a list of *file_names* is given, only the status of those files is
+        determined, which avoids walking the complete working copy.
+        """
         pass
 
+@register_repository
 class MercurialRepository(Repository):
     """Concrete implementation of :py:class:`~stash.repository.Repository` for
     Mercurial repositories.
     """
 
+    VCS_NAME = 'hg'
+    """Short name of the version control system."""
+
+    MARKER = '.hg'
+    """Directory marking the root of a Mercurial repository."""
+
+    STATE_FILES = ['dirstate']
+    """Files in which Mercurial stores the state of the working copy."""
+
+    USE_COMMAND_SERVER = os.environ.get('STASH_HG_COMMAND_SERVER', '0') not in ('', '0')
+    """Whether all commands should be sent to a single Mercurial command server
+    per repository, instead of starting a new ``hg`` process for each command.
+    Can be enabled by setting the environment variable
+    ``STASH_HG_COMMAND_SERVER`` to ``1``.
+    """
+
+    def __init__(self, path, create=False):
+        """See :py:meth:`~stash.repository.Repository.__init__`."""
+        self._command_server = None
+        self._command_server_lock = threading.Lock()
+
+        super(MercurialRepository, self).__init__(path, create)
+
+    def _hg(self, args, stdout=subprocess.PIPE, file_arguments=None):
+        """Executes the Mercurial command described by the argument list
+        *args*. In case :py:attr:`USE_COMMAND_SERVER` is set, the command is
+        executed by the command server for this repository, otherwise a new
+        ``hg`` process is started. Returns a tuple containing the return code
+        and the command output. In case a binary file object is passed as
+        *stdout*, the output is written to that file instead.
+
+        Arguments referring to files can be passed as *file_arguments*. These
+        are appended to *args*, and are divided over multiple processes in
+        case they do not fit on a single command-line. In case an empty list is
+        passed, the command is not executed at all.
+        """
+        if file_arguments is not None and not file_arguments:
+            return 0, ''
+
+        if self.USE_COMMAND_SERVER and self._command_server is not False:
+            # The command server is not limited by the size of a command-line.
+            command = args + (file_arguments or [])
+            position = stdout.tell() if stdout is not subprocess.PIPE else None
+            tracer = get_tracer()
+
+            # Commands may be executed from multiple threads, while the
+            # command server handles a single command at a time.
+            with self._command_server_lock:
+                try:
+                    if self._command_server is None:
+                        self._command_server = CommandServer(self.root_path)
+                    start = tracer.now() if tracer is not None else None
+                    with self._own_changes():
+                        return_code, output = self._command_server.runcommand(command, stdout if stdout is not subprocess.PIPE else None)
+                    if tracer is not None:
+                        output_size = len(output) if output is not None else self._get_output_size(None, stdout, position)
+                        tracer.add_command(['hg'] + command, start, return_code, output_size, 'cmdserver')
+                    return return_code, output.decode('utf-8') if output is not None else None
+                except StashException:
+                    # The command server is not available, fall back to
+                    # executing each command in its own process for this
+                    # repository.
+                    self._close_command_server()
+                    self._command_server = False
+
+                    # Discard any partial output of the failed command. In case
+                    # that is not possible, the command can not be retried.
+                    if position is not None and stdout.tell() != position:
+                        if not stdout.seekable():
+                            raise
+                        stdout.seek(position)
+                        stdout.truncate()
+
+        if file_arguments is not None:
+            return self._execute_chunked(['hg'] + args, file_arguments, stdout=stdout)
+        return self._execute(['hg'] + args, stdout=stdout)
+
+    @staticmethod
+    def _include_patterns(file_names):
+        """Returns the arguments that limit a Mercurial command to exactly the
+        files in *file_names*, and to all files in case one of them refers to a
+        directory. Include patterns are used instead of explicit file names,
+        since Mercurial complains about explicitly specified files that do not
+        exist.
+        """
+        return ['--include=path:%s' % file_name for file_name in file_names]
+
     def add(self, file_names):
         """See :py:meth:`~stash.repository.Repository.add`."""
-        self._execute('hg add %s' % (' '.join(file_names)))
+        self._hg(['add'], file_arguments=file_names)
+
+    def _close_command_server(self):
+        """Stops the command server of this repository, in case it is
+        running.
+        """
+        if self._command_server:
+            self._command_server.close()
+            self._command_server = None
+
+    def close(self):
+        """See :py:meth:`~stash.repository.Repository.close`."""
+        self._close_command_server()
+
+        super(MercurialRepository, self).close()
 
     def commit(self, message):
         """See :py:meth:`~stash.repository.Repository.commit`."""
-        self._execute('hg ci -m "%s" -u anonymous' % message)
+        self._hg(['ci', '-m', message, '-u', 'anonymous'])
 
-    def diff(self):
-        """See :py:meth:`~stash.repository.Repository.diff`."""
-        return self._execute('hg diff -a')[1]
+    def get_changes(self, paths=None):
+        """See :py:meth:`~stash.repository.Repository.get_changes`."""
+        paths = self._get_scan_paths(paths)
+        file_arguments = self._include_patterns(paths) if paths is not None else None
+        changes = {'M': FileChange.Modified, 'A': FileChange.Added, 'R': FileChange.Removed, '!': FileChange.Removed}
+        output = self._hg(['status', '-m', '-a', '-r', '-d'], file_arguments=file_arguments)[1]
+        return sorted((changes[line[0]], line[2:]) for line in output.splitlines() if line[:1] in changes)
+
+    def get_revision(self):
+        """See :py:meth:`~stash.repository.Repository.get_revision`."""
+        return self._hg(['log', '-r', '.', '--template', '{node}'])[1].strip()
 
     def init(self):
         """See :py:meth:`~stash.repository.Repository.init`."""
-        self._execute('hg init')
+        # There is no repository yet to start a command server for.
+        self._execute(['hg', 'init'])
 
     def remove(self, file_names):
         """See :py:meth:`~stash.repository.Repository.remove`."""
-        self._execute('hg rm %s' % (' '.join(file_names)))
+        self._hg(['rm'], file_arguments=file_names)
+
+    def revert(self, file_names):
+        """See :py:meth:`~stash.repository.Repository.revert`."""
+        self._hg(['revert', '-q', '-C'], file_arguments=self._include_patterns(file_names))
 
     def revert_all(self):
         """See :py:meth:`~stash.repository.Repository.revert_all`."""
-        self._execute('hg revert -q -C --all')
+        self._hg(['revert', '-q', '-C', '--all'])
 
-    @classmethod
-    def get_root_path(self, path):
-        """See :py:meth:`~stash.repository.Repository.get_root_path`."""
-        # Look at the directories present in the current working directory. In case
-        # a .hg directory is present, we know we are in the root directory of a
-        # Mercurial repository. In case no repository specific folder is found, and
-        # the current directory has a parent directory, look if a repository
-        # specific directory can be found in the parent directory.
-        while path != '/':
-            if '.hg' in os.listdir(path):
-                return path
-            path = os.path.abspath(os.path.join(path, os.pardir))
-
-        # No Mercurial repository found.
-        return None
+    def write_diff(self, patch_file, paths=None):
+        """See :py:meth:`~stash.repository.Repository.write_diff`."""
+        paths = self._get_scan_paths(paths)
+        file_arguments = self._include_patterns(paths) if paths is not None else None
+        return self._hg(['diff', '-a'], stdout=patch_file, file_arguments=file_arguments)[0]
 
-    def status(self):
+    def status(self, file_names=None):
         """See :py:meth:`~stash.repository.Repository.status`."""
         result = set()
-        for line in self._execute('hg stat')[1].splitlines():
+        file_names = self._get_scan_paths(file_names)
+        if file_names is not None and not file_names:
+            return result
+
+        file_arguments = self._include_patterns(file_names) if file_names is not None else None
+        for line in self._hg(['stat'], file_arguments=file_arguments)[1].splitlines():
             if line[0] == '?':
                 result.add((FileStatus.Added, line[2:].strip()))
             elif line[0] == '!':
                 result.add((FileStatus.Removed, line[2:].strip()))
         return result
 
+@register_repository
 class SubversionRepository(Repository):
     """Concrete implementation of :py:class:`~stash.repository.Repository` for
     Subversion repositories.
     """
 
+    VCS_NAME = 'svn'
+    """Short name of the version control system."""
+
+    MARKER = '.svn'
+    """Directory marking the root of a Subversion working copy (as of
+    Subversion 1.7, older versions have one in every directory).
+    """
+
+    STATE_FILES = ['wc.db']
+    """Database in which Subversion stores the state of the working copy."""
+
+    @staticmethod
+    def _paths(file_names):
+        """Returns the arguments that refer to exactly the files in
+        *file_names*. File names containing an ``@`` need to be terminated by
+        an ``@``, otherwise Subversion interprets the remainder of the name as
+        a peg revision.
+        """
+        return [file_name + '@' if '@' in file_name else file_name for file_name in file_names]
+
     def add(self, file_names):
         """See :py:meth:`~stash.repository.Repository.add`."""
-        self._execute('svn add --parents %s' % (' '.join(file_names)))
+        self._execute_chunked(['svn', 'add', '--parents', '--'], self._paths(file_names))
 
     def commit(self, message):
         """See :py:meth:`~stash.repository.Repository.commit`."""
-        self._execute('svn ci -m "%s" --username anonymous' % message)
+        self._execute(['svn', 'ci', '-m', message, '--username', 'anonymous'])
+
+    def get_changes(self, paths=None):
+        """See :py:meth:`~stash.repository.Repository.get_changes`."""
+        paths = self._get_scan_paths(paths)
+        if paths is None:
+            output = self._execute(['svn', 'stat', '-q'])[1]
+        elif not paths:
+            return []
+        else:
+            output = self._execute_chunked(['svn', 'stat', '-q', '--'], self._paths(paths), stderr=subprocess.DEVNULL)[1]
+
+        # Replaced and conflicted files are considered to be modified.
+        changes = {'M': FileChange.Modified, 'R': FileChange.Modified, 'C': FileChange.Modified,
+                   'A': FileChange.Added, 'D': FileChange.Removed, '!': FileChange.Removed}
+        return sorted((changes[line[0]], line[8:]) for line in output.splitlines() if line[:1] in changes)
 
-    def diff(self):
-        """See :py:meth:`~stash.repository.Repository.diff`."""
-        return self._execute('svn diff --git')[1]
+    def get_revision(self):
+        """See :py:meth:`~stash.repository.Repository.get_revision`."""
+        for line in self._execute(['svn', 'info'])[1].splitlines():
+            if line.startswith('Revision: '):
+                return line[10:].strip()
+        return None
 
     def init(self):
         """See :py:meth:`~stash.repository.Repository.init`."""
-        self._execute('svnadmin create --fs-type fsfs .svn-db')
-        self._execute('svn co file://%s/.svn-db .' % self.root_path)
+        self._execute(['svnadmin', 'create', '--fs-type', 'fsfs', '.svn-db'])
+        self._execute(['svn', 'co', 'file://%s/.svn-db' % self.root_path, '.'])
 
     def remove(self, file_names):
         """See :py:meth:`~stash.repository.Repository.remove`."""
-        self._execute('svn rm %s' % (' '.join(file_names)))
+        self._execute_chunked(['svn', 'rm', '--'], self._paths(file_names))
+
+    def revert(self, file_names):
+        """See :py:meth:`~stash.repository.Repository.revert`."""
+        self._execute_chunked(['svn', 'revert', '-R', '-q', '--'], self._paths(file_names))
 
     def revert_all(self):
         """See :py:meth:`~stash.repository.Repository.revert_all`."""
-        self._execute('svn revert -R -q .')
+        self._execute(['svn', 'revert', '-R', '-q', '.'])
 
-    @classmethod
-    def get_root_path(self, path):
-        """See :py:meth:`~stash.repository.Repository.get_root_path`."""
-        # Look at the directories present in the current working directory. In
-        # case a .svn directory is present, we know we are in the root directory
-        # of a Subversion repository (for Subversion 1.7.x). In case no
-        # repository specific folder is found, and the current directory has a
-        # parent directory, look if a repository specific directory can be found
-        # in the parent directory.
-        while path != '/':
-            if '.svn' in os.listdir(path):
-                return path
-            path = os.path.abspath(os.path.join(path, os.pardir))
-
-        # No Subversion repository found.
-        return None
+    def write_diff(self, patch_file, paths=None):
+        """See :py:meth:`~stash.repository.Repository.write_diff`."""
+        if paths is None and self._watcher is not None:
+            # Subversion refuses to diff unversioned paths, only pass the
+            # changed files. Directories are diffed recursively, so files in
+            # changed directories are left out.
+            changed = set(file_name for _, file_name in self.get_changes())
+            paths = []
+            for file_name in sorted(changed):
+                parent = os.path.dirname(file_name)
+                while parent and parent not in changed:
+                    parent = os.path.dirname(parent)
+                if not parent:
+                    paths.append(file_name)
+        if paths is None:
+            return self._execute(['svn', 'diff', '--git'], stdout=patch_file)[0]
+        if not paths:
+            return 0
+        return self._execute_chunked(['svn', 'diff', '--git', '--'], self._paths(paths), stdout=patch_file)[0]
 
-    def status(self):
+    def status(self, file_names=None):
         """See :py:meth:`~stash.repository.Repository.status`."""
         result = set()
-        for line in self._execute('svn stat')[1].splitlines():
+        file_names = self._get_scan_paths(file_names)
+        if file_names is not None and not file_names:
+            return result
+
+        if file_names is None:
+            output = self._execute(['svn', 'stat'])[1]
+        else:
+            # Subversion warns about each specified file that does not exist,
+            # which is expected for files that are added or removed by a patch.
+            output = self._execute_chunked(['svn', 'stat', '--'], self._paths(file_names), stderr=subprocess.DEVNULL)[1]
+        for line in output.splitlines():
             if line[0] == '?':
                 result.add((FileStatus.Added, line[2:].strip()))
             elif line[0] == '!':
                 result.add((FileStatus.Removed, line[2:].strip()))
         return result
+
+@register_repository
+class GitRepository(Repository):
+    """Concrete implementation of :py:class:`~stash.repository.Repository` for
+    Git repositories. Only plumbing commands are used where possible, since
+    their output does not depend on the configuration of the user. Files are
+    staged by passing their names to a single ``git update-index`` process.
+    """
+
+    VCS_NAME = 'git'
+    """Short name of the version control system."""
+
+    MARKER = '.git'
+    """Directory marking the root of a Git repository, or file in case of a
+    linked working tree.
+    """
+
+    STATE_FILES = ['index']
+    """File in which Git stores the state of the working tree."""
+
+    GIT_COMMAND = ['git', '-c', 'core.quotePath=false', '--literal-pathspecs']
+    """Command prefix of all Git commands. Paths are never interpreted as
+    patterns, and non-ASCII file names are written unquoted.
+    """
+
+    def _git(self, args, stdin=None, stdout=subprocess.PIPE, env=None):
+        """Executes the Git command described by the argument list *args*.
+        Paths are never interpreted as patterns. Returns a tuple containing the
+        return code and the command output.
+        """
+        return self._execute(self.GIT_COMMAND + args, stdin=stdin, stdout=stdout, env=env)
+
+    def _git_paths(self, args, paths, stdout=subprocess.PIPE):
+        """Executes the Git command described by *args* for all *paths*,
+        divided over multiple processes in case they do not fit on a single
+        command-line, see :py:meth:`_git`.
+        """
+        return self._execute_chunked(self.GIT_COMMAND + args + ['--'], paths, stdout=stdout)
+
+    def _git_stdin(self, args, file_names, env=None):
+        """Executes the Git command described by *args*, which reads the
+        *file_names* separated by null characters from its standard input. Any
+        number of files is handled by a single process.
+        """
+        input_file = tempfile.TemporaryFile()
+        try:
+            input_file.write(b''.join(file_name.encode('utf-8', 'surrogateescape') + b'\0' for file_name in file_names))
+            input_file.seek(0)
+            return self._git(args + ['-z', '--stdin'], stdin=input_file, env=env)
+        finally:
+            input_file.close()
+
+    def _refresh(self):
+        """Updates the cached file information in the index, such that files
+        that were touched without being changed are not considered modified by
+        plumbing commands.
+        """
+        self._git(['update-index', '-q', '--refresh'])
+
+    def add(self, file_names):
+        """See :py:meth:`~stash.repository.Repository.add`."""
+        self._git_stdin(['update-index', '--add'], file_names)
+
+    @traced
+    def apply_patch(self, patch_path, fuzz=DEFAULT_FUZZ):
+        """Applies the patch located at *patch_path* using ``git apply
+        --3way``. Files that do not apply cleanly are merged with the blobs the
+        patch is based on, leaving conflict markers in case of conflicts. The
+        merge is done in a temporary index containing the current contents of
+        the touched files, the index itself is not modified. In case Git can
+        not apply the patch at all, for example because the blobs are not
+        available, the patch is applied using
+        :py:meth:`~stash.repository.Repository.apply_patch`, using *fuzz*.
+        """
+        patch_file = open_patch(patch_path)
+        try:
+            file_patches = list(parse_patch(patch_file))
+        finally:
+            patch_file.close()
+        file_names = sorted(set(file_name for file_patch in file_patches for file_name in file_patch.file_names))
+
+        temp_path = tempfile.mkdtemp()
+        try:
+            # Git only applies uncompressed patches, the fallback reads the
+            # patch at *patch_path* itself.
+            plain_patch_path = patch_path
+            if detect_codec(patch_path) != 'none':
+                plain_patch_path = os.path.join(temp_path, 'patch')
+                with open_patch(patch_path) as compressed_file, open(plain_patch_path, 'wb') as plain_file:
+                    shutil.copyfileobj(compressed_file, plain_file, CHUNK_SIZE)
+
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(temp_path, 'index'))
+            self._git(['read-tree', 'HEAD'], env=env)
+            self._git_stdin(['update-index', '--add', '--remove'], file_names, env=env)
+            return_code = self._git(['apply', '--3way', '-q', '--whitespace=nowarn', os.path.abspath(plain_patch_path)],
+                                    env=env)[0]
+            output = self._git(['ls-files', '-u', '-z'], env=env)[1]
+            conflicts = set(entry.split('\t', 1)[1] for entry in output.split('\0') if entry)
+        finally:
+            shutil.rmtree(temp_path)
+
+        if return_code != 0 and not conflicts:
+            return super(GitRepository, self).apply_patch(patch_path, fuzz)
+
+        result = PatchResult()
+        for file_patch in file_patches:
+            file_result = FileResult(file_patch)
+            status = HunkStatus.Conflict if file_patch.file_names & conflicts else HunkStatus.Applied
+            file_result.hunks = [HunkResult(status) for _ in file_patch.hunks]
+            file_result.added = file_patch.new_name is not None and file_patch.new_name != file_patch.old_name
+            file_result.removed = (file_patch.old_name is not None and file_patch.old_name != file_patch.new_name and
+                                   not file_patch.is_copy)
+            result.files.append(file_result)
+        return result
+
+    def commit(self, message):
+        """See :py:meth:`~stash.repository.Repository.commit`."""
+        self._git(['-c', 'user.name=anonymous', '-c', 'user.email=anonymous', '-c', 'commit.gpgsign=false',
+                   'commit', '-q', '--no-verify', '-m', message])
+
+    def get_changes(self, paths=None):
+        """See :py:meth:`~stash.repository.Repository.get_changes`."""
+        paths = self._get_scan_paths(paths)
+        if paths is not None and not paths:
+            return []
+
+        self._refresh()
+        args = ['diff-index', '-z', '--name-status', '--no-renames', 'HEAD']
+        if paths is None:
+            output = self._git(args)[1]
+        else:
+            output = self._git_paths(args, paths)[1]
+
+        # Type changes and unmerged files are considered to be modified.
+        changes = {'M': FileChange.Modified, 'T': FileChange.Modified, 'U': FileChange.Modified,
+                   'A': FileChange.Added, 'D': FileChange.Removed}
+        fields = output.split('\0')
+        return sorted((changes[status], file_name) for status, file_name in zip(fields[0::2], fields[1::2])
+                      if status in changes)
+
+    def get_revision(self):
+        """See :py:meth:`~stash.repository.Repository.get_revision`."""
+        return self._git(['rev-parse', 'HEAD'])[1].strip()
+
+    def init(self):
+        """See :py:meth:`~stash.repository.Repository.init`."""
+        self._git(['init', '-q'])
+
+    def remove(self, file_names):
+        """See :py:meth:`~stash.repository.Repository.remove`."""
+        for file_name in file_names:
+            path = os.path.join(self.root_path, file_name)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.unlink(path)
+        self._git_stdin(['update-index', '--force-remove'], file_names)
+
+    def revert(self, file_names):
+        """See :py:meth:`~stash.repository.Repository.revert`."""
+        # Restore the index entries, which forgets added files, and check out
+        # the files that are tracked afterwards.
+        self._git_paths(['reset', '-q', 'HEAD'], file_names)
+        tracked = self._git_paths(['ls-files', '-z'], file_names)[1].split('\0')[:-1]
+        if tracked:
+            self._git_stdin(['checkout-index', '-f', '-q'], tracked)
+
+    def revert_all(self):
+        """See :py:meth:`~stash.repository.Repository.revert_all`."""
+        self._git(['read-tree', '--reset', '-u', 'HEAD'])
+
+    def write_diff(self, patch_file, paths=None):
+        """See :py:meth:`~stash.repository.Repository.write_diff`. Binary
+        changes are included, together with the full identifiers of the blobs
+        the diff is based on, which allows merging the diff later on.
+        """
+        paths = self._get_scan_paths(paths)
+        if paths is not None and not paths:
+            return 0
+
+        self._refresh()
+        args = ['diff-index', '-p', '--binary', '--full-index', '--no-renames', 'HEAD']
+        if paths is None:
+            return self._git(args, stdout=patch_file)[0]
+        return self._git_paths(args, paths, stdout=patch_file)[0]
+
+    def status(self, file_names=None):
+        """See :py:meth:`~stash.repository.Repository.status`."""
+        result = set()
+        file_names = self._get_scan_paths(file_names)
+        if file_names is not None and not file_names:
+            return result
+
+        args = ['ls-files', '-z', '-t', '--others', '--deleted', '--exclude-standard']
+        if file_names is None:
+            output = self._git(args)[1]
+        else:
+            output = self._git_paths(args, file_names)[1]
+        for entry in output.split('\0'):
+            if entry[:1] == '?':
+                result.add((FileStatus.Added, entry[2:]))
+            elif entry[:1] == 'R':
+                result.add((FileStatus.Removed, entry[2:]))
+        return result
@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+
+def _get_signature(directory):
+    """Returns the inode number and modification time of *directory*."""
+    directory_stat = os.stat(directory)
+    return [directory_stat.st_ino, directory_stat.st_mtime]
+
+def get_signatures(path, root_path):
+    """Returns a list of tuples containing every directory from *path* up to
+    and including *root_path*, together with its signature, or ``None`` in
+    case *root_path* is not a parent of *path* or a directory can not be
+    accessed.
+    """
+    directories = [path]
+    while directories[-1] != root_path:
+        parent = os.path.dirname(directories[-1])
+        if parent == directories[-1]:
+            return None
+        directories.append(parent)
+
+    try:
+        return [(directory, _get_signature(directory)) for directory in directories]
+    except OSError:
+        return None
+
+def signatures_match(signatures):
+    """Returns whether none of the directories in *signatures*, as returned by
+    :py:func:`get_signatures`, changed since their signatures were taken.
+    """
+    try:
+        for directory, signature in signatures:
+            if _get_signature(directory) != list(signature):
+                return False
+    except OSError:
+        return False
+    return True
+
+class RootPathCache(object):
+    """On-disk cache of detected repository root paths, stored as a JSON file.
+
+    Each entry maps a start path to the name of the version control system
+    and the root path of the repository that was found for it, together with
+    the inode number and modification time of every directory from the start
+    path up to and including the root path. Creating or removing a repository
+    marker changes the modification time of the directory it is located in,
+    so an entry is only used as long as none of those directories changed.
+    """
+
+    MAX_ENTRIES = 1000
+    """Maximum number of entries in the cache, in case the cache grows beyond
+    this size, it is emptied.
+    """
+
+    def __init__(self, path):
+        """Opens the cache stored at *path*. A missing or corrupt cache file
+        results in an empty cache.
+        """
+        self.path = path
+        try:
+            with open(path) as cache_file:
+                self._entries = json.load(cache_file)
+            if not isinstance(self._entries, dict):
+                self._entries = {}
+        except (IOError, OSError, ValueError):
+            self._entries = {}
+
+        super(RootPathCache, self).__init__()
+
+    def get(self, key, path):
+        """Returns a tuple containing the name of the version control system
+        and the root path that were cached for the start *path* under *key*,
+        or ``(None, None)`` in case nothing was cached or the cached entry is no
+        longer valid.
+        """
+        entry = self._entries.get('%s:%s' % (key, path))
+        if entry is None:
+            return None, None
+
+        vcs, root_path, signatures = entry
+        if not signatures_match(signatures):
+            return None, None
+        return vcs, root_path
+
+    def set(self, key, path, vcs, root_path):
+        """Caches the root path *root_path* of the repository of type *vcs*
+        found for the start *path* under *key*, and writes the cache to disk.
+        Failing to write the cache is not an error.
+        """
+        signatures = get_signatures(path, root_path)
+        if signatures is None:
+            return
+
+        if len(self._entries) >= self.MAX_ENTRIES:
+            self._entries = {}
+        self._entries['%s:%s' % (key, path)] = [vcs, root_path, signatures]
+
+        # Replace the cache atomically, so concurrent readers never see a
+        # partially written cache.
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.rootcache.')
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, 'w') as cache_file:
+                json.dump(self._entries, cache_file)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            os.unlink(temp_path)
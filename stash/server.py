@@ -0,0 +1,186 @@
+import contextlib
+import io
+import json
+import os
+import socketserver
+import struct
+import sys
+import traceback
+
+from .cli import main
+from .client import connect, read_message, send_message
+from .exception import StashException
+from .repository import Repository
+from .stash import Stash
+
+class _ChannelWriter(io.RawIOBase):
+    """Binary file object that sends everything written to it to the client,
+    as messages on a single channel.
+    """
+
+    def __init__(self, connection, channel):
+        self._connection = connection
+        self._channel = channel
+
+        super(_ChannelWriter, self).__init__()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        send_message(self._connection, self._channel, data)
+        return len(data)
+
+class _ChannelReader(io.RawIOBase):
+    """Binary file object that requests a single line of input from the
+    client for each read.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+        super(_ChannelReader, self).__init__()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # The request only announces the maximum number of bytes, it carries
+        # no data of its own.
+        self._connection.sendall(struct.pack('>cI', b'L', len(buffer)))
+        channel, data = read_message(self._connection)
+        if channel != b'l':
+            raise IOError("unexpected message on channel '%s'" % channel.decode('ascii', 'replace'))
+        data = data[:len(buffer)]
+        buffer[:len(data)] = data
+        return len(data)
+
+class _CommandHandler(socketserver.BaseRequestHandler):
+    """Executes a single stash command sent by :py:func:`stash.client.run`."""
+
+    def handle(self):
+        try:
+            channel, data = read_message(self.request)
+        except EOFError:
+            # Clients checking whether a server is running send no command.
+            return
+        if channel != b'c':
+            return
+        request = json.loads(data.decode('utf-8'))
+
+        stdout = io.TextIOWrapper(io.BufferedWriter(_ChannelWriter(self.request, b'o')), write_through=True)
+        stderr = io.TextIOWrapper(io.BufferedWriter(_ChannelWriter(self.request, b'e')), write_through=True)
+        stdin = io.TextIOWrapper(io.BufferedReader(_ChannelReader(self.request)))
+        try:
+            return_code = self.server.execute(request['argv'], request['cwd'], stdin, stdout, stderr)
+        finally:
+            stdout.flush()
+            stderr.flush()
+        send_message(self.request, b'r', struct.pack('>i', return_code))
+
+class StashServer(socketserver.UnixStreamServer):
+    """Long running process that executes stash commands on behalf of
+    :py:func:`stash.client.run`, over the Unix socket located at
+    *socket_path*. Since the server keeps the repositories it has seen, a
+    command executed by the server does not pay for starting Python, importing
+    stash, detecting the repository, or starting a Mercurial command server.
+    The working copies of those repositories are watched for changes, see
+    :py:meth:`~stash.repository.Repository.watch`.
+
+    Commands are executed one at a time, in the working directory of the
+    client. The server uses its own environment, for example to determine the
+    default codec.
+    """
+
+    def __init__(self, socket_path):
+        """Starts listening on *socket_path*. In case the socket is located in
+        a directory that does not yet exist, the directory is created only
+        accessible by the current user.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case another
+            server is already listening on *socket_path*.
+        """
+        directory = os.path.dirname(socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+        self.socket_path = socket_path
+        self._stashes = {}
+
+        # Remove the socket of a server that has not been shut down properly.
+        if os.path.exists(socket_path):
+            connection = connect(socket_path)
+            if connection is not None:
+                connection.close()
+                raise StashException("a stash server is already listening on '%s'" % socket_path)
+            os.unlink(socket_path)
+
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _CommandHandler)
+        finally:
+            os.umask(umask)
+
+    def get_stash(self, path):
+        """Returns the :py:class:`~stash.stash.Stash` for the repository *path*
+        is part of, reusing the stash created for an earlier command in the
+        same repository.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case no
+            repository is found at *path*.
+        """
+        repository = Repository(path)
+        root_path = os.path.abspath(repository.root_path)
+
+        # A repository that was removed and created again is a new repository.
+        marker_stat = os.stat(os.path.join(root_path, repository.MARKER))
+        key = (marker_stat.st_dev, marker_stat.st_ino)
+        cached_key, stash = self._stashes.get(root_path, (None, None))
+        if cached_key != key:
+            if stash is not None:
+                stash.repository.close()
+            stash = Stash(root_path)
+            stash.repository.watch()
+            self._stashes[root_path] = (key, stash)
+        return stash
+
+    def execute(self, argv, cwd, stdin, stdout, stderr):
+        """Executes the stash command described by *argv* in the working
+        directory *cwd*, using the text file objects *stdin*, *stdout* and
+        *stderr*. Returns the exit status of the command.
+        """
+        original_cwd = os.getcwd()
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                original_stdin, sys.stdin = sys.stdin, stdin
+                try:
+                    main(argv, self.get_stash)
+                finally:
+                    sys.stdin = original_stdin
+            return 0
+        except SystemExit as e:
+            # Raised by the argument parser, for example when asking for help.
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            stderr.write('%s\n' % e.code)
+            return 1
+        except Exception:
+            stderr.write(traceback.format_exc())
+            return 1
+        finally:
+            os.chdir(original_cwd)
+
+    def server_close(self):
+        """Stops listening, and releases all resources held by the
+        repositories of the server.
+        """
+        socketserver.UnixStreamServer.server_close(self)
+        for _, stash in self._stashes.values():
+            stash.repository.close()
+        self._stashes.clear()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
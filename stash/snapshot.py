@@ -0,0 +1,248 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+
+from .exception import StashException
+from .patch import FilePatch, FileResult, PatchResult, match_paths
+from .repository import FileChange
+
+FICLONE = 0x40049409
+"""Linux ``ioctl`` request that makes a file share the data of another file
+(a reflink), on file systems supporting copy-on-write.
+"""
+
+_CHANGE_CODES = {FileChange.Modified: 'M', FileChange.Added: 'A', FileChange.Removed: 'R'}
+"""Codes used for each kind of change in the manifest of a snapshot."""
+
+def is_snapshot(path):
+    """Returns whether the stashed entry at *path* is a snapshot rather than a
+    patch.
+    """
+    return os.path.isdir(path)
+
+def copy_file(source, target):
+    """Copies the file *source* to *target*, including its mode. The copy is
+    made as cheaply as the file system allows: by sharing the data of the
+    files (a reflink), by copying the data within the kernel, or by copying
+    the data the conventional way.
+    """
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        return
+
+    with open(source, 'rb') as source_file:
+        with open(target, 'wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            except (IOError, OSError):
+                size = os.fstat(source_file.fileno()).st_size
+                try:
+                    copied = 0
+                    while copied < size:
+                        count = os.copy_file_range(source_file.fileno(), target_file.fileno(), size - copied)
+                        if count == 0:
+                            break
+                        copied += count
+                except (AttributeError, OSError):
+                    # Not supported by the platform or between these file
+                    # systems, start over using a regular copy.
+                    source_file.seek(0)
+                    target_file.seek(0)
+                    target_file.truncate()
+                    shutil.copyfileobj(source_file, target_file)
+    shutil.copymode(source, target)
+
+def move_file(source, target):
+    """Moves the file *source* to *target*, creating the directory of
+    *target* when needed. The file is renamed in case both are located on the
+    same file system, and copied otherwise.
+    """
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    try:
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(source, target)
+        os.unlink(source)
+
+class Snapshot(object):
+    """A stashed set of changes that is stored as the contents of all modified
+    and added files, instead of as a patch. Restoring a snapshot moves the
+    files back into the working copy, which is fast and exact for large and
+    binary files, but requires the working copy to be at the revision the
+    snapshot was created at.
+
+    A snapshot is stored as a directory in the stash, containing a manifest
+    and a copy of each modified and added file.
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+    """Name of the manifest in the snapshot directory, describing the
+    snapshot.
+    """
+
+    FILES_DIRECTORY = 'files'
+    """Name of the directory in the snapshot directory containing the
+    files.
+    """
+
+    def __init__(self, path):
+        """Opens the snapshot stored at *path*.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case *path* does
+            not contain a valid snapshot.
+        """
+        self.path = path
+        try:
+            with open(os.path.join(path, self.MANIFEST_NAME)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            raise StashException("snapshot '%s' is corrupt" % os.path.basename(path))
+
+        self.revision = manifest.get('revision')
+        """Revision of the repository the snapshot was created against."""
+
+        codes = dict((code, change) for change, code in _CHANGE_CODES.items())
+        self.changes = [(codes[code], file_name) for code, file_name in manifest['changes']]
+        """Sorted list of tuples containing the
+        :py:class:`~stash.repository.FileChange` and the name of each changed
+        file.
+        """
+
+        super(Snapshot, self).__init__()
+
+    @property
+    def file_names(self):
+        """Sorted list of all files changed by the snapshot."""
+        return sorted(file_name for _, file_name in self.changes)
+
+    def _get_file_path(self, file_name):
+        """Returns the path of the copy of *file_name* in the snapshot."""
+        return os.path.join(self.path, self.FILES_DIRECTORY, file_name)
+
+    @classmethod
+    def create(cls, path, repository, paths=None):
+        """Creates a snapshot at *path* of the changes in *repository*, or only
+        the changes to the files and directories in *paths* in case it is
+        given, and reverts those changes. Modified and added files are moved
+        into the snapshot. Returns the new :py:class:`Snapshot`, or ``None``
+        in case there are no changes.
+        """
+        changes = [(change, file_name) for change, file_name in repository.get_changes(paths)
+                   if change == FileChange.Removed or not os.path.isdir(os.path.join(repository.root_path, file_name))]
+        if not changes:
+            return None
+
+        os.mkdir(path)
+        moved = []
+        try:
+            with open(os.path.join(path, cls.MANIFEST_NAME), 'w') as manifest_file:
+                json.dump({
+                    'revision': repository.get_revision(),
+                    'changes': [(_CHANGE_CODES[change], file_name) for change, file_name in changes],
+                }, manifest_file, indent=1)
+
+            for change, file_name in changes:
+                if change != FileChange.Removed:
+                    move_file(os.path.join(repository.root_path, file_name), os.path.join(path, cls.FILES_DIRECTORY, file_name))
+                    moved.append(file_name)
+
+            # Files that were moved are missing now, reverting restores
+            # modified files and forgets added files.
+            repository.revert([file_name for _, file_name in changes])
+        except:
+            # Put back the files that were already moved.
+            for file_name in moved:
+                move_file(os.path.join(path, cls.FILES_DIRECTORY, file_name), os.path.join(repository.root_path, file_name))
+            shutil.rmtree(path)
+            raise
+
+        return cls(path)
+
+    def _get_local_changes(self, repository):
+        """Returns a sorted list of all files in the snapshot that have local
+        changes in *repository*, which would be overwritten when restoring the
+        snapshot.
+        """
+        changed = [file_name for _, file_name in repository.get_changes(self.file_names)]
+        untracked = [file_name for change, file_name in self.changes
+                     if change == FileChange.Added and os.path.lexists(os.path.join(repository.root_path, file_name))]
+        return sorted(set(changed + untracked))
+
+    def check(self, repository):
+        """Determines whether the snapshot can be restored into *repository*,
+        without modifying it. Returns a :py:class:`~stash.patch.PatchResult`
+        containing a :py:class:`~stash.patch.FileResult` for each file, in
+        which files that can not be restored have an error.
+        """
+        revision = repository.get_revision()
+        local_changes = set(self._get_local_changes(repository))
+
+        result = PatchResult()
+        for change, file_name in self.changes:
+            file_patch = FilePatch()
+            file_patch.old_name = file_name if change != FileChange.Added else None
+            file_patch.new_name = file_name if change != FileChange.Removed else None
+            file_result = FileResult(file_patch)
+            if self.revision != revision:
+                file_result.error = "snapshot was created at revision %s" % self.revision
+            elif file_name in local_changes:
+                file_result.error = "file '%s' has local changes" % file_name
+            file_result.added = change == FileChange.Added
+            file_result.removed = change == FileChange.Removed
+            result.files.append(file_result)
+        return result
+
+    def restore(self, repository):
+        """Restores the changes in the snapshot into *repository*, by moving
+        all files back into the working copy and adding and removing files.
+        The snapshot is left empty afterwards.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case the working
+            copy is not at the revision the snapshot was created at, or in case
+            any of the files in the snapshot has local changes.
+        """
+        revision = repository.get_revision()
+        if self.revision != revision:
+            raise StashException("snapshot '%s' was created at revision %s, while the working copy is at revision %s"
+                                 % (os.path.basename(self.path), self.revision, revision))
+
+        local_changes = self._get_local_changes(repository)
+        if local_changes:
+            raise StashException("unable to restore snapshot '%s', files have local changes: %s"
+                                 % (os.path.basename(self.path), ', '.join(local_changes)))
+
+        moved = []
+        try:
+            for change, file_name in self.changes:
+                if change != FileChange.Removed:
+                    move_file(self._get_file_path(file_name), os.path.join(repository.root_path, file_name))
+                    moved.append(file_name)
+        except:
+            for file_name in moved:
+                move_file(os.path.join(repository.root_path, file_name), self._get_file_path(file_name))
+            repository.revert(moved)
+            raise
+
+        added = [file_name for change, file_name in self.changes if change == FileChange.Added]
+        removed = [file_name for change, file_name in self.changes if change == FileChange.Removed]
+        if added:
+            repository.add(added)
+        if removed:
+            repository.remove(removed)
+
+    def write_summary(self, output, paths=None):
+        """Writes a line for each changed file to the binary file object
+        *output*, containing a code for the kind of change (``M``, ``A`` or
+        ``R``) and the file name. In case a list of *paths* is given, only
+        files equal to or located in one of those paths are listed.
+        """
+        for change, file_name in self.changes:
+            if paths is None or match_paths([file_name], paths):
+                output.write(('%s %s\n' % (_CHANGE_CODES[change], file_name)).encode('utf-8', 'surrogateescape'))
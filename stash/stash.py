@@ -1,8 +1,42 @@
+import contextlib
+import fnmatch
+import io
+import mmap
 import os
-import subprocess
+import re
+import shutil
+import tempfile
 
-from exception import StashException
-from repository import Repository, FileStatus
+from concurrent.futures import ProcessPoolExecutor
+
+from .compression import CHUNK_SIZE, detect_codec, get_codecs, open_patch, recompress
+from .exception import StashException
+from .index import PatchIndex
+from .patch import DEFAULT_FUZZ, apply_patch, get_file_names, get_process_context, match_paths, parse_patch
+from .repository import Repository, FileStatus
+from .snapshot import Snapshot, copy_file, is_snapshot, move_file
+from .store import check_namespace, create_store, is_patch_name
+from .trace import traced
+
+MMAP_CHUNK_SIZE = 1 << 20
+"""Number of bytes of a memory mapped patch that are written at once."""
+
+def _check_patch(patch_path, root_path):
+    """Determines whether the patch located at *patch_path* applies to the
+    files in *root_path*, without modifying them. Used by worker processes of
+    :py:meth:`Stash.check_patches`.
+    """
+    return apply_patch(patch_path, root_path, DEFAULT_FUZZ, dry_run=True)
+
+class PatchState(object):
+    """Enumeration of the states of a stashed patch relative to the working
+    copy, as determined by :py:meth:`Stash.get_patch_states`. A patch either
+    applies exactly, as all files it touches are unchanged since it was
+    created, needs to be merged, as some of those files changed, or its base is
+    missing, as the original contents of the files were not recorded or belong
+    to another repository.
+    """
+    AppliesExactly, NeedsMerge, BaseMissing = range(3)
 
 class Stash(object):
     """This class manages the collection of patches that have been stashed from
@@ -13,6 +47,44 @@ class Stash(object):
 
     STASH_PATH = os.path.expanduser('~/.stash')
 
+    STORE_URL = os.environ.get('STASH_STORE_URL') or None
+    """URL of a patch store shared with other machines, see
+    :py:func:`~stash.store.create_store`, or ``None`` to store patches in
+    :py:attr:`STASH_PATH` only. In case it is set, :py:attr:`STASH_PATH` is
+    used as a local cache. Can be set using the environment variable
+    ``STASH_STORE_URL``.
+    """
+
+    CODEC = os.environ.get('STASH_CODEC', 'none')
+    """Codec that is used to store new patches, see
+    :py:func:`~stash.compression.get_codecs`. Can be set using the environment
+    variable ``STASH_CODEC``.
+    """
+
+    FORMATS = ('patch', 'snapshot')
+    """Formats changes can be stashed in. Patches can be applied on top of
+    other revisions, while snapshots store the changed files themselves, see
+    :py:class:`~stash.snapshot.Snapshot`.
+    """
+
+    FORMAT = os.environ.get('STASH_FORMAT', 'patch')
+    """Format that is used to stash new changes, one of :py:attr:`FORMATS`.
+    Can be set using the environment variable ``STASH_FORMAT``.
+    """
+
+    LOCK_FREE_READS = os.environ.get('STASH_LOCK_FREE_READS', '0') not in ('', '0')
+    """Whether patches are read without waiting for processes modifying them.
+    Since patches are replaced atomically, a reader never sees a partially
+    written patch, but it may see a patch that is being applied or removed.
+    Can be enabled by setting the environment variable
+    ``STASH_LOCK_FREE_READS`` to ``1``.
+    """
+
+    CHECK_PROCESSES = os.cpu_count() or 1
+    """Number of processes used to check whether patches apply, see
+    :py:meth:`check_patches`.
+    """
+
     def __init__(self, path):
         """To instantiantate a stash, provide a path that points to a location
         somewhere in a repository.
@@ -26,37 +98,369 @@ class Stash(object):
         super(Stash, self).__init__()
 
     @classmethod
-    def _get_patch_path(cls, patch_name):
-        """Returns the absolute path for patch *patch_name*."""
-        return os.path.join(cls.STASH_PATH, patch_name) if patch_name else None
+    def _get_store(cls):
+        """Returns the :py:class:`~stash.store.PatchStore` of the stash."""
+        return create_store(cls.STORE_URL, cls.STASH_PATH)
+
+    @classmethod
+    def _lock_for_reading(cls, patch_name):
+        """Returns a context manager holding a shared lock on patch
+        *patch_name*, unless :py:attr:`LOCK_FREE_READS` is set.
+        """
+        if cls.LOCK_FREE_READS:
+            return contextlib.nullcontext()
+        return cls._get_store().lock([patch_name], shared=True)
+
+    @classmethod
+    def _get_index(cls):
+        """Returns the :py:class:`~stash.index.PatchIndex` of the stash."""
+        # The store creates the stash directory in case it does not exist yet.
+        store = cls._get_store()
+        return PatchIndex(store.path, store.get_path, store.fetch)
+
+    @classmethod
+    def get_patches(cls, namespace=None):
+        """Returns the names of all stashed patches, or only those in
+        *namespace* and the namespaces nested in it.
+        """
+        return cls._get_store().get_patches(namespace)
+
+    @classmethod
+    def has_patch(cls, patch_name):
+        """Returns whether patch *patch_name* exists, without listing the
+        stash.
+        """
+        return cls._get_store().exists(patch_name)
 
     @classmethod
-    def get_patches(cls):
-        """Returns the names of all stashed patches."""
-        return sorted(os.listdir(cls.STASH_PATH))
+    @traced
+    def find_patches(cls, repository=None, since=None, touches=None, sort='name', namespace=None):
+        """Returns a list of :py:class:`~stash.index.PatchInfo` instances
+        describing all stashed patches, optionally filtered on the root path of
+        the *repository* they were created in, their creation time (*since*, in
+        seconds since the epoch), a file or directory they touch (*touches*),
+        and the *namespace* they are part of. The list is sorted on *sort*,
+        which is one of :py:attr:`~stash.index.PatchIndex.SORT_KEYS`. Only the
+        patch index is consulted, patches themselves are read only in case
+        they were not indexed yet.
+        """
+        namespace = check_namespace(namespace)
+        index = cls._get_index()
+        try:
+            index.synchronize(cls.get_patches(namespace), namespace)
+            return index.find(repository, since, touches, sort, namespace)
+        finally:
+            index.close()
 
     @classmethod
+    @traced
+    def recompress(cls, codec):
+        """Stores all patches in the stash again using *codec*. Returns the
+        names of all patches that were recompressed.
+        """
+        if codec not in get_codecs():
+            raise StashException("unsupported codec '%s'" % codec)
+
+        # Snapshots are not compressed. Patches are replaced atomically, the
+        # lock prevents patches from being modified while being recompressed.
+        store = cls._get_store()
+        with store.lock():
+            patch_names = [patch_name for patch_name in store.get_patches()
+                           if not is_snapshot(store.fetch(patch_name)) and recompress(store.get_path(patch_name), codec)]
+            for patch_name in patch_names:
+                store.push(patch_name, overwrite=True)
+
+        # The index records the size and codec of each patch.
+        index = cls._get_index()
+        try:
+            index.synchronize(cls.get_patches())
+        finally:
+            index.close()
+
+        return patch_names
+
+    @classmethod
+    @traced
+    def rebuild_index(cls):
+        """Regenerates the patch index from all patches in the stash."""
+        with cls._get_store().lock():
+            index = cls._get_index()
+            try:
+                index.rebuild(cls.get_patches())
+            finally:
+                index.close()
+
+    @classmethod
+    @traced
     def remove_patch(cls, patch_name):
         """Removes patch *patch_name* from the stash (in case it exists).
 
         :raises: :py:exc:`~stash.exception.StashException` in case *patch_name* does not exist.
         """
+        store = cls._get_store()
+        with store.lock([patch_name]):
+            cls._remove_patch(store, patch_name)
+
+    @classmethod
+    def _remove_patch(cls, store, patch_name):
+        """Removes patch *patch_name* from *store* and from the index, while
+        the lock on the patch is held, see :py:meth:`remove_patch`.
+        """
+        store.remove(patch_name)
+
+        index = cls._get_index()
         try:
-            os.unlink(cls._get_patch_path(patch_name))
-        except:
-            raise StashException("patch '%s' does not exist" % patch_name)
+            index.remove(patch_name)
+        finally:
+            index.close()
 
     @classmethod
+    @traced
     def get_patch(cls, patch_name):
         """Returns the contents of the specified patch *patch_name*.
 
         :raises: :py:exc:`~stash.exception.StashException` in case *patch_name* does not exist.
         """
+        output = io.BytesIO()
+        cls.write_patch(patch_name, output)
+        return output.getvalue().decode('utf-8', 'replace')
+
+    @classmethod
+    @traced
+    def write_patch(cls, patch_name, output, paths=None):
+        """Writes the contents of patch *patch_name* to the binary file object
+        *output*. The patch is streamed, it is never held in memory as a whole.
+        In case a list of *paths* is given, only the changes to files equal to
+        or located in one of those paths are written. For snapshots, the
+        changed files are listed instead.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case *patch_name* does not exist.
+        """
+        with cls._lock_for_reading(patch_name):
+            patch_path = cls._get_store().fetch(patch_name)
+            if is_snapshot(patch_path):
+                Snapshot(patch_path).write_summary(output, paths)
+                return
+
+            try:
+                codec = detect_codec(patch_path)
+            except:
+                raise StashException("patch '%s' does not exist" % patch_name)
+
+            if paths is None and codec == 'none':
+                # Let the operating system page in the patch directly.
+                with open(patch_path, 'rb') as patch_file:
+                    if os.fstat(patch_file.fileno()).st_size > 0:
+                        patch_map = mmap.mmap(patch_file.fileno(), 0, access=mmap.ACCESS_READ)
+                        try:
+                            view = memoryview(patch_map)
+                            for offset in range(0, len(patch_map), MMAP_CHUNK_SIZE):
+                                output.write(view[offset:offset + MMAP_CHUNK_SIZE])
+                            view.release()
+                        finally:
+                            patch_map.close()
+                return
+
+            with open_patch(patch_path) as patch_file:
+                if paths is None:
+                    shutil.copyfileobj(patch_file, output, CHUNK_SIZE)
+                else:
+                    for file_patch in parse_patch(patch_file, raw=True):
+                        if match_paths(file_patch.file_names, paths):
+                            output.writelines(file_patch.raw_lines)
+
+    @classmethod
+    @traced
+    def get_patch_stat(cls, patch_name, paths=None):
+        """Returns a summary of the changes in patch *patch_name*, in the form
+        of a list containing a tuple for each file in the patch. Each tuple
+        contains the file name, the number of added lines, the number of
+        removed lines, and whether the change is binary. The summary is
+        determined in a single pass over the patch. In case a list of *paths* is
+        given, only files equal to or located in one of those paths are taken
+        into account.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case *patch_name*
+            does not exist, or in case it is a snapshot.
+        """
+        with cls._lock_for_reading(patch_name):
+            patch_path = cls._get_store().fetch(patch_name)
+            if is_snapshot(patch_path):
+                raise StashException("'%s' is a snapshot, it contains no line changes" % patch_name)
+
+            try:
+                patch_file = open_patch(patch_path)
+            except:
+                raise StashException("patch '%s' does not exist" % patch_name)
+
+            stat = []
+            try:
+                for file_patch in parse_patch(patch_file):
+                    if paths is not None and not match_paths(file_patch.file_names, paths):
+                        continue
+
+                    added, removed = 0, 0
+                    for hunk in file_patch.hunks:
+                        for tag, _ in hunk.lines:
+                            if tag == b'+':
+                                added += 1
+                            elif tag == b'-':
+                                removed += 1
+
+                    file_name = file_patch.new_name or file_patch.old_name
+                    if file_patch.old_name and file_patch.new_name and file_patch.old_name != file_patch.new_name:
+                        file_name = '%s => %s' % (file_patch.old_name, file_patch.new_name)
+                    stat.append((file_name, added, removed, file_patch.binary is not None))
+            finally:
+                patch_file.close()
+
+            return stat
+
+    @classmethod
+    @traced
+    def grep_patches(cls, pattern, file_pattern=None, namespace=None):
+        """Searches the changes in all stashed patches, or in the patches in
+        *namespace*, for the regular expression *pattern*. Returns a list of
+        tuples containing the patch name, the file name, and the
+        :py:class:`~stash.patch.Hunk` for each hunk that adds or removes a line
+        matching *pattern*, in a file matching the glob pattern
+        *file_pattern*. The patch index narrows the search down to the patches
+        containing the words of *pattern*, only those patches are read.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case *pattern*
+            is not a valid regular expression.
+        """
         try:
-            return open(cls._get_patch_path(patch_name), 'r').read()
-        except:
-            raise StashException("patch '%s' does not exist" % patch_name)
+            regex = re.compile(pattern)
+        except re.error as e:
+            raise StashException("invalid pattern '%s': %s" % (pattern, e))
+
+        namespace = check_namespace(namespace)
+        index = cls._get_index()
+        try:
+            index.synchronize(cls.get_patches(namespace), namespace)
+            patch_names = index.search(pattern, file_pattern, namespace)
+        finally:
+            index.close()
+
+        matches = []
+        store = cls._get_store()
+        for patch_name in patch_names:
+            with cls._lock_for_reading(patch_name):
+                try:
+                    patch_file = open_patch(store.fetch(patch_name))
+                except StashException:
+                    # The patch was removed meanwhile.
+                    continue
+
+                with patch_file:
+                    for file_patch in parse_patch(patch_file):
+                        file_name = file_patch.new_name or file_patch.old_name
+                        if file_pattern and not any(fnmatch.fnmatchcase(name, file_pattern) for name in file_patch.file_names):
+                            continue
+                        for hunk in file_patch.hunks:
+                            if any(tag != b' ' and regex.search(contents.decode('utf-8', 'surrogateescape')) for tag, contents in hunk.lines):
+                                matches.append((patch_name, file_name, hunk))
+        return matches
+
+    @traced
+    def get_patch_states(self, patch_names=None):
+        """Determines for each patch in *patch_names*, or for all patches in the
+        stash in case it is not given, its :py:class:`PatchState` relative to
+        the working copy. Neither the patches nor the version control system
+        are consulted, the hashes of the files touched by each patch are
+        compared with the hashes recorded when the patch was created. Returns
+        a list of tuples containing the patch name and its state, in the order
+        of *patch_names*.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case one of the
+            *patch_names* does not exist.
+        """
+        # Only the given patches are looked up, the stash is listed in case
+        # all patches are requested.
+        store = self._get_store()
+        if patch_names is not None:
+            for patch_name in patch_names:
+                store.fetch(patch_name)
 
+        root_path = os.path.abspath(self.repository.root_path)
+        states = []
+        index = self._get_index()
+        try:
+            if patch_names is None:
+                patch_names = store.get_patches()
+                index.synchronize(patch_names)
+            else:
+                index.update(patch_names)
+            for patch_name in patch_names:
+                patch_info = index.get_patch_info(patch_name)
+                preimages = index.get_preimages(patch_name)
+                if preimages is None or patch_info.repository != root_path:
+                    states.append((patch_name, PatchState.BaseMissing))
+                    continue
+
+                file_names = sorted(preimages)
+                hashes = index.hash_files([os.path.join(root_path, file_name) for file_name in file_names])
+                if all(preimages[file_name] == digest for file_name, digest in zip(file_names, hashes)):
+                    states.append((patch_name, PatchState.AppliesExactly))
+                else:
+                    states.append((patch_name, PatchState.NeedsMerge))
+        finally:
+            index.close()
+        return states
+
+    def _get_preimages(self, index, file_names):
+        """Returns a dictionary mapping each of the *file_names* to the hash of
+        its current contents in the working copy, as recorded in *index* to
+        detect whether a patch still applies exactly.
+        """
+        if file_names is None:
+            return None
+        root_path = self.repository.root_path
+        return dict(zip(file_names, index.hash_files([os.path.join(root_path, file_name) for file_name in file_names])))
+
+    @traced
+    def check_patches(self, patch_names=None):
+        """Determines for each patch in *patch_names*, or for all patches in the
+        stash in case it is not given, whether it applies to the working copy,
+        without modifying it. Hunks are tested against the current files in
+        memory. Returns a list of tuples containing the patch name and a
+        :py:class:`~stash.patch.PatchResult`, in the order of *patch_names*.
+
+        In case multiple patches are checked, the patches are checked in
+        parallel by a pool of :py:attr:`CHECK_PROCESSES` processes.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case one of the
+            *patch_names* does not exist.
+        """
+        store = self._get_store()
+        if patch_names is None:
+            patch_names = store.get_patches()
+
+        results = {}
+
+        # Snapshots are checked by querying the repository.
+        patch_paths = []
+        for patch_name in patch_names:
+            patch_path = store.fetch(patch_name)
+            if is_snapshot(patch_path):
+                results[patch_name] = Snapshot(patch_path).check(self.repository)
+            else:
+                patch_paths.append((patch_name, patch_path))
+
+        if len(patch_paths) > 1 and self.CHECK_PROCESSES > 1:
+            with ProcessPoolExecutor(max_workers=self.CHECK_PROCESSES, mp_context=get_process_context()) as executor:
+                futures = [(patch_name, executor.submit(_check_patch, patch_path, self.repository.root_path))
+                           for patch_name, patch_path in patch_paths]
+                for patch_name, future in futures:
+                    results[patch_name] = future.result()
+        else:
+            for patch_name, patch_path in patch_paths:
+                results[patch_name] = self.repository.check_patch(patch_path)
+
+        return [(patch_name, results[patch_name]) for patch_name in patch_names]
+
+    @traced
     def apply_patch(self, patch_name):
         """Applies the patch *patch_name* on to the current working directory in
         case the patch exists. In case applying the patch was successful, the
@@ -65,64 +469,260 @@ class Stash(object):
 
         :raises: :py:exc:`~stash.exception.StashException` in case *patch_name* does not exist.
         """
-        if patch_name in self.get_patches():
-            patch_path = self._get_patch_path(patch_name)
+        # The lock makes sure a patch is applied and removed by one process
+        # only.
+        store = self._get_store()
+        with store.lock([patch_name]):
+            patch_path = store.fetch(patch_name)
 
-            # Apply the patch, and determine the files that have been added and
-            # removed.
-            pre_file_status = self.repository.status()
-            patch_return_code = self.repository.apply_patch(patch_path)
-            changed_file_status = self.repository.status().difference(pre_file_status)
+            if is_snapshot(patch_path):
+                # Snapshots are either restored completely, or not at all.
+                Snapshot(patch_path).restore(self.repository)
+                self._remove_patch(store, patch_name)
+                return True
 
-            # Determine all files that have been added.
-            for status, file_name in changed_file_status:
-                if status == FileStatus.Added:
-                    self.repository.add([file_name])
-                elif status == FileStatus.Removed:
-                    self.repository.remove([file_name])
+            # Apply the patch, and add and remove all files that have been
+            # added and removed by the patch, each in a single batch.
+            result = self.repository.apply_patch(patch_path)
+            if result.added_file_names:
+                self.repository.add(result.added_file_names)
+            if result.removed_file_names:
+                self.repository.remove(result.removed_file_names)
 
-            if patch_return_code == 0:
+            if result.succeeded:
                 # Applying the patch succeeded, remove stashed patch.
-                os.unlink(patch_path)
+                self._remove_patch(store, patch_name)
 
-            return patch_return_code == 0
-        else:
-            raise StashException("patch '%s' does not exist" % patch_name)
+            return result.succeeded
+
+    @traced
+    def apply_patches(self, patch_names):
+        """Applies the series of patches *patch_names* in order on to the
+        current working directory, as a single operation. The status of the
+        touched files is determined once before and once after applying the
+        series, and all files added and removed by the series are added and
+        removed in a single batch each. In case all patches applied cleanly,
+        they are removed from the stash, and ``None`` is returned.
+
+        In case a patch does not apply cleanly, the series is stopped, all
+        touched files are restored to their state before the series, and the
+        name of that patch is returned. The stash is left unchanged.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case one of the
+            *patch_names* does not exist, is a snapshot, or touches files that
+            can not be determined.
+        """
+        # The patches of the series can not be applied or removed by other
+        # processes meanwhile.
+        store = self._get_store()
+        with store.lock(patch_names):
+            return self._apply_patches(store, patch_names)
+
+    def _apply_patches(self, store, patch_names):
+        """Applies the series of patches *patch_names*, while the locks on the
+        patches in *store* are held, see :py:meth:`apply_patches`.
+        """
+        file_names = set()
+        for patch_name in patch_names:
+            patch_path = store.fetch(patch_name)
+            if is_snapshot(patch_path):
+                raise StashException("snapshot '%s' can not be applied as part of a series" % patch_name)
+            # Without the touched files, the series could not be rolled back.
+            patch_file_names = get_file_names(patch_path)
+            if patch_file_names is None:
+                raise StashException("the files touched by patch '%s' can not be determined, "
+                                     "it can not be applied as part of a series" % patch_name)
+            file_names.update(patch_file_names)
+        file_names = sorted(file_names)
+
+        pre_file_status = self.repository.status(file_names)
+
+        # Keep a copy of all touched files, such that the series can be rolled
+        # back. Hidden directories in the stash are not considered patches.
+        backup_path = tempfile.mkdtemp(dir=self.STASH_PATH, prefix='.apply.')
+        try:
+            existed = []
+            for file_name in file_names:
+                path = os.path.join(self.repository.root_path, file_name)
+                if os.path.lexists(path):
+                    backup_file_path = os.path.join(backup_path, file_name)
+                    if not os.path.isdir(os.path.dirname(backup_file_path)):
+                        os.makedirs(os.path.dirname(backup_file_path))
+                    copy_file(path, backup_file_path)
+                    existed.append(file_name)
 
-    def create_patch(self, patch_name):
+            def roll_back():
+                # Remove all touched files, and put back the original ones.
+                for file_name in file_names:
+                    path = os.path.join(self.repository.root_path, file_name)
+                    if os.path.lexists(path):
+                        os.unlink(path)
+                for file_name in existed:
+                    move_file(os.path.join(backup_path, file_name), os.path.join(self.repository.root_path, file_name))
+
+            failed_patch_name = None
+            try:
+                for patch_name in patch_names:
+                    if not self.repository.apply_patch(store.get_path(patch_name)).succeeded:
+                        failed_patch_name = patch_name
+                        roll_back()
+                        break
+            except:
+                roll_back()
+                raise
+        finally:
+            shutil.rmtree(backup_path)
+
+        if failed_patch_name is not None:
+            return failed_patch_name
+
+        # Add and remove all files that have been added and removed by the
+        # series, each in a single batch.
+        changed_file_status = self.repository.status(file_names).difference(pre_file_status)
+        added = sorted(file_name for status, file_name in changed_file_status if status == FileStatus.Added)
+        removed = sorted(file_name for status, file_name in changed_file_status if status == FileStatus.Removed)
+        if added:
+            self.repository.add(added)
+        if removed:
+            self.repository.remove(removed)
+
+        for patch_name in patch_names:
+            self._remove_patch(store, patch_name)
+        return None
+
+    def _create_snapshot(self, store, patch_name, paths, overwrite):
+        """Stashes the changes to *paths* as snapshot *patch_name* in *store*,
+        while the lock on the patch is held, see :py:meth:`create_patch`.
+        """
+        temp_path = store.create_temp_path()
+        snapshot = Snapshot.create(temp_path, self.repository, paths)
+        if snapshot is None:
+            store.discard(temp_path)
+            return False
+
+        try:
+            store.publish(temp_path, patch_name, overwrite)
+        except:
+            # The changes were moved into the snapshot, put them back.
+            snapshot.restore(self.repository)
+            store.discard(temp_path)
+            raise
+
+        index = self._get_index()
+        try:
+            index.add(patch_name, os.path.abspath(self.repository.root_path), self.repository.VCS_NAME, snapshot.revision,
+                      snapshot.file_names, self._get_preimages(index, snapshot.file_names))
+        finally:
+            index.close()
+
+        return True
+
+    @traced
+    def create_patch(self, patch_name, paths=None, overwrite=False):
         """Creates a patch based on the changes in the current repository. In
-        case the specified patch *patch_name* already exists, ask the user to
-        overwrite the patch. In case creating the patch was successful, all
-        changes in the current repository are reverted. Returns ``True`` in case
-        a patch was created, and ``False`` otherwise.
-
-        :raises: :py:exc:`~stash.exception.StashException` in case *patch_name* already exists.
-        """
-        # Raise an exception in case the specified patch already exists.
-        patch_path = self._get_patch_path(patch_name)
-        if os.path.exists(patch_path):
-            raise StashException("patch '%s' already exists" % patch_name)
-
-        # Determine the contents for the new patch.
-        patch = self.repository.diff()
-        if patch != '':
-            # Create the patch.
-            patch_file = open(patch_path, 'wb')
-            patch_file.write(patch.encode('utf-8'))
-            patch_file.close()
-
-            # Undo all changes in the repository, and determine which files have
-            # been added or removed. Files that were added, need to be removed
-            # again.
-            pre_file_status = self.repository.status()
+        case creating the patch was successful, all changes in the current
+        repository are reverted. Returns ``True`` in case a patch was created,
+        and ``False`` otherwise.
+
+        In case a list of *paths* (relative to the repository root) is given,
+        only the changes to those files and the files in those directories are
+        stashed and reverted, all other changes are left untouched.
+
+        The changes are stashed in the format :py:attr:`FORMAT`. The patch is
+        written to a temporary file first, and replaces any existing patch
+        *patch_name* atomically in case *overwrite* is set.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case *patch_name*
+            already exists and *overwrite* is not set, or in case one of the
+            *paths* is located outside the repository.
+        """
+        # Hidden files in the stash are not considered to be patches.
+        if not is_patch_name(patch_name):
+            raise StashException("invalid patch name '%s'" % patch_name)
+
+        if paths is not None:
+            paths = [os.path.normpath(path) for path in paths]
+            for path in paths:
+                if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+                    raise StashException("path '%s' is outside the repository" % path)
+
+        if self.FORMAT not in self.FORMATS:
+            raise StashException("unsupported format '%s'" % self.FORMAT)
+
+        store = self._get_store()
+        with store.lock([patch_name]):
+            # Raise an exception in case the specified patch already exists.
+            if not overwrite and store.exists(patch_name):
+                raise StashException("patch '%s' already exists" % patch_name)
+
+            if self.FORMAT == 'snapshot':
+                if not store.SUPPORTS_SNAPSHOTS:
+                    raise StashException("snapshots can not be stored in '%s'" % self.STORE_URL)
+                return self._create_snapshot(store, patch_name, paths, overwrite)
+            return self._create_patch(store, patch_name, paths, overwrite)
+
+    def _create_patch(self, store, patch_name, paths, overwrite):
+        """Stashes the changes to *paths* as patch *patch_name* in *store*,
+        while the lock on the patch is held, see :py:meth:`create_patch`.
+        """
+        # The revision the patch is based on does not depend on the diff,
+        # determine it while the diff is being written.
+        revision = self.repository.get_revision_async()
+
+        # Write the contents for the new patch to a temporary file, and
+        # determine whether any changes were written at all.
+        temp_path = store.create_temp_path()
+        try:
+            patch_file = open_patch(temp_path, 'wb', self.CODEC)
+            try:
+                self.repository.write_diff(patch_file, paths)
+                patch_created = patch_file.tell() > 0
+            finally:
+                patch_file.close()
+            revision = revision.result()
+
+            # Store the patch before touching the working copy, such that the
+            # changes are not lost in case storing fails. Nothing is stored
+            # for an empty patch.
+            if patch_created:
+                store.publish(temp_path, patch_name, overwrite)
+        except:
+            store.discard(temp_path)
+            raise
+
+        if not patch_created:
+            store.discard(temp_path)
+            return False
+
+        # Undo all changes in the repository, and determine which files have
+        # been added or removed. Files that were added, need to be removed
+        # again. In case the files that are part of the patch are known, only
+        # those files are inspected and reverted, otherwise the selected paths
+        # are.
+        patch_path = store.get_path(patch_name)
+        file_names = get_file_names(patch_path)
+        revert_paths = file_names if file_names is not None else paths
+        pre_file_status = self.repository.status(revert_paths)
+        if revert_paths is not None:
+            self.repository.revert(revert_paths)
+        else:
             self.repository.revert_all()
-            changed_file_status = self.repository.status().difference(pre_file_status)
+        changed_file_status = self.repository.status(revert_paths).difference(pre_file_status)
 
-            # Remove all files that are created by the patch that is now being
-            # stashed.
-            for status, file_name in changed_file_status:
-                if status == FileStatus.Added:
-                    os.unlink(os.path.join(self.repository.root_path, file_name))
+        # Remove all files that are created by the patch that is now being
+        # stashed.
+        for status, file_name in changed_file_status:
+            if status == FileStatus.Added:
+                os.unlink(os.path.join(self.repository.root_path, file_name))
+
+        # Record the origin of the patch in the index, together with the
+        # contents of the touched files the patch is based on, which are
+        # restored now.
+        index = self._get_index()
+        try:
+            index.add(patch_name, os.path.abspath(self.repository.root_path), self.repository.VCS_NAME, revision, file_names,
+                      self._get_preimages(index, file_names))
+        finally:
+            index.close()
 
-        # Return whether a non-empty patch was created.
-        return patch != ''
+        return True
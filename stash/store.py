@@ -0,0 +1,589 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from urllib.parse import quote, urlencode, urlsplit
+
+from .compression import CHUNK_SIZE
+from .exception import StashException
+from .snapshot import is_snapshot
+
+def is_patch_name(patch_name):
+    """Returns whether *patch_name* can be the name of a stored patch. A name
+    consists of one or more components separated by slashes, all but the last
+    form the namespace of the patch, for example ``'repository/name'``.
+    Components can not be empty or start with a dot, hidden files are used
+    for administrative purposes.
+    """
+    if not patch_name or (os.sep != '/' and os.sep in patch_name):
+        return False
+    return all(component and not component.startswith('.') for component in patch_name.split('/'))
+
+def check_namespace(namespace):
+    """Returns *namespace* without leading and trailing slashes, or ``None``
+    in case *namespace* is empty or ``None``.
+
+    :raises: :py:exc:`~stash.exception.StashException` in case *namespace* is
+        not a valid namespace.
+    """
+    if not namespace or not namespace.strip('/'):
+        return None
+    namespace = namespace.strip('/')
+    if not is_patch_name(namespace):
+        raise StashException("invalid namespace '%s'" % namespace)
+    return namespace
+
+def _get_shard(name):
+    """Returns the name of the directory containing the patch named *name*
+    within its namespace. Patches are spread over 256 hidden directories
+    based on the hash of their name, which keeps directories small.
+    """
+    return '.' + hashlib.sha1(name.encode('utf-8', 'surrogateescape')).hexdigest()[:2]
+
+@contextlib.contextmanager
+def _lock_file(path, shared=False, remove=None):
+    """Context manager holding an advisory lock on the lock file *path*,
+    which is created when needed. In case the lock is exclusive and
+    *remove* returns ``True`` when the lock is released, the lock file is
+    removed. A lock file that was removed while waiting for it is locked
+    again.
+    """
+    while True:
+        handle = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            if os.path.samestat(os.fstat(handle), os.stat(path)):
+                break
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                os.close(handle)
+                raise
+        os.close(handle)
+
+    try:
+        yield
+    finally:
+        try:
+            if not shared and remove is not None and remove():
+                os.unlink(path)
+        finally:
+            os.close(handle)
+
+class PatchStore(object):
+    """Location the patches of a :py:class:`~stash.stash.Stash` are stored in.
+    Regardless of the store, each patch is accessible as a file (or, for
+    snapshots, a directory) in the local directory *path*, such that patches
+    can be read and applied directly. This base class stores patches in that
+    directory only, subclasses share them with other machines.
+
+    Patches are stored in :py:attr:`PATCHES_DIRECTORY`, in a directory per
+    namespace, divided over hidden shard directories. The location of a patch
+    follows from its name, looking up a patch never lists a directory.
+    Patches stored directly in *path* by earlier versions are moved into place
+    automatically.
+
+    New patches are written to a temporary location first, and are published
+    by renaming them, such that readers never see a partially written patch,
+    see :py:meth:`create_temp_path` and :py:meth:`publish`. Processes sharing
+    the store coordinate modifications using advisory locks, see
+    :py:meth:`lock`.
+    """
+
+    LOCKS_DIRECTORY = '.locks'
+    """Name of the directory in *path* containing the lock of the store as a
+    whole. The lock of each patch is located next to the patch.
+    """
+
+    PATCHES_DIRECTORY = '.patches'
+    """Name of the directory in *path* containing the patches."""
+
+    SUPPORTS_SNAPSHOTS = True
+    """Whether snapshots can be stored, see :py:class:`~stash.snapshot.Snapshot`."""
+
+    def __init__(self, path):
+        self.path = path
+        """Local directory containing the patches."""
+
+        os.makedirs(os.path.join(path, self.LOCKS_DIRECTORY), exist_ok=True)
+
+        super(PatchStore, self).__init__()
+
+        # Stores created by earlier versions lack the patches directory, once
+        # it exists the store is never examined again.
+        if not os.path.isdir(os.path.join(path, self.PATCHES_DIRECTORY)):
+            with self.lock():
+                self._migrate()
+
+    def _migrate(self):
+        """Creates :py:attr:`PATCHES_DIRECTORY`, moving patches stored directly
+        in the store directory, as done by earlier versions, into it. The
+        directory is populated under a temporary name first, such that an
+        interrupted migration is resumed. The caller is expected to hold the
+        lock on the store as a whole.
+        """
+        patches_path = os.path.join(self.path, self.PATCHES_DIRECTORY)
+        if os.path.isdir(patches_path):
+            return
+
+        temp_path = patches_path + '.migrate'
+        os.makedirs(temp_path, exist_ok=True)
+        for patch_name in os.listdir(self.path):
+            if is_patch_name(patch_name):
+                shard_path = os.path.join(temp_path, _get_shard(patch_name))
+                os.makedirs(shard_path, exist_ok=True)
+                os.rename(os.path.join(self.path, patch_name), os.path.join(shard_path, patch_name))
+        os.rename(temp_path, patches_path)
+
+    @contextlib.contextmanager
+    def lock(self, patch_names=None, shared=False):
+        """Context manager holding advisory locks on the store. In case
+        *patch_names* is ``None``, the store as a whole is locked. Otherwise,
+        the patches in *patch_names* are locked, while the store as a whole is
+        locked shared, such that locking the store waits for all operations on
+        individual patches. The locks are exclusive unless *shared* is set.
+        Locks are always acquired in the same order, the locks held by a
+        process can not be acquired again by that process.
+        """
+        store_lock_path = os.path.join(self.path, self.LOCKS_DIRECTORY, '.store')
+        if patch_names is None:
+            with _lock_file(store_lock_path, shared):
+                yield
+            return
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(_lock_file(store_lock_path, shared=True))
+            for patch_name in sorted(set(patch_names)):
+                if not is_patch_name(patch_name):
+                    raise StashException("invalid patch name '%s'" % patch_name)
+                # Lock files of patches that do not exist are cleaned up.
+                patch_path = self.get_path(patch_name)
+                directory, name = os.path.split(patch_path)
+                os.makedirs(directory, exist_ok=True)
+                stack.enter_context(_lock_file(os.path.join(directory, '.lock.' + name), shared,
+                                               lambda patch_path=patch_path: not os.path.lexists(patch_path)))
+            yield
+
+    def create_temp_path(self):
+        """Returns a path in a new hidden directory in the store, at which a
+        new patch or snapshot can be written before it is published using
+        :py:meth:`publish`, or discarded using :py:meth:`discard`.
+        """
+        return os.path.join(tempfile.mkdtemp(dir=self.path, prefix='.new.'), 'patch')
+
+    def discard(self, temp_path):
+        """Removes the unpublished patch at *temp_path*, see
+        :py:meth:`create_temp_path`.
+        """
+        shutil.rmtree(os.path.dirname(temp_path))
+
+    def publish(self, temp_path, patch_name, overwrite=False):
+        """Atomically stores the patch or snapshot written at *temp_path* as
+        patch *patch_name*, see :py:meth:`create_temp_path`. Unless
+        *overwrite* is set, the patch must not exist yet. The caller is
+        expected to hold the lock on *patch_name*, see :py:meth:`lock`.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case the patch
+            could not be stored, *temp_path* is left untouched in that case.
+        """
+        self._upload(temp_path, patch_name, overwrite)
+
+        # A directory can not atomically replace a file or another directory,
+        # or the other way around.
+        patch_path = self.get_path(patch_name)
+        if os.path.lexists(patch_path) and (is_snapshot(patch_path) or is_snapshot(temp_path)):
+            self._remove_local_copy(patch_name)
+        os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+        os.replace(temp_path, patch_path)
+        os.rmdir(os.path.dirname(temp_path))
+
+    def _upload(self, path, patch_name, overwrite):
+        """Stores the patch located at *path* as patch *patch_name*, before
+        it is published locally, see :py:meth:`publish`.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case *overwrite*
+            is not set and the patch already exists.
+        """
+        if not overwrite and os.path.lexists(self.get_path(patch_name)):
+            raise StashException("patch '%s' already exists" % patch_name)
+
+    def get_path(self, patch_name):
+        """Returns the path of the local copy of patch *patch_name*, without
+        checking whether it exists.
+        """
+        namespace, _, name = patch_name.rpartition('/')
+        components = namespace.split('/') if namespace else []
+        return os.path.join(self.path, self.PATCHES_DIRECTORY, *(components + [_get_shard(name), name]))
+
+    def get_patches(self, namespace=None):
+        """Returns the names of all stored patches, or only those in
+        *namespace* and the namespaces nested in it. The patches are not read,
+        use :py:meth:`fetch` to obtain an up to date local copy.
+        """
+        namespace = check_namespace(namespace)
+        patch_names = []
+        def scan(path, prefix):
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                return
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    if len(entry.name) == 3 and entry.is_dir(follow_symlinks=False):
+                        patch_names.extend(prefix + name for name in os.listdir(entry.path) if not name.startswith('.'))
+                elif entry.is_dir(follow_symlinks=False):
+                    scan(entry.path, prefix + entry.name + '/')
+
+        if namespace:
+            scan(os.path.join(self.path, self.PATCHES_DIRECTORY, *namespace.split('/')), namespace + '/')
+        else:
+            scan(os.path.join(self.path, self.PATCHES_DIRECTORY), '')
+        return sorted(patch_names)
+
+    def exists(self, patch_name):
+        """Returns whether patch *patch_name* is stored."""
+        return is_patch_name(patch_name) and os.path.exists(self.get_path(patch_name))
+
+    def fetch(self, patch_name):
+        """Makes sure the local copy of patch *patch_name* is up to date, and
+        returns its path.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case
+            *patch_name* does not exist.
+        """
+        patch_path = self.get_path(patch_name)
+        if not is_patch_name(patch_name) or not os.path.exists(patch_path):
+            raise StashException("patch '%s' does not exist" % patch_name)
+        return patch_path
+
+    def push(self, patch_name, overwrite=False):
+        """Stores the local copy of patch *patch_name*, which was just created
+        or modified. Unless *overwrite* is set, the patch must not exist in
+        the store yet.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case the patch
+            could not be stored.
+        """
+
+    def remove(self, patch_name):
+        """Removes patch *patch_name* from the store, including its local
+        copy.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case
+            *patch_name* does not exist.
+        """
+        self._remove_local_copy(patch_name)
+
+    def _remove_local_copy(self, patch_name):
+        """Removes the local copy of patch *patch_name*.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case there is
+            no local copy.
+        """
+        patch_path = self.get_path(patch_name)
+        try:
+            if not is_patch_name(patch_name):
+                raise OSError(errno.ENOENT, patch_name)
+            if is_snapshot(patch_path):
+                shutil.rmtree(patch_path)
+            else:
+                os.unlink(patch_path)
+        except OSError:
+            raise StashException("patch '%s' does not exist" % patch_name)
+
+class _ConnectionPool(object):
+    """Pool of idle persistent HTTP connections, per host. Connections are
+    only returned to the pool once their response has been read completely.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+        super(_ConnectionPool, self).__init__()
+
+    def _get(self, scheme, netloc):
+        """Returns an idle connection to *netloc*, or a new one, and whether
+        the connection was used before.
+        """
+        with self._lock:
+            connections = self._connections.get((scheme, netloc))
+            if connections:
+                return connections.pop(), True
+
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(netloc, blocksize=CHUNK_SIZE), False
+
+    def release(self, scheme, netloc, connection, response):
+        """Returns *connection* to the pool, unless the server announced it
+        will close it.
+        """
+        if response.will_close:
+            connection.close()
+            return
+        with self._lock:
+            self._connections.setdefault((scheme, netloc), []).append(connection)
+
+    def request(self, method, url, body=None, headers=None):
+        """Sends the request *method* for *url*, and returns a tuple containing
+        the connection and its response. The body of the request is streamed
+        from the binary file object *body*. A request on an idle connection
+        that turns out to be closed by the server is sent again on a new
+        connection.
+        """
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Length'] = str(os.fstat(body.fileno()).st_size)
+
+        while True:
+            connection, reused = self._get(parts.scheme, parts.netloc)
+            try:
+                if body is not None:
+                    body.seek(0)
+                connection.request(method, path, body, headers)
+                return connection, connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            for connections in self._connections.values():
+                for connection in connections:
+                    connection.close()
+            self._connections.clear()
+
+_pool = _ConnectionPool()
+"""Connections shared by all :py:class:`HttpPatchStore` instances."""
+
+class HttpPatchStore(PatchStore):
+    """Store that shares patches through an HTTP server, for example
+    :py:class:`~stash.storeserver.PatchStoreServer`, located at *url*. The
+    local directory *path* is used as a read-through cache, the entity tag of
+    each cached patch is recorded, such that a patch is only downloaded again
+    in case it changed on the server. Patches are uploaded and downloaded in
+    chunks over persistent connections.
+
+    The server lists all patches with their entity tags as a JSON object at
+    *url*, or those in a namespace given by the ``namespace`` query parameter,
+    and serves each patch at *url* followed by its quoted name, supporting
+    ``GET``, ``HEAD``, ``PUT`` and ``DELETE``.
+    """
+
+    SUPPORTS_SNAPSHOTS = False
+    """Snapshots are directories, which can not be uploaded."""
+
+    ETAGS_FILE_NAME = '.etags.json'
+    """Name of the file in the cache directory that records the entity tags of
+    the cached patches.
+    """
+
+    def __init__(self, url, path):
+        self.url = url.rstrip('/') + '/'
+        """URL of the server."""
+
+        super(HttpPatchStore, self).__init__(path)
+
+        try:
+            with open(os.path.join(self.path, self.ETAGS_FILE_NAME), 'r') as etags_file:
+                self._etags = json.load(etags_file)
+        except (IOError, OSError, ValueError):
+            self._etags = {}
+
+    def _save_etags(self):
+        """Records the entity tags of the cached patches."""
+        handle, temp_path = tempfile.mkstemp(dir=self.path, prefix='.etags.')
+        with os.fdopen(handle, 'w') as etags_file:
+            json.dump(self._etags, etags_file)
+        os.replace(temp_path, os.path.join(self.path, self.ETAGS_FILE_NAME))
+
+    def _request(self, method, patch_name=None, body=None, headers=None, query=None):
+        """Sends the request *method* for patch *patch_name*, or for the list
+        of patches, optionally with the *query* string, and returns a tuple
+        containing the connection and its response. The caller reads the
+        response and passes both to :py:meth:`_release`.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case the server
+            can not be reached.
+        """
+        url = self.url + (quote(patch_name, safe='') if patch_name is not None else '')
+        if query:
+            url += '?' + query
+        try:
+            return _pool.request(method, url, body, headers)
+        except (http.client.HTTPException, OSError) as e:
+            raise StashException("unable to reach patch store '%s': %s" % (self.url, e))
+
+    def _release(self, connection, response):
+        """Returns the connection of a completely read *response* to the
+        pool.
+        """
+        parts = urlsplit(self.url)
+        _pool.release(parts.scheme, parts.netloc, connection, response)
+
+    def _query(self, method, patch_name=None, body=None, headers=None):
+        """Sends a request without a meaningful response body, see
+        :py:meth:`_request`. Returns the response.
+        """
+        connection, response = self._request(method, patch_name, body, headers)
+        response.read()
+        self._release(connection, response)
+        return response
+
+    def _download(self, patch_name, etag):
+        """Downloads patch *patch_name* in case its entity tag differs from
+        *etag*, the tag of the cached copy. Returns whether the patch exists.
+        """
+        headers = {'If-None-Match': etag} if etag is not None else {}
+        connection, response = self._request('GET', patch_name, headers=headers)
+        if response.status != 200:
+            response.read()
+            self._release(connection, response)
+            if response.status == 304:
+                return True
+            if response.status == 404:
+                return False
+            raise StashException("unable to download patch '%s': %d %s" % (patch_name, response.status, response.reason))
+
+        handle, temp_path = tempfile.mkstemp(dir=self.path, prefix='.download.')
+        try:
+            with os.fdopen(handle, 'wb') as patch_file:
+                shutil.copyfileobj(response, patch_file, CHUNK_SIZE)
+            patch_path = self.get_path(patch_name)
+            os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+            os.replace(temp_path, patch_path)
+        except:
+            connection.close()
+            os.unlink(temp_path)
+            raise
+        self._release(connection, response)
+        self._etags[patch_name] = response.getheader('ETag')
+        return True
+
+    def get_patches(self, namespace=None):
+        """See :py:meth:`PatchStore.get_patches`. Only the names and entity
+        tags of the patches are listed by the server, no patch is downloaded.
+        Cached copies of patches that changed on the server since they were
+        cached, or that were removed from the server, are removed, such that
+        they are downloaded by :py:meth:`fetch` once needed. The server lists
+        the patches in *namespace* only, such that the size of the listing
+        does not depend on the size of the store.
+        """
+        namespace = check_namespace(namespace)
+        query = urlencode({'namespace': namespace}) if namespace else None
+        connection, response = self._request('GET', query=query)
+        data = response.read()
+        self._release(connection, response)
+        if response.status != 200:
+            raise StashException("unable to list patches in '%s': %d %s" % (self.url, response.status, response.reason))
+        etags = json.loads(data.decode('utf-8'))
+
+        modified = False
+        for patch_name, etag in sorted(etags.items()):
+            if is_patch_name(patch_name) and self._etags.get(patch_name) != etag and \
+                    os.path.lexists(self.get_path(patch_name)):
+                self._remove_local_copy(patch_name)
+                self._etags.pop(patch_name, None)
+                modified = True
+
+        # Only forget patches that were cached before, any other files are
+        # patches that are being created.
+        for patch_name in list(self._etags):
+            if patch_name not in etags and (not namespace or patch_name.startswith(namespace + '/')):
+                if os.path.lexists(self.get_path(patch_name)):
+                    self._remove_local_copy(patch_name)
+                del self._etags[patch_name]
+                modified = True
+
+        if modified:
+            self._save_etags()
+        return sorted(patch_name for patch_name in etags if is_patch_name(patch_name))
+
+    def exists(self, patch_name):
+        """See :py:meth:`PatchStore.exists`."""
+        if not is_patch_name(patch_name):
+            return False
+        response = self._query('HEAD', patch_name)
+        if response.status not in (200, 404):
+            raise StashException("unable to query patch '%s': %d %s" % (patch_name, response.status, response.reason))
+        return response.status == 200
+
+    def fetch(self, patch_name):
+        """See :py:meth:`PatchStore.fetch`. The cached copy is validated using
+        its entity tag.
+        """
+        if not is_patch_name(patch_name):
+            raise StashException("patch '%s' does not exist" % patch_name)
+
+        patch_path = self.get_path(patch_name)
+        etag = self._etags.get(patch_name) if os.path.exists(patch_path) else None
+        try:
+            if not self._download(patch_name, etag):
+                if etag is not None:
+                    self._remove_local_copy(patch_name)
+                    del self._etags[patch_name]
+                raise StashException("patch '%s' does not exist" % patch_name)
+        finally:
+            self._save_etags()
+        return patch_path
+
+    def push(self, patch_name, overwrite=False):
+        """See :py:meth:`PatchStore.push`."""
+        self._upload(self.get_path(patch_name), patch_name, overwrite)
+
+    def _upload(self, path, patch_name, overwrite):
+        """See :py:meth:`PatchStore._upload`."""
+        if is_snapshot(path):
+            raise StashException("snapshot '%s' can not be stored in '%s'" % (patch_name, self.url))
+
+        # Avoid overwriting a patch that another user stored meanwhile.
+        headers = {'If-None-Match': '*'} if not overwrite else {}
+        with open(path, 'rb') as patch_file:
+            response = self._query('PUT', patch_name, patch_file, headers)
+        if response.status == 412:
+            raise StashException("patch '%s' already exists" % patch_name)
+        if response.status not in (200, 201, 204):
+            raise StashException("unable to upload patch '%s': %d %s" % (patch_name, response.status, response.reason))
+
+        self._etags[patch_name] = response.getheader('ETag')
+        self._save_etags()
+
+    def remove(self, patch_name):
+        """See :py:meth:`PatchStore.remove`."""
+        if not is_patch_name(patch_name):
+            raise StashException("patch '%s' does not exist" % patch_name)
+
+        response = self._query('DELETE', patch_name)
+        if response.status == 404:
+            raise StashException("patch '%s' does not exist" % patch_name)
+        if response.status not in (200, 204):
+            raise StashException("unable to remove patch '%s': %d %s" % (patch_name, response.status, response.reason))
+
+        if os.path.lexists(self.get_path(patch_name)):
+            self._remove_local_copy(patch_name)
+        if self._etags.pop(patch_name, None) is not None:
+            self._save_etags()
+
+def create_store(url, path):
+    """Returns the :py:class:`PatchStore` for *url*, using *path* as the
+    local directory. In case *url* is ``None``, patches are stored in *path*
+    itself.
+
+    :raises: :py:exc:`~stash.exception.StashException` in case the scheme of
+        *url* is not supported.
+    """
+    if not url:
+        return PatchStore(path)
+    if urlsplit(url).scheme in ('http', 'https'):
+        return HttpPatchStore(url, path)
+    raise StashException("unsupported patch store '%s'" % url)
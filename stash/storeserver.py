@@ -0,0 +1,226 @@
+import argparse
+import http.server
+import json
+import os
+import shutil
+import sys
+import threading
+
+from urllib.parse import parse_qs, unquote
+
+from .compression import CHUNK_SIZE
+from .exception import StashException
+from .store import PatchStore, check_namespace, is_patch_name
+
+def _get_etag(path):
+    """Returns the entity tag of the file located at *path*, based on its size,
+    modification time and inode, or ``None`` in case it does not exist.
+    """
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return None
+    mtime = getattr(path_stat, 'st_mtime_ns', int(path_stat.st_mtime * 1e9))
+    return '"%x-%x-%x"' % (path_stat.st_size, mtime, path_stat.st_ino)
+
+class _PatchRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the patches of a :py:class:`PatchStoreServer`, see
+    :py:class:`~stash.store.HttpPatchStore` for the protocol.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _get_patch_name(self):
+        """Returns the name of the requested patch, ``''`` in case the list of
+        patches is requested, or ``None`` in case the name is invalid.
+        """
+        patch_name = unquote(self.path.split('?', 1)[0].lstrip('/'))
+        if patch_name and not is_patch_name(patch_name):
+            return None
+        return patch_name
+
+    def _get_namespace(self):
+        """Returns the namespace the list of patches is requested for, or
+        ``None`` for all patches.
+
+        :raises: :py:exc:`~stash.exception.StashException` in case the
+            namespace is invalid.
+        """
+        query = parse_qs(self.path.partition('?')[2])
+        return check_namespace(query.get('namespace', [None])[0])
+
+    def _send_empty(self, status, etag=None):
+        """Sends a response without a body."""
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _skip_body(self):
+        """Reads the request body, such that the connection can be reused."""
+        length = int(self.headers.get('Content-Length') or 0)
+        while length > 0:
+            length -= len(self.rfile.read(min(length, CHUNK_SIZE)))
+
+    def _send_patch(self, send_body):
+        patch_name = self._get_patch_name()
+        if patch_name is None:
+            self._send_empty(400)
+            return
+
+        if not patch_name:
+            try:
+                namespace = self._get_namespace()
+            except StashException:
+                self._send_empty(400)
+                return
+            body = json.dumps(self.server.get_etags(namespace)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+
+        try:
+            patch_file = open(self.server.store.get_path(patch_name), 'rb')
+        except (IOError, OSError):
+            self._send_empty(404)
+            return
+
+        with patch_file:
+            etag = _get_etag(patch_file.name)
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self._send_empty(304, etag)
+                return
+
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(patch_file.fileno()).st_size))
+            self.end_headers()
+            if send_body:
+                shutil.copyfileobj(patch_file, self.wfile, CHUNK_SIZE)
+
+    def do_GET(self):
+        self._send_patch(True)
+
+    def do_HEAD(self):
+        self._send_patch(False)
+
+    def do_PUT(self):
+        patch_name = self._get_patch_name()
+        if not patch_name or 'Content-Length' not in self.headers:
+            self._skip_body()
+            self._send_empty(400)
+            return
+
+        # Receive the patch in a temporary file, such that readers never see a
+        # partially uploaded patch.
+        store = self.server.store
+        temp_path = store.create_temp_path()
+        try:
+            with open(temp_path, 'wb') as patch_file:
+                length = int(self.headers['Content-Length'])
+                while length > 0:
+                    data = self.rfile.read(min(length, CHUNK_SIZE))
+                    if not data:
+                        raise IOError("connection closed")
+                    patch_file.write(data)
+                    length -= len(data)
+
+            with self.server.lock:
+                existed = store.exists(patch_name)
+                if existed and self.headers.get('If-None-Match') == '*':
+                    self._send_empty(412)
+                    return
+                store.publish(temp_path, patch_name, overwrite=True)
+        finally:
+            if os.path.exists(temp_path):
+                store.discard(temp_path)
+
+        self._send_empty(204 if existed else 201, _get_etag(store.get_path(patch_name)))
+
+    def do_DELETE(self):
+        patch_name = self._get_patch_name()
+        if not patch_name:
+            self._send_empty(400)
+            return
+
+        try:
+            with self.server.lock:
+                self.server.store.remove(patch_name)
+        except StashException:
+            self._send_empty(404)
+            return
+        self._send_empty(204)
+
+class PatchStoreServer(http.server.ThreadingHTTPServer):
+    """Minimal HTTP server sharing the patches in the directory *path*, for
+    use with :py:class:`~stash.store.HttpPatchStore`, listening on *address*,
+    a tuple containing the host and port. It is a reference implementation of
+    the protocol, for example for testing, it provides no authentication. The
+    patches are laid out like those of a :py:class:`~stash.store.PatchStore`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, path, verbose=False):
+        self.path = path
+        """Directory containing the patches."""
+
+        self.verbose = verbose
+        """Whether requests are logged to stderr."""
+
+        self.lock = threading.Lock()
+        """Lock serializing modifications of the directory."""
+
+        self.store = PatchStore(path)
+        """Store containing the patches."""
+
+        http.server.ThreadingHTTPServer.__init__(self, address, _PatchRequestHandler)
+
+    @property
+    def url(self):
+        """URL of the patch store served."""
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    def get_etags(self, namespace=None):
+        """Returns a dictionary mapping the names of all patches, or those in
+        *namespace*, to their entity tags.
+        """
+        etags = {}
+        for patch_name in self.store.get_patches(namespace):
+            etag = _get_etag(self.store.get_path(patch_name))
+            if etag is not None:
+                etags[patch_name] = etag
+        return etags
+
+def main(argv=None):
+    """Serves the patches in a directory until interrupted."""
+    parser = argparse.ArgumentParser(description='Shares stashed patches over HTTP.')
+    parser.add_argument('path', help='directory containing the patches')
+    parser.add_argument('--host', default='localhost', help='address to listen on (default: localhost)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--verbose', action='store_true', help='log all requests')
+    args = parser.parse_args(argv)
+
+    server = PatchStoreServer((args.host, args.port), args.path, args.verbose)
+    sys.stderr.write('Serving patches in %s at %s\n' % (args.path, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -37,7 +37,20 @@ class StashTestCase(unittest.TestCase):
         if os.path.exists(cls.REPOSITORY_URI):
             shutil.rmtree(cls.REPOSITORY_URI)
 
+    def _store_patch(self, patch_name, contents):
+        """Stores *contents*, either bytes or a string, as patch *patch_name*
+        directly in the stash directory, bypassing the stash itself.
+        """
+        patch_path = Stash._get_store().get_path(patch_name)
+        os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+        with open(patch_path, 'wb') as patch_file:
+            patch_file.write(contents if isinstance(contents, bytes) else contents.encode())
+
     def tearDown(self):
         """Removes all stashed patches."""
         for patch_name in os.listdir(self.STASH_PATH):
-            os.unlink(os.path.join(self.STASH_PATH, patch_name))
+            patch_path = os.path.join(self.STASH_PATH, patch_name)
+            if os.path.isdir(patch_path):
+                shutil.rmtree(patch_path)
+            else:
+                os.unlink(patch_path)
@@ -0,0 +1,138 @@
+import functools
+import json
+import os
+import threading
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+_tracer = None
+"""The active :py:class:`Tracer`, or ``None`` in case tracing is disabled."""
+
+class TraceEvent(object):
+    """A single traced operation or command."""
+
+    def __init__(self, name, category, start, duration, details=None):
+        self.name = name
+        """Name of the operation, or the command line of a command."""
+
+        self.category = category
+        """Kind of event, ``'operation'`` for stash operations, ``'command'``
+        for executed processes, and ``'cmdserver'`` for commands executed by a
+        Mercurial command server.
+        """
+
+        self.start = start
+        """Start time in seconds, relative to the start of the tracer."""
+
+        self.duration = duration
+        """Wall-clock duration in seconds."""
+
+        self.details = details or {}
+        """Additional information, for commands the exit code and the number
+        of output bytes.
+        """
+
+        self.thread = threading.current_thread().ident
+
+        super(TraceEvent, self).__init__()
+
+class Tracer(object):
+    """Collects :py:class:`TraceEvent` instances for all traced operations and
+    commands, while it is enabled using :py:func:`enable`.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._start = _clock()
+
+        super(Tracer, self).__init__()
+
+    def now(self):
+        """Returns the current time relative to the start of the tracer."""
+        return _clock() - self._start
+
+    def add(self, name, category, start, details=None):
+        """Records an event named *name* that started at *start* (as returned
+        by :py:meth:`now`) and ends now.
+        """
+        self.events.append(TraceEvent(name, category, start, self.now() - start, details))
+
+    def add_command(self, command, start, exit_code, output_size, category='command'):
+        """Records the execution of *command*, a list of arguments, that
+        started at *start* and ends now.
+        """
+        self.add(' '.join(command), category, start, {'exit_code': exit_code, 'output_bytes': output_size})
+
+    def get_summary(self):
+        """Returns a list of tuples summarizing all events, grouped by category
+        and name. For commands, only the program and its first argument are
+        used as name. Each tuple contains the category, the name, the number
+        of events, the total duration and the total number of output bytes.
+        The list is sorted on total duration, in descending order.
+        """
+        groups = {}
+        for event in self.events:
+            name = event.name
+            if event.category != 'operation':
+                name = ' '.join(name.split()[:2])
+            count, duration, output_size = groups.get((event.category, name), (0, 0.0, 0))
+            groups[(event.category, name)] = (count + 1, duration + event.duration,
+                                              output_size + (event.details.get('output_bytes') or 0))
+
+        summary = [(category, name) + values for (category, name), values in groups.items()]
+        return sorted(summary, key=lambda entry: entry[3], reverse=True)
+
+    def write_chrome_trace(self, output):
+        """Writes all events to the text file object *output* in the Chrome
+        trace event format, which can be loaded in ``chrome://tracing``.
+        """
+        pid = os.getpid()
+        events = [{
+            'name': event.name,
+            'cat': event.category,
+            'ph': 'X',
+            'ts': event.start * 1e6,
+            'dur': event.duration * 1e6,
+            'pid': pid,
+            'tid': event.thread,
+            'args': event.details,
+        } for event in self.events]
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, output, indent=1)
+
+def enable():
+    """Enables tracing, and returns the new active :py:class:`Tracer`."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def disable():
+    """Disables tracing."""
+    global _tracer
+    _tracer = None
+
+def get_tracer():
+    """Returns the active :py:class:`Tracer`, or ``None`` in case tracing is
+    disabled.
+    """
+    return _tracer
+
+def traced(function):
+    """Decorator that records each call of *function* as an operation in case
+    tracing is enabled. When tracing is disabled, the only overhead is a
+    single check.
+    """
+    name = getattr(function, '__qualname__', function.__name__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        tracer = _tracer
+        if tracer is None:
+            return function(*args, **kwargs)
+
+        start = tracer.now()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            tracer.add(name, 'operation', start)
+    return wrapper
@@ -0,0 +1,390 @@
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import os
+import stat
+import struct
+import threading
+from abc import ABCMeta, abstractmethod
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+"""Constants of the Linux ``inotify`` interface."""
+
+_EVENT_HEADER = struct.Struct('iIII')
+"""Layout of the fixed part of an ``inotify`` event: the watch descriptor,
+the event mask, a cookie and the length of the name that follows.
+"""
+
+class Watcher(metaclass=ABCMeta):
+    """Keeps track of the paths in a working copy that may have changed, so
+    queries on the working copy only need to examine those paths instead of
+    the complete tree.
+
+    The set of dirty paths is a superset of all changed, added, removed and
+    unversioned paths: it is seeded with the outcome of a full scan using
+    :py:meth:`reset`, and every path that is touched afterwards is added to
+    it. Changes that only affect the metadata of the version control system,
+    such as adding a file or committing, do not touch the working copy. Those
+    are detected by watching the *state_files* in the *marker* directory,
+    after which the dirty paths are unknown until the next :py:meth:`reset`.
+    Changes made by commands executed within :py:meth:`own_changes` are not
+    considered, since the repository itself keeps the set of dirty paths a
+    superset.
+    """
+
+    MAX_DIRTY_PATHS = 10000
+    """Number of dirty paths above which the dirty paths are considered
+    unknown, a full scan is cheaper then and prunes paths that turned out to be
+    unchanged.
+    """
+
+    def __init__(self, root_path, marker, state_files):
+        """Starts watching the working copy located at *root_path*, whose
+        version control system stores its metadata in the directory *marker*.
+        """
+        self.root_path = os.path.abspath(root_path)
+        self.marker = marker
+        self.state_files = set(state_files)
+        self.broken = False
+        """Whether the watcher is no longer able to watch the working copy, for
+        example because a system limit was reached.
+        """
+
+        self._lock = threading.RLock()
+        self._dirty = {}
+        self._generation = 0
+        self._stale_generation = 0
+        self._own_changes = 0
+
+        super(Watcher, self).__init__()
+
+        # Nothing is known until the first full scan.
+        self._mark_stale()
+
+    @property
+    def generation(self):
+        """Number of changes observed so far, pass it to :py:meth:`reset`
+        before starting a full scan.
+        """
+        with self._lock:
+            self._poll()
+            return self._generation
+
+    def _mark(self, path):
+        """Marks the *path* relative to the root path as dirty."""
+        self._generation += 1
+        self._dirty[path] = self._generation
+
+    def _mark_stale(self):
+        """Marks the dirty paths as unknown until the next :py:meth:`reset`."""
+        self._generation += 1
+        self._stale_generation = self._generation
+
+    def _state_changed(self):
+        """Handles a change of one of the state files of the version control
+        system.
+        """
+        if not self._own_changes:
+            self._mark_stale()
+
+    def get_dirty_paths(self):
+        """Returns a sorted list of all dirty paths, relative to the root path,
+        or ``None`` in case they are unknown and a full scan is needed.
+        """
+        with self._lock:
+            self._poll()
+            if self._stale_generation or self.broken or len(self._dirty) > self.MAX_DIRTY_PATHS:
+                return None
+            return sorted(self._dirty)
+
+    def reset(self, paths, generation):
+        """Replaces the dirty paths by *paths*, the outcome of a full scan that
+        was started at *generation*. Paths that changed after the scan was
+        started remain dirty.
+        """
+        with self._lock:
+            self._poll()
+            self._dirty = dict((path, path_generation) for path, path_generation in self._dirty.items()
+                               if path_generation > generation)
+            for path in paths:
+                self._dirty.setdefault(path, generation)
+            if self._stale_generation <= generation:
+                self._stale_generation = 0
+
+    @contextlib.contextmanager
+    def own_changes(self):
+        """Context manager for executing a command of the version control
+        system, changes it makes to the state files are ignored.
+        """
+        with self._lock:
+            self._poll()
+            self._own_changes += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._poll()
+                self._own_changes -= 1
+
+    @abstractmethod
+    def _poll(self):
+        """Processes all changes since the last call."""
+
+    def close(self):
+        """Stops watching the working copy."""
+        pass
+
+class _Inotify(object):
+    """Minimal binding of the Linux ``inotify`` system calls."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        super(_Inotify, self).__init__()
+
+    def add_watch(self, path, mask):
+        """Watches *path* for the events in *mask*, returns the watch
+        descriptor.
+        """
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Stops watching the watch descriptor *wd*."""
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Returns a list of tuples containing the watch descriptor, mask,
+        cookie and name of all pending events, without blocking.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        os.close(self.fd)
+
+class InotifyWatcher(Watcher):
+    """:py:class:`Watcher` using the Linux ``inotify`` interface, which
+    watches every directory of the working copy. Events are queued by the
+    kernel, and processed when the dirty paths are requested. In case the
+    queue overflows, the dirty paths are unknown until the next
+    :py:meth:`reset`.
+
+    :raises: :py:exc:`OSError` in case ``inotify`` is not available, or the
+        working copy contains more directories than can be watched.
+    """
+
+    TREE_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+                 IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+    """Events watched for each directory in the working copy."""
+
+    STATE_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    """Events watched for the metadata directory of the version control
+    system.
+    """
+
+    def __init__(self, root_path, marker, state_files):
+        """See :py:class:`Watcher`."""
+        super(InotifyWatcher, self).__init__(root_path, marker, state_files)
+
+        self._inotify = _Inotify()
+        self._directories = {}
+        try:
+            self._state_wd = self._inotify.add_watch(os.path.join(self.root_path, marker), self.STATE_MASK)
+            self._watch_tree('')
+        except:
+            self._inotify.close()
+            raise
+
+    def _watch_tree(self, directory, mark=False):
+        """Watches *directory*, relative to the root path, and all directories
+        in it. In case *mark* is set, all files in it are marked as dirty, as
+        they may have been created before the directory was watched.
+        """
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            path = os.path.join(self.root_path, directory)
+            try:
+                wd = self._inotify.add_watch(path, self.TREE_MASK)
+            except OSError as e:
+                # The directory may be gone already.
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+            self._directories[wd] = directory
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                name = os.path.join(directory, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != self.marker:
+                        directories.append(name)
+                if mark:
+                    self._mark(name)
+
+    def _unwatch_tree(self, directory):
+        """Stops watching *directory* and all directories in it."""
+        prefix = directory + os.sep
+        for wd, watched in list(self._directories.items()):
+            if watched == directory or watched.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._directories[wd]
+
+    def _poll(self):
+        """See :py:meth:`Watcher._poll`."""
+        if self.broken:
+            return
+        try:
+            for wd, mask, _, name in self._inotify.read_events():
+                self._handle_event(wd, mask, name)
+        except OSError:
+            # Typically the limit on the number of watches was reached.
+            self.broken = True
+
+    def _handle_event(self, wd, mask, name):
+        """Updates the dirty paths for a single event."""
+        if mask & IN_Q_OVERFLOW:
+            self._mark_stale()
+        elif wd == self._state_wd:
+            if name in self.state_files:
+                self._state_changed()
+        elif wd not in self._directories:
+            # Event of a watch that was just removed.
+            pass
+        elif mask & IN_IGNORED:
+            del self._directories[wd]
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if not self._directories[wd]:
+                # The working copy itself is gone.
+                self.broken = True
+        else:
+            path = os.path.join(self._directories[wd], name)
+            self._mark(path)
+            if mask & IN_ISDIR and name != self.marker:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path, mark=True)
+                elif mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+
+    def close(self):
+        """See :py:meth:`Watcher.close`."""
+        self._inotify.close()
+
+class PollingWatcher(Watcher):
+    """:py:class:`Watcher` for systems without ``inotify``, which determines
+    the dirty paths by comparing the size, modification time and inode of all
+    files with those seen before. This still walks the working copy, but only
+    needs a ``stat`` call per file, which is much cheaper than a query of the
+    version control system.
+    """
+
+    def __init__(self, root_path, marker, state_files):
+        """See :py:class:`Watcher`."""
+        super(PollingWatcher, self).__init__(root_path, marker, state_files)
+        self._signatures = self._scan()
+
+    @staticmethod
+    def _get_signature(path_stat):
+        """Returns the properties of *path_stat* that change when a file is
+        modified. Directories only change when they are created or removed,
+        changes to the files in them are detected for the files themselves.
+        """
+        if stat.S_ISDIR(path_stat.st_mode):
+            return (stat.S_IFDIR,)
+        return (stat.S_IFMT(path_stat.st_mode), path_stat.st_mode, path_stat.st_size, path_stat.st_mtime, path_stat.st_ino)
+
+    def _scan(self):
+        """Returns a dictionary mapping each path in the working copy, and each
+        state file (prefixed by the marker), to its signature.
+        """
+        signatures = {}
+        for state_file in self.state_files:
+            path = os.path.join(self.marker, state_file)
+            try:
+                signatures[path] = self._get_signature(os.stat(os.path.join(self.root_path, path)))
+            except OSError:
+                pass
+
+        directories = ['']
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(os.path.join(self.root_path, directory)))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name == self.marker:
+                    continue
+                name = os.path.join(directory, entry.name)
+                try:
+                    signatures[name] = self._get_signature(entry.stat(follow_symlinks=False))
+                except OSError:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(name)
+        return signatures
+
+    def _poll(self):
+        """See :py:meth:`Watcher._poll`."""
+        signatures = self._scan()
+        state_prefix = self.marker + os.sep
+        for path in set(signatures) | set(self._signatures):
+            if signatures.get(path) != self._signatures.get(path):
+                if path.startswith(state_prefix):
+                    self._state_changed()
+                else:
+                    self._mark(path)
+        self._signatures = signatures
+
+def create_watcher(root_path, marker, state_files):
+    """Returns a new :py:class:`Watcher` for the working copy located at
+    *root_path*, an :py:class:`InotifyWatcher` where possible and a
+    :py:class:`PollingWatcher` otherwise. See :py:class:`Watcher` for the
+    arguments.
+    """
+    try:
+        return InotifyWatcher(root_path, marker, state_files)
+    except (OSError, AttributeError):
+        return PollingWatcher(root_path, marker, state_files)
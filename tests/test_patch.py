@@ -0,0 +1,362 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import assert_equal, assert_false, assert_is_none, assert_true
+
+from stash import patch
+from stash.patch import HunkStatus, apply_patch, get_file_names, parse_patch
+
+class TestPatch(unittest.TestCase):
+
+    def _write_patch(self, contents):
+        """Writes a temporary patch containing *contents*, and returns its
+        path.
+        """
+        handle, patch_path = tempfile.mkstemp()
+        os.write(handle, contents)
+        os.close(handle)
+        self.addCleanup(os.unlink, patch_path)
+        return patch_path
+
+    def test_get_file_names_from_mercurial_diff(self):
+        """Tests that file names are parsed from a Mercurial diff, including
+        added and removed files.
+        """
+        patch_path = self._write_patch(b'diff -r 000000000000 a\n'
+                                       b'--- a/a\tThu Jan 01 00:00:00 1970 +0000\n'
+                                       b'+++ b/a\tThu Jan 01 00:00:00 1970 +0000\n'
+                                       b'@@ -1,1 +1,1 @@\n'
+                                       b'-123\n'
+                                       b'+321\n'
+                                       b'--- /dev/null\tThu Jan 01 00:00:00 1970 +0000\n'
+                                       b'+++ b/sub/d e\tThu Jan 01 00:00:00 1970 +0000\n'
+                                       b'@@ -0,0 +1,1 @@\n'
+                                       b'+123\n'
+                                       b'--- a/b\tThu Jan 01 00:00:00 1970 +0000\n'
+                                       b'+++ /dev/null\tThu Jan 01 00:00:00 1970 +0000\n'
+                                       b'@@ -1,1 +0,0 @@\n'
+                                       b'-123\n')
+        assert_equal(get_file_names(patch_path), ['a', 'b', 'sub/d e'])
+
+    def test_get_file_names_ignores_hunk_contents(self):
+        """Tests that lines within hunks that look like file headers are not
+        mistaken for file names.
+        """
+        patch_path = self._write_patch(b'--- a/a\n'
+                                       b'+++ b/a\n'
+                                       b'@@ -1,2 +1,2 @@\n'
+                                       b'--- a/x\n'
+                                       b'+++ b/y\n'
+                                       b' context\n')
+        assert_equal(get_file_names(patch_path), ['a'])
+
+    def test_get_file_names_from_git_diff(self):
+        """Tests that file names are parsed from git style headers, for
+        renames and binary files that have no ``---`` and ``+++`` lines.
+        """
+        patch_path = self._write_patch(b'diff --git a/old b/new\n'
+                                       b'similarity index 100%\n'
+                                       b'rename from old\n'
+                                       b'rename to new\n'
+                                       b'diff --git a/image b/image\n'
+                                       b'Binary files a/image and b/image differ\n')
+        assert_equal(get_file_names(patch_path), ['image', 'new', 'old'])
+
+    def test_get_file_names_from_quoted_git_diff(self):
+        """Tests that file names quoted by git, because they contain special
+        characters, are unquoted.
+        """
+        patch_path = self._write_patch(b'diff --git "a/caf\\303\\251" "b/caf\\303\\251"\n'
+                                       b'new file mode 100644\n'
+                                       b'--- /dev/null\n'
+                                       b'+++ "b/caf\\303\\251"\n'
+                                       b'@@ -0,0 +1 @@\n'
+                                       b'+1\n'
+                                       b'diff --git "a/tab\\tand \\"quote\\"" b/new\n'
+                                       b'rename from "tab\\tand \\"quote\\""\n'
+                                       b'rename to new\n')
+        assert_equal(get_file_names(patch_path), ['caf\u00e9', 'new', 'tab\tand "quote"'])
+
+    def test_get_file_names_without_headers(self):
+        """Tests that ``None`` is returned for a patch without file headers."""
+        assert_is_none(get_file_names(self._write_patch(b'A')))
+
+    def test_parse_patch_keeps_raw_lines_per_file(self):
+        """Tests that the raw lines of a patch are divided over the files, and
+        that lines introducing a file are attributed to that file.
+        """
+        first = b'Index: a\n===\ndiff --git a/a b/a\nindex 1..2\n--- a/a\n+++ b/a\n@@ -1 +1 @@\n-1\n+2\n'
+        second = b'Index: b\n===\ndiff --git a/b b/b\ndeleted file mode 100644\n--- a/b\n+++ /dev/null\n@@ -1 +0,0 @@\n-x\n'
+        file_patches = list(parse_patch(io.BytesIO(first + second), raw=True))
+        assert_equal([b''.join(file_patch.raw_lines) for file_patch in file_patches], [first, second])
+
+class TestApplyPatch(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a temporary directory to apply patches in."""
+        self.root_path = tempfile.mkdtemp()
+        self.patch_path = os.path.join(self.root_path, '.patch')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_path)
+
+    def _write(self, file_name, contents):
+        """Writes *contents* to the file *file_name* in the root directory."""
+        f = open(os.path.join(self.root_path, file_name), 'wb')
+        f.write(contents)
+        f.close()
+
+    def _read(self, file_name):
+        """Returns the contents of the file *file_name* in the root directory."""
+        return open(os.path.join(self.root_path, file_name), 'rb').read()
+
+    def _apply(self, patch):
+        """Applies the *patch* in the root directory, and returns the result."""
+        self._write(self.patch_path, patch)
+        return apply_patch(self.patch_path, self.root_path)
+
+    def test_applying_modification_with_offset(self):
+        """Tests that a hunk is applied at an offset in case the file has lines
+        inserted before the location of the hunk.
+        """
+        self._write('a', b'0\n0\n1\n2\n3\n')
+        result = self._apply(b'--- a/a\n'
+                             b'+++ b/a\n'
+                             b'@@ -1,3 +1,3 @@\n'
+                             b' 1\n'
+                             b'-2\n'
+                             b'+4\n'
+                             b' 3\n')
+
+        assert_true(result.succeeded)
+        assert_equal(self._read('a'), b'0\n0\n1\n4\n3\n')
+        assert_equal(result.files[0].hunks[0].status, HunkStatus.Applied)
+        assert_equal(result.files[0].hunks[0].offset, 2)
+
+    def test_applying_modification_with_fuzz(self):
+        """Tests that context lines are ignored in case they do not match."""
+        self._write('a', b'x\n2\n3\n')
+        result = self._apply(b'--- a/a\n'
+                             b'+++ b/a\n'
+                             b'@@ -1,3 +1,3 @@\n'
+                             b' 1\n'
+                             b'-2\n'
+                             b'+4\n'
+                             b' 3\n')
+
+        assert_true(result.succeeded)
+        assert_equal(self._read('a'), b'x\n4\n3\n')
+        assert_equal(result.files[0].hunks[0].status, HunkStatus.Fuzzy)
+        assert_equal(result.files[0].hunks[0].fuzz, 1)
+
+    def test_applying_modification_with_carriage_returns(self):
+        """Tests that carriage returns are treated as part of a line, as they
+        are in the diff.
+        """
+        self._write('a', b'1\r2\n3\r\n4')
+        result = self._apply(b'--- a/a\n'
+                             b'+++ b/a\n'
+                             b'@@ -1,3 +1,3 @@\n'
+                             b' 1\r2\n'
+                             b'-3\r\n'
+                             b'+5\r\n'
+                             b' 4\n'
+                             b'\\ No newline at end of file\n')
+
+        assert_true(result.succeeded)
+        assert_equal(self._read('a'), b'1\r2\n5\r\n4')
+
+    def test_dry_run_does_not_modify_files(self):
+        """Tests that a dry run reports the outcome without modifying files."""
+        self._write('a', b'1\n2\n3\n')
+        self._write(self.patch_path, b'--- a/a\n'
+                                     b'+++ b/a\n'
+                                     b'@@ -1,3 +1,3 @@\n'
+                                     b' 1\n'
+                                     b'-2\n'
+                                     b'+4\n'
+                                     b' 3\n'
+                                     b'--- a/b\n'
+                                     b'+++ /dev/null\n'
+                                     b'@@ -1,1 +0,0 @@\n'
+                                     b'-1\n')
+        result = apply_patch(self.patch_path, self.root_path, dry_run=True)
+
+        assert_false(result.succeeded)
+        assert_equal([file_result.status for file_result in result.files], [HunkStatus.Applied, HunkStatus.Conflict])
+        assert_equal(self._read('a'), b'1\n2\n3\n')
+        assert_false(os.path.exists(os.path.join(self.root_path, 'b')))
+
+    def test_applying_conflicting_modification(self):
+        """Tests that a conflicting hunk is merged using conflict markers."""
+        self._write('a', b'456')
+        result = self._apply(b'--- a/a\n'
+                             b'+++ b/a\n'
+                             b'@@ -1,1 +1,1 @@\n'
+                             b'-123\n'
+                             b'\\ No newline at end of file\n'
+                             b'+321\n'
+                             b'\\ No newline at end of file\n')
+
+        assert_false(result.succeeded)
+        assert_equal(self._read('a'), b'<<<<<<<\n=======\n321\n>>>>>>>\n456')
+        assert_equal(result.files[0].hunks[0].status, HunkStatus.Conflict)
+
+    def test_applying_added_and_removed_files(self):
+        """Tests that files are created and removed, and are reported as such."""
+        self._write('b', b'123\n')
+        result = self._apply(b'--- /dev/null\n'
+                             b'+++ b/sub/a\n'
+                             b'@@ -0,0 +1,1 @@\n'
+                             b'+123\n'
+                             b'--- a/b\n'
+                             b'+++ /dev/null\n'
+                             b'@@ -1,1 +0,0 @@\n'
+                             b'-123\n')
+
+        assert_true(result.succeeded)
+        assert_equal(self._read('sub/a'), b'123\n')
+        assert_false(os.path.exists(os.path.join(self.root_path, 'b')))
+        assert_equal(result.added_file_names, ['sub/a'])
+        assert_equal(result.removed_file_names, ['b'])
+
+    def test_applying_rename(self):
+        """Tests that a git style rename moves the file."""
+        self._write('a', b'123\n')
+        result = self._apply(b'diff --git a/a b/b\n'
+                             b'similarity index 100%\n'
+                             b'rename from a\n'
+                             b'rename to b\n')
+
+        assert_true(result.succeeded)
+        assert_equal(self._read('b'), b'123\n')
+        assert_equal(result.added_file_names, ['b'])
+        assert_equal(result.removed_file_names, ['a'])
+
+    def test_applying_symbolic_links(self):
+        """Tests that symbolic links are created, changed and removed, and
+        that the mode of a new file is applied.
+        """
+        result = self._apply(b'diff --git a/link b/link\n'
+                             b'new file mode 120000\n'
+                             b'--- /dev/null\n'
+                             b'+++ b/link\n'
+                             b'@@ -0,0 +1 @@\n'
+                             b'+target\n'
+                             b'\\ No newline at end of file\n'
+                             b'diff --git a/script b/script\n'
+                             b'new file mode 100755\n'
+                             b'--- /dev/null\n'
+                             b'+++ b/script\n'
+                             b'@@ -0,0 +1 @@\n'
+                             b'+exit\n')
+        assert_true(result.succeeded)
+        assert_true(os.path.islink(os.path.join(self.root_path, 'link')))
+        assert_equal(os.readlink(os.path.join(self.root_path, 'link')), 'target')
+        assert_equal(os.stat(os.path.join(self.root_path, 'script')).st_mode & 0o7777, 0o755)
+
+        result = self._apply(b'diff --git a/link b/link\n'
+                             b'index 1de5659..0f3a2b4 120000\n'
+                             b'--- a/link\n'
+                             b'+++ b/link\n'
+                             b'@@ -1 +1 @@\n'
+                             b'-target\n'
+                             b'\\ No newline at end of file\n'
+                             b'+other\n'
+                             b'\\ No newline at end of file\n')
+        assert_true(result.succeeded)
+        assert_equal(os.readlink(os.path.join(self.root_path, 'link')), 'other')
+
+        result = self._apply(b'diff --git a/link b/link\n'
+                             b'deleted file mode 120000\n'
+                             b'--- a/link\n'
+                             b'+++ /dev/null\n'
+                             b'@@ -1 +0,0 @@\n'
+                             b'-other\n'
+                             b'\\ No newline at end of file\n')
+        assert_true(result.succeeded)
+        assert_false(os.path.lexists(os.path.join(self.root_path, 'link')))
+
+    def test_applying_unsupported_file_type_fails(self):
+        """Tests that a file of a type other than a regular file or a symbolic
+        link, such as a Git submodule, is not created.
+        """
+        result = self._apply(b'diff --git a/module b/module\n'
+                             b'new file mode 160000\n'
+                             b'--- /dev/null\n'
+                             b'+++ b/module\n'
+                             b'@@ -0,0 +1 @@\n'
+                             b'+Subproject commit 0123456789abcdef0123456789abcdef01234567\n')
+        assert_false(result.succeeded)
+        assert_false(os.path.lexists(os.path.join(self.root_path, 'module')))
+
+    def test_applying_binary_patch(self):
+        """Tests that a git binary patch replaces the contents of a file."""
+        self._write('bin', b'x\0y')
+        result = self._apply(b'diff --git a/bin b/bin\n'
+                             b'index d5d0b8b..4a27031 100644\n'
+                             b'GIT binary patch\n'
+                             b'literal 3\n'
+                             b'Kcmb<mr~&{1<pA>l\n'
+                             b'\n'
+                             b'literal 3\n'
+                             b'Kcmb<ms0083<N)#j\n'
+                             b'\n')
+
+        assert_true(result.succeeded)
+        assert_equal(self._read('bin'), b'x\0z')
+
+    def test_applying_patch_outside_root_fails(self):
+        """Tests that files outside of the root directory are not touched."""
+        result = self._apply(b'--- /dev/null\n'
+                             b'+++ b/../a\n'
+                             b'@@ -0,0 +1,1 @@\n'
+                             b'+123\n')
+
+        assert_false(result.succeeded)
+        assert_true(result.files[0].error)
+
+    def test_applying_patch_concurrently(self):
+        """Tests that a patch touching many files has the same outcome when it
+        is applied by multiple processes, including changes to a file that is
+        touched more than once.
+        """
+        # Send batches of a few files to the workers, once a few batches were
+        # read.
+        self.addCleanup(setattr, patch, 'BATCH_SIZE', patch.BATCH_SIZE)
+        self.addCleanup(setattr, patch, 'CONCURRENT_APPLY_SIZE', patch.CONCURRENT_APPLY_SIZE)
+        patch.BATCH_SIZE = 200
+        patch.CONCURRENT_APPLY_SIZE = 500
+
+        file_names = ['f%d' % i for i in range(20)]
+        patch_data = b''
+        for file_name in file_names:
+            self._write(file_name, b'1\n')
+            patch_data += b'--- a/%s\n+++ b/%s\n@@ -1,1 +1,1 @@\n-1\n+2\n' % (file_name.encode(), file_name.encode())
+        patch_data += b'--- a/f0\n+++ b/f0\n@@ -1,1 +1,1 @@\n-2\n+3\n'
+        patch_data += b'--- /dev/null\n+++ b/new/a\n@@ -0,0 +1,1 @@\n+1\n'
+        self._write(self.patch_path, patch_data)
+
+        result = apply_patch(self.patch_path, self.root_path, processes=2)
+        assert_true(result.succeeded)
+        assert_equal([file_result.new_name for file_result in result.files], file_names + ['f0', 'new/a'])
+        assert_equal(result.added_file_names, ['new/a'])
+        assert_equal(self._read('f0'), b'3\n')
+        assert_equal([self._read(file_name) for file_name in file_names[1:]], [b'2\n'] * (len(file_names) - 1))
+
+    def test_small_patch_is_applied_by_calling_process(self):
+        """Tests that no worker processes are started for a patch that is
+        applied faster than the workers start.
+        """
+        def fail(*args, **kwargs):
+            raise AssertionError("process pool started")
+        self.addCleanup(setattr, patch, 'ProcessPoolExecutor', patch.ProcessPoolExecutor)
+        patch.ProcessPoolExecutor = fail
+
+        self._write('a', b'1\n')
+        self._write(self.patch_path, b'--- a/a\n+++ b/a\n@@ -1,1 +1,1 @@\n-1\n+2\n' * 1000)
+        result = apply_patch(self.patch_path, self.root_path, dry_run=True, processes=2)
+        assert_equal(len(result.files), 1000)
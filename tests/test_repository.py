@@ -1,13 +1,121 @@
+import gzip
 import os
+import re
 import shutil
+import struct
+import tempfile
+import unittest
 
-from nose.tools import assert_in, assert_equal, assert_not_in, assert_raises, assert_true
+from nose.tools import assert_false, assert_in, assert_equal, assert_not_in, assert_raises, assert_true
 
 from stash.exception import StashException
-from stash.repository import MercurialRepository, SubversionRepository
-from stash.stash import Stash
+from stash.patch import HunkStatus
+from stash.repository import FileChange, GitRepository, MercurialRepository, Repository, SubversionRepository, split_arguments
+from stash import trace
+from stash.stash import PatchState, Stash
 from stash.test_case import StashTestCase
 
+class TestSplitArguments(unittest.TestCase):
+
+    def test_arguments_fitting_limit_are_not_split(self):
+        """Tests that arguments that fit within the limit form one chunk."""
+        assert_equal(list(split_arguments(['hg', 'add'], ['a', 'b', 'c'])), [['a', 'b', 'c']])
+
+    def test_arguments_exceeding_limit_are_split(self):
+        """Tests that arguments are split over multiple chunks, each of which
+        fits within the limit together with the command.
+        """
+        # Each argument takes up five bytes and a pointer, as does the command.
+        limit = 3 * (5 + struct.calcsize('P'))
+        arguments = ['%04d' % i for i in range(5)]
+        assert_equal(list(split_arguments(['hg!!'], arguments, limit)), [['0000', '0001'], ['0002', '0003'], ['0004']])
+
+    def test_no_arguments_results_in_no_chunks(self):
+        """Tests that no chunks are generated without arguments."""
+        assert_equal(list(split_arguments(['hg', 'add'], [])), [])
+
+class TestRepositoryDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.path)
+        self.addCleanup(Repository._root_paths.clear)
+
+        # A Mercurial repository nested in a Subversion working copy.
+        os.makedirs(os.path.join(self.path, '.svn'))
+        os.makedirs(os.path.join(self.path, 'hg', '.hg'))
+        os.makedirs(os.path.join(self.path, 'hg', 'sub', 'dir'))
+
+    def test_nearest_repository_is_detected(self):
+        """Tests that the repository nearest to the path is detected."""
+        repository = Repository(os.path.join(self.path, 'hg', 'sub', 'dir'))
+        assert_true(isinstance(repository, MercurialRepository))
+        assert_equal(repository.root_path, os.path.join(self.path, 'hg'))
+
+        repository = Repository(self.path)
+        assert_true(isinstance(repository, SubversionRepository))
+        assert_equal(repository.root_path, self.path)
+
+    def test_root_path_of_specific_implementation(self):
+        """Tests that only the markers of the implementation itself are taken
+        into account when determining its root path.
+        """
+        assert_equal(SubversionRepository.get_root_path(os.path.join(self.path, 'hg', 'sub')), self.path)
+
+    def test_removed_repository_is_not_detected(self):
+        """Tests that a memoized root path is discarded once its marker is
+        removed.
+        """
+        path = os.path.join(self.path, 'hg', 'sub')
+        assert_equal(Repository(path).root_path, os.path.join(self.path, 'hg'))
+
+        os.rmdir(os.path.join(self.path, 'hg', '.hg'))
+        repository = Repository(path)
+        assert_true(isinstance(repository, SubversionRepository))
+        assert_equal(repository.root_path, self.path)
+
+    def test_nested_repository_is_detected(self):
+        """Tests that a memoized root path is discarded once a repository is
+        created in between the path and the root.
+        """
+        path = os.path.join(self.path, 'hg', 'sub', 'dir')
+        assert_equal(Repository(path).root_path, os.path.join(self.path, 'hg'))
+
+        os.mkdir(os.path.join(self.path, 'hg', 'sub', '.svn'))
+        repository = Repository(path)
+        assert_true(isinstance(repository, SubversionRepository))
+        assert_equal(repository.root_path, os.path.join(self.path, 'hg', 'sub'))
+
+    def test_root_path_cache(self):
+        """Tests that root paths are cached on disk, and that the cache is
+        invalidated by a new repository in between the path and the root.
+        """
+        cache_path = os.path.join(self.path, 'cache.json')
+        self.addCleanup(setattr, Repository, 'ROOT_CACHE_PATH', Repository.ROOT_CACHE_PATH)
+        Repository.ROOT_CACHE_PATH = cache_path
+
+        path = os.path.join(self.path, 'hg', 'sub', 'dir')
+        assert_equal(Repository(path).root_path, os.path.join(self.path, 'hg'))
+        assert_true(os.path.exists(cache_path))
+
+        # Forget the root paths detected in this process, which forces using
+        # the cache.
+        Repository._root_paths.clear()
+        assert_equal(Repository(path).root_path, os.path.join(self.path, 'hg'))
+
+        Repository._root_paths.clear()
+        os.mkdir(os.path.join(self.path, 'hg', 'sub', '.svn'))
+        repository = Repository(path)
+        assert_true(isinstance(repository, SubversionRepository))
+        assert_equal(repository.root_path, os.path.join(self.path, 'hg', 'sub'))
+
+    def test_no_repository_raises_exception(self):
+        """Tests that detecting a repository outside any repository raises an
+        exception.
+        """
+        shutil.rmtree(os.path.join(self.path, '.svn'))
+        assert_raises(StashException, Repository, self.path)
+
 class TestRepository(StashTestCase):
 
     PATCH_NAME = __name__
@@ -54,9 +162,13 @@ class TestRepository(StashTestCase):
 
     def test_creating_patch_outside_repository_raises_exception(self):
         """Tests that creating a patch in case the current working directory
-        does not point to a repository raises an exception.
+        does not point to a repository raises an exception. A temporary
+        directory is used, since the stash directory may be located in a
+        checkout of stash itself.
         """
-        assert_raises(StashException, Stash, self.STASH_PATH)
+        path = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, path)
+        assert_raises(StashException, Stash, path)
 
     def test_creating_patch_in_subdirectory(self):
         """Tests that creating a patch from within a subdirectory of a
@@ -90,6 +202,152 @@ class TestRepository(StashTestCase):
         # The file should contain the expected changes.
         assert_equal(open(file_name, 'r').read(), '321')
 
+    def test_stash_and_apply_non_utf8_change(self):
+        """Tests that changes that are not valid UTF-8 can be stashed and
+        applied again.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        # Modify a committed file, such that it contains invalid UTF-8.
+        file_name = os.path.join(self.REPOSITORY_URI, 'a')
+        f = open(file_name, 'wb')
+        f.write(b'\xff\xfe321\n')
+        f.close()
+
+        # Create the patch, and apply it again.
+        assert_true(stash.create_patch(self.PATCH_NAME))
+        assert_equal(open(file_name, 'rb').read(), b'123')
+        assert_true(stash.apply_patch(self.PATCH_NAME))
+
+        # The file should contain the expected changes.
+        assert_equal(open(file_name, 'rb').read(), b'\xff\xfe321\n')
+
+    def test_stashing_without_changes(self):
+        """Tests that no patch is created in case there are no changes in the
+        repository.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        assert_false(stash.create_patch(self.PATCH_NAME))
+        assert_not_in(self.PATCH_NAME, stash.get_patches())
+
+    def test_stashed_patch_is_indexed(self):
+        """Tests that the origin and touched files of a stashed patch are
+        recorded in the index.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        # Modify a committed file, and create the patch.
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'w+')
+        f.write('321')
+        f.close()
+        stash.create_patch(self.PATCH_NAME)
+
+        patches = Stash.find_patches(repository=os.path.abspath(self.REPOSITORY_URI), touches='a')
+        assert_equal([patch_info.name for patch_info in patches], [self.PATCH_NAME])
+        assert_equal(patches[0].vcs, self.repository.VCS_NAME)
+        assert_true(patches[0].revision)
+
+    def test_asynchronous_queries_match_serial_queries(self):
+        """Tests that the asynchronous variants of the queries return the same
+        results as the queries themselves, whether they are executed
+        concurrently or not.
+        """
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'w+')
+        f.write('321')
+        f.close()
+        open(os.path.join(self.REPOSITORY_URI, 'd'), 'w').close()
+
+        # Diff headers may contain the time the diff was generated.
+        def strip_dates(diff):
+            return re.sub(r'\t.*', '', diff)
+
+        diff, status, revision = strip_dates(self.repository.diff()), self.repository.status(), self.repository.get_revision()
+        for max_workers in [0, 2]:
+            self.repository.MAX_WORKERS = max_workers
+            try:
+                futures = [self.repository.diff_async(), self.repository.status_async(), self.repository.get_revision_async()]
+                assert_equal(strip_dates(futures[0].result()), diff)
+                assert_equal(futures[1].result(), status)
+                assert_equal(futures[2].result(), revision)
+            finally:
+                del self.repository.MAX_WORKERS
+                self.repository.close()
+
+    def test_watched_queries_match_unwatched_queries(self):
+        """Tests that queries on a watched working copy return the same results
+        as queries on the complete working copy, also after changes that only
+        affect the state of the version control system.
+        """
+        def strip_dates(diff):
+            return re.sub(r'\t.*', '', diff)
+
+        def query(repository):
+            return strip_dates(repository.diff()), repository.status(), repository.get_changes()
+
+        watched = Repository(self.REPOSITORY_URI)
+        self.addCleanup(watched.close)
+        watched.watch()
+        assert_equal(query(watched), query(self.repository))
+
+        self._write('a', '321')
+        os.mkdir(os.path.join(self.REPOSITORY_URI, 'e'))
+        self._write(os.path.join('e', 'f'), '321')
+        assert_equal(query(watched), query(self.repository))
+
+        self.repository.add([os.path.join('e', 'f')])
+        self.repository.remove(['b'])
+        assert_equal(query(watched), query(self.repository))
+
+        watched.revert_all()
+        assert_equal(query(watched), query(self.repository))
+
+    def test_stashing_is_traced(self):
+        """Tests that the stash operation and the commands it executes are
+        recorded in case tracing is enabled.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'w+')
+        f.write('321')
+        f.close()
+
+        tracer = trace.enable()
+        try:
+            stash.create_patch(self.PATCH_NAME)
+        finally:
+            trace.disable()
+
+        assert_in('Stash.create_patch', [event.name for event in tracer.events if event.category == 'operation'])
+        commands = [event for event in tracer.events if event.category != 'operation']
+        assert_true(commands)
+        for event in commands:
+            assert_equal(event.details['exit_code'], 0)
+        diff_size = sum(event.details['output_bytes'] for event in commands if ' diff' in event.name)
+        assert_equal(diff_size, os.path.getsize(Stash._get_store().get_path(self.PATCH_NAME)))
+
+    def test_stash_and_apply_compressed_change(self):
+        """Tests that patches can be stored compressed, and are decompressed
+        transparently when showing and applying them.
+        """
+        Stash.CODEC = 'gzip'
+        self.addCleanup(setattr, Stash, 'CODEC', 'none')
+        stash = Stash(self.REPOSITORY_URI)
+
+        # Modify a committed file, and create the patch.
+        file_name = os.path.join(self.REPOSITORY_URI, 'a')
+        f = open(file_name, 'w+')
+        f.write('321')
+        f.close()
+        stash.create_patch(self.PATCH_NAME)
+
+        # The patch should be stored compressed.
+        assert_equal(open(Stash._get_store().get_path(self.PATCH_NAME), 'rb').read(2), b'\x1f\x8b')
+        assert_in('+321', stash.get_patch(self.PATCH_NAME))
+
+        assert_true(stash.apply_patch(self.PATCH_NAME))
+        assert_equal(open(file_name, 'r').read(), '321')
+
     def test_stash_and_apply_conflicting_change(self):
         """Test that applying a conflicting patch results in a merged file.
         """
@@ -124,6 +382,142 @@ class TestRepository(StashTestCase):
         # should still be present.
         assert_in(self.PATCH_NAME, stash.get_patches())
 
+    def test_checking_patches(self):
+        """Tests that checking whether patches and snapshots apply reports the
+        outcome per file, without modifying the working copy.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+        for file_name in ['a', 'b', 'c']:
+            f = open(os.path.join(self.REPOSITORY_URI, file_name), 'w+')
+            f.write('321')
+            f.close()
+            stash.FORMAT = 'snapshot' if file_name == 'c' else 'patch'
+            assert_true(stash.create_patch(self.PATCH_NAME + file_name))
+
+        # Make the first patch conflict.
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'w+')
+        f.write('456')
+        f.close()
+
+        for processes in [1, 2]:
+            stash.CHECK_PROCESSES = processes
+            results = stash.check_patches()
+            assert_equal([(patch_name, [(file_result.new_name, file_result.status) for file_result in result.files])
+                          for patch_name, result in results],
+                         [(self.PATCH_NAME + 'a', [('a', HunkStatus.Conflict)]),
+                          (self.PATCH_NAME + 'b', [('b', HunkStatus.Applied)]),
+                          (self.PATCH_NAME + 'c', [('c', HunkStatus.Applied)])])
+
+        assert_equal([patch_name for patch_name, _ in stash.check_patches([self.PATCH_NAME + 'b'])], [self.PATCH_NAME + 'b'])
+        assert_raises(StashException, stash.check_patches, ['missing'])
+
+        # Nothing has been modified.
+        assert_equal(len(stash.get_patches()), 3)
+        assert_equal(stash.repository.get_changes(), [(FileChange.Modified, 'a')])
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a')).read(), '456')
+
+    def test_patch_states(self):
+        """Tests that the state of patches relative to the working copy is
+        determined from the recorded contents of the files they touch.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+        self._write('a', '321')
+        stash.create_patch(self.PATCH_NAME + 'a')
+        self._write('b', '321')
+        self._write('d', '321')
+        stash.repository.add(['d'])
+        stash.create_patch(self.PATCH_NAME + 'b')
+        stash.FORMAT = 'snapshot'
+        self._write('c', '321')
+        stash.create_patch(self.PATCH_NAME + 'c')
+
+        assert_equal(stash.get_patch_states(), [(self.PATCH_NAME + 'a', PatchState.AppliesExactly),
+                                                (self.PATCH_NAME + 'b', PatchState.AppliesExactly),
+                                                (self.PATCH_NAME + 'c', PatchState.AppliesExactly)])
+
+        # Modifying a touched file, or creating a file that the patch adds,
+        # requires the patch to be merged.
+        self._write('a', '456')
+        self._write('d', '456')
+        assert_equal(stash.get_patch_states(), [(self.PATCH_NAME + 'a', PatchState.NeedsMerge),
+                                                (self.PATCH_NAME + 'b', PatchState.NeedsMerge),
+                                                (self.PATCH_NAME + 'c', PatchState.AppliesExactly)])
+        self._write('a', '123')
+        os.unlink(os.path.join(self.REPOSITORY_URI, 'd'))
+        assert_equal(stash.get_patch_states([self.PATCH_NAME + 'b', self.PATCH_NAME + 'a']),
+                     [(self.PATCH_NAME + 'b', PatchState.AppliesExactly), (self.PATCH_NAME + 'a', PatchState.AppliesExactly)])
+
+        # Patches without recorded contents have no known base.
+        self._store_patch('copied', open(Stash._get_store().get_path(self.PATCH_NAME + 'a'), 'rb').read())
+        assert_equal(stash.get_patch_states(['copied']), [('copied', PatchState.BaseMissing)])
+        assert_raises(StashException, stash.get_patch_states, ['missing'])
+
+    def _write(self, file_name, contents):
+        """Writes *contents* to the file *file_name* in the repository."""
+        f = open(os.path.join(self.REPOSITORY_URI, file_name), 'w')
+        f.write(contents)
+        f.close()
+
+    def _read(self, file_name):
+        """Returns the contents of the file *file_name* in the repository."""
+        return open(os.path.join(self.REPOSITORY_URI, file_name)).read()
+
+    def test_applying_patch_series(self):
+        """Tests that a series of patches is applied in order, including
+        added and removed files.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+        self._write('a', '321')
+        stash.create_patch(self.PATCH_NAME + '1')
+        self._write('b', '321')
+        self._write('d', '321')
+        stash.repository.add(['d'])
+        stash.create_patch(self.PATCH_NAME + '2')
+        stash.repository.remove(['c'])
+        stash.create_patch(self.PATCH_NAME + '3')
+
+        assert_equal(stash.apply_patches([self.PATCH_NAME + '1', self.PATCH_NAME + '2', self.PATCH_NAME + '3']), None)
+        assert_equal(stash.get_patches(), [])
+        assert_equal(stash.repository.get_changes(),
+                     [(FileChange.Modified, 'a'), (FileChange.Modified, 'b'), (FileChange.Added, 'd'), (FileChange.Removed, 'c')])
+        assert_equal([self._read('a'), self._read('b'), self._read('d')], ['321', '321', '321'])
+
+    def test_failing_patch_series_is_rolled_back(self):
+        """Tests that the working copy is restored in case a patch in a series
+        does not apply, and that all patches are kept.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+        self._write('a', '321')
+        stash.create_patch(self.PATCH_NAME + '1')
+        self._write('d', '321')
+        stash.repository.add(['d'])
+        stash.create_patch(self.PATCH_NAME + '2')
+        self._write('b', '321')
+        stash.create_patch(self.PATCH_NAME + '3')
+
+        # Make the last patch conflict.
+        self._write('b', '456')
+
+        patch_names = [self.PATCH_NAME + '1', self.PATCH_NAME + '2', self.PATCH_NAME + '3']
+        assert_equal(stash.apply_patches(patch_names), self.PATCH_NAME + '3')
+        assert_equal(stash.get_patches(), patch_names)
+        assert_equal(stash.repository.get_changes(), [(FileChange.Modified, 'b')])
+        assert_equal([self._read('a'), self._read('b')], ['123', '456'])
+        assert_false(os.path.exists(os.path.join(self.REPOSITORY_URI, 'd')))
+
+    def test_patch_series_with_unknown_files_is_refused(self):
+        """Tests that a series is not applied in case the files touched by one
+        of its patches are unknown, since it could not be rolled back.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+        self._write('a', '321')
+        stash.create_patch(self.PATCH_NAME)
+        self._store_patch('unknown', 'not a diff\n')
+
+        assert_raises(StashException, stash.apply_patches, [self.PATCH_NAME, 'unknown'])
+        assert_equal(stash.get_patches(), [self.PATCH_NAME, 'unknown'])
+        assert_equal(self._read('a'), '123')
+
     def test_stashing_added_file(self):
         """Test that stashing an added file will remove it, and again recreate
         it when applying the patch.
@@ -153,6 +547,73 @@ class TestRepository(StashTestCase):
         # The patch applied cleanly, so it should no longer exist.
         assert_not_in(self.PATCH_NAME, stash.get_patches())
 
+    def test_stashing_selected_paths(self):
+        """Tests that only the changes to the selected files and directories
+        are stashed and reverted, and that other changes are left untouched.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        # Modify two committed files, and add a file to the subdirectory.
+        for file_name in ['a', 'b', os.path.join(self.SUB_DIRECTORY_NAME, 'd')]:
+            f = open(os.path.join(self.REPOSITORY_URI, file_name), 'w+')
+            f.write('321')
+            f.close()
+        stash.repository.add([os.path.join(self.SUB_DIRECTORY_NAME, 'd')])
+
+        assert_true(stash.create_patch(self.PATCH_NAME, ['a', self.SUB_DIRECTORY_NAME]))
+        assert_equal(Stash.find_patches()[0].name, self.PATCH_NAME)
+        assert_equal([file_name for file_name, _, _, _ in Stash.get_patch_stat(self.PATCH_NAME)],
+                     ['a', os.path.join(self.SUB_DIRECTORY_NAME, 'd')])
+
+        # The selected changes have been reverted, the other change is kept.
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a')).read(), '123')
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'b')).read(), '321')
+        assert_false(os.path.exists(os.path.join(self.REPOSITORY_URI, self.SUB_DIRECTORY_NAME, 'd')))
+
+        assert_true(stash.apply_patch(self.PATCH_NAME))
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a')).read(), '321')
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, self.SUB_DIRECTORY_NAME, 'd')).read(), '321')
+
+    def test_stashing_unchanged_paths(self):
+        """Tests that no patch is created in case the selected paths are not
+        changed, and that paths outside the repository are rejected.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'w+')
+        f.write('321')
+        f.close()
+
+        assert_false(stash.create_patch(self.PATCH_NAME, ['b']))
+        assert_not_in(self.PATCH_NAME, stash.get_patches())
+        assert_raises(StashException, stash.create_patch, self.PATCH_NAME, [os.path.join(os.pardir, 'a')])
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a')).read(), '321')
+
+    def test_stashing_added_files_with_spaces(self):
+        """Test that several added files with spaces in their names are
+        stashed and added again when applying the patch.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        # Create new files, and add them to the repository.
+        file_names = ['d e', 'f g', 'h@i']
+        for file_name in file_names:
+            f = open(os.path.join(self.REPOSITORY_URI, file_name), 'w+')
+            f.write('123\n')
+            f.close()
+        stash.repository.add(file_names)
+
+        # Create the patch, all added files should no longer exist.
+        stash.create_patch(self.PATCH_NAME)
+        for file_name in file_names:
+            assert_false(os.path.exists(os.path.join(self.REPOSITORY_URI, file_name)))
+
+        # Apply the patch, all files should have been added again.
+        assert_true(stash.apply_patch(self.PATCH_NAME))
+        assert_equal(stash.repository.status(file_names), set())
+        for file_name in file_names:
+            assert_true(os.path.exists(os.path.join(self.REPOSITORY_URI, file_name)))
+
     def test_stashing_removed_file(self):
         """Test that stashing a removed file will recreate it, and again remove
         it when applying the patch.
@@ -181,6 +642,60 @@ class TestRepository(StashTestCase):
         # The patch applied cleanly, so it should no longer exist.
         assert_not_in(self.PATCH_NAME, stash.get_patches())
 
+    def test_stash_and_restore_snapshot(self):
+        """Tests that modified, added and removed files are stashed as a
+        snapshot, and restored exactly.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+        stash.FORMAT = 'snapshot'
+
+        # Modify a file with binary data, add a file and remove a file.
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'wb')
+        f.write(b'\x00\r\n\xff')
+        f.close()
+        os.mkdir(os.path.join(self.REPOSITORY_URI, 'new'))
+        f = open(os.path.join(self.REPOSITORY_URI, 'new', 'd'), 'w')
+        f.write('456')
+        f.close()
+        stash.repository.add([os.path.join('new', 'd')])
+        stash.repository.remove(['b'])
+        changes = stash.repository.get_changes()
+        assert_equal(changes, [(FileChange.Modified, 'a'), (FileChange.Added, os.path.join('new', 'd')), (FileChange.Removed, 'b')])
+
+        assert_true(stash.create_patch(self.PATCH_NAME))
+        assert_equal(stash.repository.get_changes(), [])
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a'), 'rb').read(), b'123')
+        assert_true(os.path.exists(os.path.join(self.REPOSITORY_URI, 'b')))
+        assert_false(os.path.exists(os.path.join(self.REPOSITORY_URI, 'new', 'd')))
+
+        assert_equal(Stash.get_patch(self.PATCH_NAME), 'M a\nA %s\nR b\n' % os.path.join('new', 'd'))
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(touches='new')], [self.PATCH_NAME])
+
+        assert_true(stash.apply_patch(self.PATCH_NAME))
+        assert_not_in(self.PATCH_NAME, stash.get_patches())
+        assert_equal(stash.repository.get_changes(), changes)
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a'), 'rb').read(), b'\x00\r\n\xff')
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'new', 'd')).read(), '456')
+
+    def test_restoring_snapshot_over_local_changes_raises_exception(self):
+        """Tests that a snapshot is not restored over local changes, and that
+        it is kept in that case.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+        stash.FORMAT = 'snapshot'
+
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'w')
+        f.write('321')
+        f.close()
+        assert_true(stash.create_patch(self.PATCH_NAME))
+
+        f = open(os.path.join(self.REPOSITORY_URI, 'a'), 'w')
+        f.write('456')
+        f.close()
+        assert_raises(StashException, stash.apply_patch, self.PATCH_NAME)
+        assert_in(self.PATCH_NAME, stash.get_patches())
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a')).read(), '456')
+
     def test_stashing_existing_patch_raises_exception(self):
         """Test that stashing an already existing patch raises an exception."""
         stash = Stash(self.REPOSITORY_URI)
@@ -219,3 +734,138 @@ class TestSubversionRepository(TestRepository):
         self.repository = SubversionRepository(self.REPOSITORY_URI, create=True)
 
         super(TestSubversionRepository, self).setUp()
+
+class TestGitRepository(TestRepository):
+
+    # Make sure to execute this test case.
+    __test__ = True
+
+    @classmethod
+    def setUpClass(cls):
+        """Moves the repository and the patches out of the source tree, since a
+        Git repository would otherwise be detected in the tests directory.
+        """
+        cls.SANDBOX_PATH = os.path.realpath(tempfile.mkdtemp())
+        cls.REPOSITORY_URI = os.path.join(cls.SANDBOX_PATH, 'repo')
+        cls.STASH_PATH = os.path.join(cls.SANDBOX_PATH, 'stash')
+
+        super(TestGitRepository, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestGitRepository, cls).tearDownClass()
+
+        shutil.rmtree(cls.SANDBOX_PATH)
+
+    def setUp(self):
+        # Initialize a Git repository in the repository directory.
+        self.repository = GitRepository(self.REPOSITORY_URI, create=True)
+
+        super(TestGitRepository, self).setUp()
+
+    def test_stash_and_apply_conflicting_change(self):
+        """Test that applying a conflicting patch results in a file merged by
+        Git, using the contents the patch is based on.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        file_name = os.path.join(self.REPOSITORY_URI, 'a')
+        with open(file_name, 'w') as f:
+            f.write('321\n')
+        stash.create_patch(self.PATCH_NAME)
+        assert_equal(open(file_name, 'r').read(), '123')
+
+        with open(file_name, 'w') as f:
+            f.write('456\n')
+        assert_false(stash.apply_patch(self.PATCH_NAME))
+        assert_equal(open(file_name, 'r').read(), '<<<<<<< ours\n456\n=======\n321\n>>>>>>> theirs\n')
+
+        # Since the patch did not apply cleanly, the patch should still be
+        # present.
+        assert_in(self.PATCH_NAME, stash.get_patches())
+
+    def test_binary_changes_are_stashed(self):
+        """Tests that changes to binary files survive stashing and applying."""
+        stash = Stash(self.REPOSITORY_URI)
+
+        data = bytes(range(256))
+        with open(os.path.join(self.REPOSITORY_URI, 'a'), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(self.REPOSITORY_URI, 'd'), 'wb') as f:
+            f.write(data)
+        self.repository.add(['d'])
+
+        stash.create_patch(self.PATCH_NAME)
+        assert_false(os.path.exists(os.path.join(self.REPOSITORY_URI, 'd')))
+        assert_equal(self.repository.get_changes(), [])
+
+        assert_true(stash.apply_patch(self.PATCH_NAME))
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'a'), 'rb').read(), data)
+        assert_equal(open(os.path.join(self.REPOSITORY_URI, 'd'), 'rb').read(), data)
+        assert_equal(self.repository.get_changes(), [(FileChange.Modified, 'a'), (FileChange.Added, 'd')])
+
+    def test_non_ascii_file_names_are_stashed(self):
+        """Tests that changes to files with non-ASCII names, which Git quotes
+        by default, are stashed and applied.
+        """
+        stash = Stash(self.REPOSITORY_URI)
+
+        file_name = os.path.join(self.REPOSITORY_URI, 'caf\u00e9')
+        with open(file_name, 'w') as f:
+            f.write('1\n')
+        self.repository.add(['caf\u00e9'])
+        self.repository.commit('Add file.')
+
+        with open(file_name, 'w') as f:
+            f.write('2\n')
+        stash.create_patch(self.PATCH_NAME)
+        assert_equal(open(file_name).read(), '1\n')
+        assert_equal(self.repository.get_changes(), [])
+
+        assert_true(stash.apply_patch(self.PATCH_NAME))
+        assert_equal(open(file_name).read(), '2\n')
+        assert_equal(self.repository.get_changes(), [(FileChange.Modified, 'caf\u00e9')])
+
+    def test_compressed_patch_falls_back_to_applier(self):
+        """Tests that a compressed patch Git refuses to apply, is applied by
+        the generic applier using fuzz.
+        """
+        file_name = os.path.join(self.REPOSITORY_URI, 'f')
+        with open(file_name, 'w') as f:
+            f.write(''.join('%d\n' % i for i in range(1, 11)))
+        self.repository.add(['f'])
+        self.repository.commit('Add file.')
+
+        # Without blob information Git can not merge the patch, and since the
+        # first context line changed, it does not apply exactly either.
+        with open(file_name, 'w') as f:
+            f.write(''.join('%s\n' % line for line in ['1', '2', 'three', '4', '5', '6', '7', '8', '9', '10']))
+        patch_path = os.path.join(self.SANDBOX_PATH, 'patch.gz')
+        self.addCleanup(os.unlink, patch_path)
+        with gzip.open(patch_path, 'wb') as patch_file:
+            patch_file.write(b'--- a/f\n+++ b/f\n@@ -3,5 +3,5 @@\n 3\n 4\n-5\n+five\n 6\n 7\n')
+
+        assert_true(self.repository.apply_patch(patch_path).succeeded)
+        assert_equal(open(file_name).read(), '1\n2\nthree\n4\nfive\n6\n7\n8\n9\n10\n')
+
+class TestMercurialCommandServerRepository(TestMercurialRepository):
+
+    # Make sure to execute this test case.
+    __test__ = True
+
+    def setUp(self):
+        # Execute all Mercurial commands using a command server.
+        MercurialRepository.USE_COMMAND_SERVER = True
+
+        super(TestMercurialCommandServerRepository, self).setUp()
+
+    def tearDown(self):
+        self.repository.close()
+        MercurialRepository.USE_COMMAND_SERVER = False
+
+        super(TestMercurialCommandServerRepository, self).tearDown()
+
+    def test_command_server_is_used(self):
+        """Tests that commands are executed by a command server."""
+        self.repository.status()
+        assert_true(self.repository._command_server)
@@ -0,0 +1,59 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+from nose.tools import assert_equal, assert_in, assert_is_none
+
+from stash import client
+from stash.server import StashServer
+from stash.test_case import StashTestCase
+
+class TestServer(StashTestCase):
+
+    def setUp(self):
+        """Starts a stash server in a separate thread, and creates the patches
+        a and b.
+        """
+        for patch_name in ['a', 'b']:
+            open(os.path.join(self.STASH_PATH, patch_name), 'w').write(patch_name.upper())
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.socket_path = os.path.join(path, 'socket')
+
+        server = StashServer(self.socket_path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+
+    def _run(self, argv):
+        """Lets the server execute the command *argv*, and returns a tuple
+        containing the exit status, the output and the error output.
+        """
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        return_code = client.run(argv, self.socket_path, io.BytesIO(), stdout, stderr)
+        return return_code, stdout.getvalue(), stderr.getvalue()
+
+    def test_commands_are_executed_by_server(self):
+        """Tests that the output of commands is sent to the client."""
+        assert_equal(self._run(['-l']), (0, b'a\nb\n', b''))
+        assert_equal(self._run(['-s', 'b']), (0, b'B', b''))
+        assert_equal(self._run(['-r', 'a']), (0, b"Patch 'a' successfully removed.\n", b''))
+        assert_equal(self._run(['-l']), (0, b'b\n', b''))
+
+    def test_invalid_arguments(self):
+        """Tests that the exit status of the argument parser is passed on to
+        the client, and that the server keeps serving afterwards.
+        """
+        return_code, _, error_output = self._run(['--invalid'])
+        assert_equal(return_code, 2)
+        assert_in(b'unrecognized arguments', error_output)
+        assert_equal(self._run(['-l'])[0], 0)
+
+    def test_without_server(self):
+        """Tests that the client indicates that no server is running."""
+        assert_is_none(client.run(['-l'], self.socket_path + '.missing'))
@@ -0,0 +1,34 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from nose.tools import assert_equal, assert_true
+
+from stash.snapshot import copy_file
+
+class TestCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_copy_file_keeps_contents_and_mode(self):
+        """Tests that copying a file keeps its contents and mode."""
+        source = os.path.join(self.path, 'source')
+        with open(source, 'wb') as f:
+            f.write(b'\x00\r\n' * 100000)
+        os.chmod(source, 0o750)
+
+        copy_file(source, os.path.join(self.path, 'target'))
+        assert_equal(open(os.path.join(self.path, 'target'), 'rb').read(), b'\x00\r\n' * 100000)
+        assert_equal(stat.S_IMODE(os.stat(os.path.join(self.path, 'target')).st_mode), 0o750)
+
+    def test_copy_symbolic_link(self):
+        """Tests that a symbolic link is copied as a link."""
+        os.symlink('missing', os.path.join(self.path, 'source'))
+
+        copy_file(os.path.join(self.path, 'source'), os.path.join(self.path, 'target'))
+        assert_true(os.path.islink(os.path.join(self.path, 'target')))
+        assert_equal(os.readlink(os.path.join(self.path, 'target')), 'missing')
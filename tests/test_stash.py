@@ -1,6 +1,8 @@
+import hashlib
+import io
 import os
 
-from nose.tools import assert_equal, assert_raises
+from nose.tools import assert_equal, assert_false, assert_is_none, assert_raises, assert_true
 
 from stash.exception import StashException
 from stash.stash import Stash
@@ -45,3 +47,195 @@ class TestStash(StashTestCase):
     def test_getting_non_existent_patch_raises_exception(self):
         """Tests that showing a non existent patch raises an exception."""
         assert_raises(StashException, Stash.get_patch, 'd')
+
+    def test_get_patches_ignores_index(self):
+        """Tests that the patch index is not listed as a patch."""
+        Stash.find_patches()
+        assert_equal(Stash.get_patches(), ['a', 'b', 'c'])
+
+    def test_find_patches(self):
+        """Tests that patches can be listed and filtered using the index,
+        including patches that were added to the stash directly.
+        """
+        assert_equal([patch_info.name for patch_info in Stash.find_patches()], ['a', 'b', 'c'])
+
+        # Add a patch touching a file in a subdirectory.
+        self._store_patch('d', '--- a/sub/e\n+++ b/sub/e\n@@ -1,1 +1,1 @@\n-1\n+2\n')
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(touches='sub')], ['d'])
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(touches='sub/e')], ['d'])
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(touches='su')], [])
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(sort='size')], ['a', 'b', 'c', 'd'])
+
+        # Patches of unknown origin do not match any repository.
+        assert_equal(Stash.find_patches(repository='/'), [])
+        assert_is_none(Stash.find_patches()[0].repository)
+
+    def test_find_patches_in_namespace(self):
+        """Tests that listing a namespace only indexes and lists the patches in
+        that namespace, without forgetting the patches outside of it.
+        """
+        Stash.find_patches()
+        store = Stash._get_store()
+        for patch_name in ['repo/d', 'repo/sub/e', 'other/f']:
+            os.makedirs(os.path.dirname(store.get_path(patch_name)), exist_ok=True)
+            open(store.get_path(patch_name), 'w').write(patch_name)
+        assert_true(Stash.has_patch('repo/d'))
+        assert_false(Stash.has_patch('repo/f'))
+
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(namespace='repo')], ['repo/d', 'repo/sub/e'])
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(namespace='repo/sub')], ['repo/sub/e'])
+        assert_equal([patch_info.name for patch_info in Stash.find_patches()], ['a', 'b', 'c', 'other/f', 'repo/d', 'repo/sub/e'])
+        assert_raises(StashException, Stash.find_patches, namespace='.repo')
+
+    def test_removing_patch_updates_index(self):
+        """Tests that removed patches are no longer found using the index."""
+        Stash.find_patches()
+        Stash.remove_patch('b')
+        assert_equal([patch_info.name for patch_info in Stash.find_patches()], ['a', 'c'])
+
+    def test_patch_removed_while_indexing(self):
+        """Tests that a patch removed by another process after the stash was
+        listed, is left out of the index.
+        """
+        Stash.find_patches()
+        patch_names = Stash.get_patches()
+        os.unlink(Stash._get_store().get_path('a'))
+        os.unlink(Stash._get_store().get_path('c'))
+
+        index = Stash._get_index()
+        try:
+            index.synchronize(patch_names + ['d'])
+            assert_equal([patch_info.name for patch_info in index.find()], ['b'])
+        finally:
+            index.close()
+
+    def test_rebuild_index(self):
+        """Tests that the index can be rebuilt from the stashed patches."""
+        Stash.rebuild_index()
+        assert_equal([patch_info.name for patch_info in Stash.find_patches()], ['a', 'b', 'c'])
+
+    def test_hashing_files_uses_cache(self):
+        """Tests that file hashes are cached until the size, modification time
+        or inode of a file changes, and that missing files have no hash.
+        """
+        index = Stash._get_index()
+        try:
+            file_name = Stash._get_store().get_path('a')
+            os.utime(file_name, (1, 1))
+            digest = index.hash_files([file_name])[0]
+            assert_equal(digest, hashlib.sha1(b'A').hexdigest())
+
+            # Contents that change without the file appearing changed are not
+            # noticed.
+            open(file_name, 'w').write('B')
+            os.utime(file_name, (1, 1))
+            assert_equal(index.hash_files([file_name]), [digest])
+
+            os.utime(file_name, (2, 2))
+            assert_equal(index.hash_files([file_name, os.path.join(self.STASH_PATH, 'missing')]),
+                         [hashlib.sha1(b'B').hexdigest(), None])
+        finally:
+            index.close()
+
+    def test_recompress(self):
+        """Tests that patches can be recompressed, and are transparently
+        decompressed again.
+        """
+        assert_equal(Stash.recompress('bz2'), ['a', 'b', 'c'])
+        assert_equal(open(Stash._get_store().get_path('a'), 'rb').read(3), b'BZh')
+        assert_equal(Stash.get_patch('a'), 'A')
+        assert_equal([patch_info.codec for patch_info in Stash.find_patches()], ['bz2', 'bz2', 'bz2'])
+
+        # Recompressing to the same codec does not touch any patches.
+        assert_equal(Stash.recompress('bz2'), [])
+
+        assert_equal(Stash.recompress('none'), ['a', 'b', 'c'])
+        assert_equal(open(Stash._get_store().get_path('a'), 'rb').read(), b'A')
+
+    def test_recompress_with_unsupported_codec_raises_exception(self):
+        """Tests that recompressing using an unknown codec raises an exception."""
+        assert_raises(StashException, Stash.recompress, 'zip')
+
+    def test_write_patch(self):
+        """Tests that the contents of a patch can be written to a file."""
+        output = io.BytesIO()
+        Stash.write_patch('a', output)
+        assert_equal(output.getvalue(), b'A')
+
+        # Compressed patches are written decompressed.
+        Stash.recompress('gzip')
+        output = io.BytesIO()
+        Stash.write_patch('b', output)
+        assert_equal(output.getvalue(), b'B')
+
+    def test_write_patch_filtered_by_path(self):
+        """Tests that only the changes to the requested paths are written."""
+        sub_patch = b'diff -r 0 sub/e\n--- a/sub/e\n+++ b/sub/e\n@@ -1,1 +1,1 @@\n-1\n+2\n'
+        other_patch = b'diff -r 0 f\n--- a/f\n+++ b/f\n@@ -1,1 +1,2 @@\n 1\n+2\n'
+        self._store_patch('d', other_patch + sub_patch)
+
+        output = io.BytesIO()
+        Stash.write_patch('d', output, ['sub/'])
+        assert_equal(output.getvalue(), sub_patch)
+
+    def test_get_patch_stat(self):
+        """Tests that the number of added and removed lines is determined per
+        file.
+        """
+        self._store_patch('d', b'--- a/e\n+++ b/e\n@@ -1,2 +1,2 @@\n-1\n+2\n+3\n-4\n'
+                                                              b'--- a/f\n+++ b/f\n@@ -1,1 +1,2 @@\n 1\n+2\n')
+        assert_equal(Stash.get_patch_stat('d'), [('e', 2, 2, False), ('f', 1, 0, False)])
+        assert_equal(Stash.get_patch_stat('d', ['f']), [('f', 1, 0, False)])
+
+    def test_grep_patches(self):
+        """Tests that the changed lines of all patches are searched, and that
+        only matching hunks in files matching the file pattern are returned.
+        """
+        self._store_patch('d', b'--- a/e.py\n+++ b/e.py\n@@ -1,1 +1,1 @@\n-x = 1\n+x = FooService.handle(1)\n'
+                                                              b'@@ -10,1 +10,1 @@\n-y = 1\n+y = 2\n'
+                                                              b'--- a/f.c\n+++ b/f.c\n@@ -1,1 +1,2 @@\n 1\n+FooService.handle();\n')
+        self._store_patch('e', b'--- a/g.py\n+++ b/g.py\n@@ -1,2 +1,1 @@\n FooService\n-handle\n')
+
+        matches = Stash.grep_patches(r'FooService\.handle')
+        assert_equal([(patch_name, file_name, hunk.old_start) for patch_name, file_name, hunk in matches],
+                     [('d', 'e.py', 1), ('d', 'f.c', 1)])
+        assert_equal([file_name for _, file_name, _ in Stash.grep_patches('Service.hand', '*.py')], ['e.py'])
+        assert_equal([patch_name for patch_name, _, _ in Stash.grep_patches('^handle$')], ['e'])
+        assert_equal(Stash.grep_patches('Missing'), [])
+        assert_raises(StashException, Stash.grep_patches, '(')
+
+        # Removed patches are no longer found.
+        Stash.remove_patch('d')
+        assert_equal(Stash.grep_patches('FooService'), [])
+
+    def test_grep_patches_with_escapes_and_flags(self):
+        """Tests that escapes with a payload and flags changing the meaning of
+        literal text do not cause matching patches to be skipped.
+        """
+        self._store_patch('d', b'--- a/e\n+++ b/e\n@@ -1,1 +1,1 @@\n-Abc_def\n+foobar\n')
+        for pattern in [r'\x41bc_def', r'\101bc_def', r'\u0041bc_def', r'\N{LATIN CAPITAL LETTER A}bc_def', r'foo\142ar',
+                        '(?x) foo bar', '(?i)FOOBAR']:
+            assert_equal([patch_name for patch_name, _, _ in Stash.grep_patches(pattern)], ['d'])
+
+    def test_index_narrows_down_search(self):
+        """Tests that the index only selects patches containing the words of a
+        search pattern, taking into account whether a word may be part of a
+        longer token.
+        """
+        self._store_patch('d', b'--- a/e\n+++ b/e\n@@ -1,1 +1,1 @@\n-old\n+MyFooService.handler()\n')
+        self._store_patch('e', b'--- a/e\n+++ b/e\n@@ -1,2 +1,1 @@\n FooService\n-handle\n')
+        Stash.find_patches()
+        index = Stash._get_index()
+        try:
+            assert_equal(index.search(r'FooService\.handle'), ['d'])
+            assert_equal(index.search(r'\.handle\('), ['e'])
+            assert_equal(index.search(r'\.handler\('), ['d'])
+            assert_equal(index.search('ooServ'), ['d'])
+            assert_equal(index.search('old|new'), ['a', 'b', 'c', 'd', 'e'])
+            assert_equal(index.search('old', 'f*'), [])
+        finally:
+            index.close()
+
+    def test_writing_non_existent_patch_raises_exception(self):
+        """Tests that showing a non existent patch raises an exception."""
+        assert_raises(StashException, Stash.write_patch, 'd', io.BytesIO())
@@ -0,0 +1,373 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from concurrent.futures import ProcessPoolExecutor
+
+from nose.tools import assert_equal, assert_false, assert_in, assert_raises, assert_true
+
+from stash.exception import StashException
+from stash.repository import GitRepository
+from stash.stash import Stash
+from stash.store import HttpPatchStore, PatchStore, _pool, is_patch_name
+from stash.storeserver import PatchStoreServer
+
+def _get_contents(writer, iteration):
+    """Returns the contents of a patch written by *writer*, which can be
+    verified to be complete using :py:func:`_is_complete`.
+    """
+    line = ('%d %d\n' % (writer, iteration)).encode()
+    return line * (1000 + 100 * iteration)
+
+def _is_complete(contents):
+    """Returns whether *contents* were written completely by
+    :py:func:`_get_contents`.
+    """
+    lines = contents.splitlines(True)
+    writer, iteration = [int(field) for field in lines[0].split()]
+    return contents == _get_contents(writer, iteration)
+
+def _write_and_read_patches(stash_path, worker, iterations):
+    """Alternately overwrites, reads and removes a few patches in the stash at
+    *stash_path*. Returns a list of errors.
+    """
+    Stash.STASH_PATH = stash_path
+    store = Stash._get_store()
+    errors = []
+    for iteration in range(iterations):
+        patch_name = 'p%d' % (iteration % 3)
+        try:
+            if worker % 3 == 0:
+                with store.lock([patch_name]):
+                    temp_path = store.create_temp_path()
+                    with open(temp_path, 'wb') as patch_file:
+                        patch_file.write(_get_contents(worker, iteration))
+                    store.publish(temp_path, patch_name, overwrite=True)
+            elif worker % 3 == 1:
+                if not _is_complete(Stash.get_patch(patch_name).encode()):
+                    errors.append('incomplete patch %s' % patch_name)
+            elif iteration % 10 == 0:
+                Stash.remove_patch(patch_name)
+        except StashException:
+            # The patch does not exist (anymore).
+            pass
+        except Exception as e:
+            errors.append(repr(e))
+    return errors
+
+def _apply_patches(stash_path, repository_path, patch_names):
+    """Tries to apply all *patch_names* in the stash at *stash_path* to the
+    repository at *repository_path*. Returns the names of the patches that
+    were applied.
+    """
+    Stash.STASH_PATH = stash_path
+    stash = Stash(repository_path)
+    applied = []
+    for patch_name in patch_names:
+        try:
+            if stash.apply_patch(patch_name):
+                applied.append(patch_name)
+        except StashException:
+            # Another process applied the patch.
+            pass
+    return applied
+
+class TestPatchStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.store = PatchStore(self.path)
+
+    def _publish(self, patch_name, contents):
+        """Stores a patch named *patch_name* containing *contents*."""
+        with self.store.lock([patch_name]):
+            temp_path = self.store.create_temp_path()
+            with open(temp_path, 'wb') as patch_file:
+                patch_file.write(contents)
+            self.store.publish(temp_path, patch_name)
+
+    def test_patch_names(self):
+        """Tests which names are valid patch names."""
+        for patch_name in ['a', 'repo/a', 'repo/sub/a.patch']:
+            assert_true(is_patch_name(patch_name))
+        for patch_name in ['', '.a', 'repo/', '/a', 'repo//a', 'repo/.a', '.repo/a']:
+            assert_false(is_patch_name(patch_name))
+
+    def test_listing_is_scoped_to_namespace(self):
+        """Tests that listing a namespace only lists the patches in that
+        namespace and the namespaces nested in it.
+        """
+        for patch_name in ['a', 'repo/b', 'repo/sub/c', 'repository/d']:
+            self._publish(patch_name, patch_name.encode())
+
+        assert_equal(self.store.get_patches(), ['a', 'repo/b', 'repo/sub/c', 'repository/d'])
+        assert_equal(self.store.get_patches('repo'), ['repo/b', 'repo/sub/c'])
+        assert_equal(self.store.get_patches('repo/sub/'), ['repo/sub/c'])
+        assert_equal(self.store.get_patches('missing'), [])
+        assert_raises(StashException, self.store.get_patches, 'repo/.sub')
+
+        self.store.remove('repo/b')
+        assert_equal(self.store.get_patches('repo'), ['repo/sub/c'])
+
+    def test_lookup_does_not_list_directories(self):
+        """Tests that patches are spread over directories, and are looked up by
+        name without listing any directory.
+        """
+        patch_names = ['p%d' % i for i in range(100)]
+        for patch_name in patch_names:
+            self._publish(patch_name, patch_name.encode())
+        assert_true(len(set(os.path.dirname(self.store.get_path(patch_name)) for patch_name in patch_names)) > 1)
+
+        def fail(*args):
+            raise AssertionError("directory listed")
+        self.addCleanup(setattr, os, 'listdir', os.listdir)
+        self.addCleanup(setattr, os, 'scandir', os.scandir)
+        os.listdir = os.scandir = fail
+
+        assert_true(self.store.exists('p42'))
+        assert_false(self.store.exists('p100'))
+        assert_equal(open(self.store.fetch('p42'), 'rb').read(), b'p42')
+        with self.store.lock(['p42']):
+            self.store.remove('p42')
+        assert_false(self.store.exists('p42'))
+
+    def test_flat_store_is_migrated(self):
+        """Tests that patches stored directly in the store directory by
+        earlier versions are moved into place.
+        """
+        path = os.path.join(self.path, 'flat')
+        os.mkdir(path)
+        open(os.path.join(path, 'a'), 'wb').write(b'A')
+        os.mkdir(os.path.join(path, 'b'))
+        open(os.path.join(path, '.hidden'), 'wb').write(b'H')
+
+        store = PatchStore(path)
+        assert_equal(store.get_patches(), ['a', 'b'])
+        assert_equal(open(store.fetch('a'), 'rb').read(), b'A')
+        assert_true(os.path.isdir(store.get_path('b')))
+        assert_equal(sorted(os.listdir(path)), ['.hidden', '.locks', '.patches'])
+
+    def test_migrated_store_is_not_examined(self):
+        """Tests that a store is only examined for patches of earlier versions
+        once, and that constructing it while its lock is held does not block.
+        """
+        def fail(*args):
+            raise AssertionError("directory listed")
+        self.addCleanup(setattr, os, 'listdir', os.listdir)
+        os.listdir = fail
+
+        with self.store.lock():
+            assert_equal(PatchStore(self.path).path, self.path)
+
+class TestConcurrentAccess(unittest.TestCase):
+
+    PROCESSES = 8
+
+    def setUp(self):
+        self.path = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.path)
+
+        self.addCleanup(setattr, Stash, 'STASH_PATH', Stash.STASH_PATH)
+        Stash.STASH_PATH = os.path.join(self.path, 'stash')
+
+    def test_readers_never_see_partial_patches(self):
+        """Tests that many processes overwriting, reading and removing the same
+        patches never read a partially written patch, and leave no temporary
+        files behind.
+        """
+        with ProcessPoolExecutor(self.PROCESSES) as executor:
+            futures = [executor.submit(_write_and_read_patches, Stash.STASH_PATH, worker, 300)
+                       for worker in range(self.PROCESSES)]
+            errors = sum((future.result() for future in futures), [])
+        assert_equal(errors, [])
+
+        for patch_name in Stash.get_patches():
+            assert_in(patch_name, ['p0', 'p1', 'p2'])
+            assert_true(_is_complete(Stash.get_patch(patch_name).encode()))
+        assert_equal(sorted(os.listdir(Stash.STASH_PATH)), ['.index.sqlite', '.locks', '.patches'])
+
+        store = Stash._get_store()
+        patch_paths = [os.path.join(directory, file_name)
+                       for directory, _, file_names in os.walk(os.path.join(Stash.STASH_PATH, store.PATCHES_DIRECTORY))
+                       for file_name in file_names if not file_name.startswith('.lock.')]
+        assert_equal(sorted(patch_paths), sorted(store.get_path(patch_name) for patch_name in Stash.get_patches()))
+
+    def test_patch_is_applied_once(self):
+        """Tests that each patch is applied by exactly one of many processes
+        applying the same patches to their own working copies.
+        """
+        repository_paths = []
+        for worker in range(self.PROCESSES):
+            repository_path = os.path.join(self.path, 'repo%d' % worker)
+            repository = GitRepository(repository_path, create=True)
+            open(os.path.join(repository_path, 'a'), 'w').write('1\n')
+            repository.add(['a'])
+            repository.commit('Initial commit.')
+            repository_paths.append(repository_path)
+
+        patch_names = ['p%d' % i for i in range(20)]
+        stash = Stash(repository_paths[0])
+        for i, patch_name in enumerate(patch_names):
+            open(os.path.join(repository_paths[0], 'f%d' % i), 'w').write('%d\n' % i)
+            stash.repository.add(['f%d' % i])
+            assert_true(stash.create_patch(patch_name))
+
+        with ProcessPoolExecutor(self.PROCESSES) as executor:
+            futures = [executor.submit(_apply_patches, Stash.STASH_PATH, repository_path, patch_names)
+                       for repository_path in repository_paths]
+            applied = sum((future.result() for future in futures), [])
+
+        assert_equal(sorted(applied), sorted(patch_names))
+        assert_equal(Stash.get_patches(), [])
+
+class TestHttpPatchStore(unittest.TestCase):
+
+    def setUp(self):
+        """Starts a patch store server in a separate thread, and creates two
+        stores using it, each with their own cache.
+        """
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        server = PatchStoreServer(('localhost', 0), os.path.join(self.path, 'server'))
+        self.connections = []
+        process_request = server.process_request
+        def count_connections(request, client_address):
+            self.connections.append(client_address)
+            process_request(request, client_address)
+        server.process_request = count_connections
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(_pool.close)
+
+        self.url = server.url
+        self.store = HttpPatchStore(self.url, os.path.join(self.path, 'a'))
+        self.other_store = HttpPatchStore(self.url, os.path.join(self.path, 'b'))
+
+    def _push(self, store, patch_name, contents, overwrite=False):
+        """Stores a patch named *patch_name* containing *contents* in
+        *store*.
+        """
+        patch_path = store.get_path(patch_name)
+        os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+        with open(patch_path, 'wb') as patch_file:
+            patch_file.write(contents)
+        store.push(patch_name, overwrite)
+
+    def test_patches_are_shared(self):
+        """Tests that a patch stored by one store is available in the other
+        store, and that listing the patches does not download them.
+        """
+        self._push(self.store, 'a', b'A' * 100000)
+        assert_true(self.other_store.exists('a'))
+        assert_false(self.other_store.exists('b'))
+
+        assert_equal(self.other_store.get_patches(), ['a'])
+        assert_false(os.path.exists(self.other_store.get_path('a')))
+        assert_equal(open(self.other_store.fetch('a'), 'rb').read(), b'A' * 100000)
+
+    def test_changed_patch_is_removed_from_cache(self):
+        """Tests that listing the patches removes the cached copy of a patch
+        that changed on the server, and that it is downloaded again once
+        fetched.
+        """
+        self._push(self.store, 'a', b'A')
+        self.other_store.fetch('a')
+        assert_equal(self.other_store.get_patches(), ['a'])
+        assert_true(os.path.exists(self.other_store.get_path('a')))
+
+        self._push(self.store, 'a', b'AA', overwrite=True)
+        assert_equal(self.other_store.get_patches(), ['a'])
+        assert_false(os.path.exists(self.other_store.get_path('a')))
+        assert_equal(open(self.other_store.fetch('a'), 'rb').read(), b'AA')
+
+    def test_cached_patch_is_validated(self):
+        """Tests that a cached patch is only downloaded again in case it
+        changed on the server.
+        """
+        self._push(self.store, 'a', b'A')
+        patch_path = self.other_store.fetch('a')
+        inode = os.stat(patch_path).st_ino
+
+        # Another instance uses the recorded entity tag.
+        other_store = HttpPatchStore(self.url, self.other_store.path)
+        assert_equal(other_store.fetch('a'), patch_path)
+        assert_equal(os.stat(patch_path).st_ino, inode)
+
+        self._push(self.store, 'a', b'AA', overwrite=True)
+        assert_equal(open(other_store.fetch('a'), 'rb').read(), b'AA')
+
+    def test_removed_patch_is_removed_from_cache(self):
+        """Tests that a patch removed from the server by one store, disappears
+        from the cache of the other store.
+        """
+        self._push(self.store, 'a', b'A')
+        self._push(self.store, 'b', b'B')
+        assert_equal(self.other_store.get_patches(), ['a', 'b'])
+        self.other_store.fetch('a')
+
+        self.store.remove('a')
+        assert_equal(self.other_store.get_patches(), ['b'])
+        assert_false(os.path.exists(self.other_store.get_path('a')))
+        assert_raises(StashException, self.other_store.fetch, 'a')
+        assert_raises(StashException, self.other_store.remove, 'a')
+
+    def test_existing_patch_is_not_overwritten(self):
+        """Tests that storing a new patch fails in case another store already
+        stored a patch with the same name.
+        """
+        self._push(self.store, 'a', b'A')
+        assert_raises(StashException, self._push, self.other_store, 'a', b'B')
+        assert_equal(open(self.store.fetch('a'), 'rb').read(), b'A')
+
+    def test_listing_is_scoped_to_namespace(self):
+        """Tests that the server lists the patches in a namespace only, and
+        that listing a namespace only prunes cached patches in that namespace.
+        """
+        for patch_name in ['a', 'repo/b', 'repo/sub/c']:
+            self._push(self.store, patch_name, patch_name.encode())
+        assert_equal(self.other_store.get_patches(), ['a', 'repo/b', 'repo/sub/c'])
+        assert_equal(self.other_store.get_patches('repo'), ['repo/b', 'repo/sub/c'])
+        for patch_name in ['a', 'repo/b']:
+            self.other_store.fetch(patch_name)
+        assert_equal(open(self.other_store.fetch('repo/sub/c'), 'rb').read(), b'repo/sub/c')
+
+        self.store.remove('a')
+        self.store.remove('repo/b')
+        assert_equal(self.other_store.get_patches('repo'), ['repo/sub/c'])
+        assert_true(os.path.exists(self.other_store.get_path('a')))
+        assert_false(os.path.exists(self.other_store.get_path('repo/b')))
+
+    def test_connections_are_reused(self):
+        """Tests that consecutive requests use a single connection."""
+        for patch_name in ['a', 'b', 'c']:
+            self._push(self.store, patch_name, patch_name.encode())
+        self.other_store.get_patches()
+        self.store.remove('b')
+        assert_equal(len(self.connections), 1)
+
+    def test_stash_uses_store(self):
+        """Tests that a stash lists, shows and removes the patches of a shared
+        store.
+        """
+        self.addCleanup(setattr, Stash, 'STASH_PATH', Stash.STASH_PATH)
+        self.addCleanup(setattr, Stash, 'STORE_URL', Stash.STORE_URL)
+        Stash.STASH_PATH = os.path.join(self.path, 'stash')
+        Stash.STORE_URL = self.url
+
+        self._push(self.store, 'a', b'--- a/a\n+++ b/a\n@@ -1,1 +1,1 @@\n-1\n+2\n')
+        assert_equal(Stash.get_patches(), ['a'])
+        assert_equal([patch_info.name for patch_info in Stash.find_patches(touches='a')], ['a'])
+        assert_in('+2', Stash.get_patch('a'))
+        assert_equal(Stash.get_patch_stat('a'), [('a', 1, 1, False)])
+
+        Stash.remove_patch('a')
+        assert_equal(self.store.get_patches(), [])
+        assert_raises(StashException, Stash.get_patch, 'a')
@@ -0,0 +1,60 @@
+import io
+import json
+import unittest
+
+from nose.tools import assert_equal, assert_is_none
+
+from stash import trace
+
+@trace.traced
+def _double(value):
+    return 2 * value
+
+class TestTrace(unittest.TestCase):
+
+    def tearDown(self):
+        trace.disable()
+
+    def test_disabled_tracing_records_nothing(self):
+        """Tests that traced functions behave normally when tracing is
+        disabled.
+        """
+        assert_is_none(trace.get_tracer())
+        assert_equal(_double(2), 4)
+
+    def test_traced_function_is_recorded(self):
+        """Tests that each call of a traced function is recorded as an
+        operation.
+        """
+        tracer = trace.enable()
+        assert_equal(_double(2), 4)
+        _double(3)
+
+        assert_equal([(event.name, event.category) for event in tracer.events], [('_double', 'operation')] * 2)
+        assert_equal([entry[:3] for entry in tracer.get_summary()], [('operation', '_double', 2)])
+
+    def test_summary_groups_commands(self):
+        """Tests that commands are grouped on their program and first argument
+        in the summary.
+        """
+        tracer = trace.enable()
+        tracer.add_command(['hg', 'stat', 'a'], tracer.now(), 0, 10)
+        tracer.add_command(['hg', 'stat', 'b'], tracer.now(), 0, 5)
+        tracer.add_command(['hg', 'diff'], tracer.now(), 1, None)
+
+        summary = sorted(entry[:3] + entry[4:] for entry in tracer.get_summary())
+        assert_equal(summary, [('command', 'hg diff', 1, 0), ('command', 'hg stat', 2, 15)])
+
+    def test_write_chrome_trace(self):
+        """Tests that events are written in the Chrome trace event format."""
+        tracer = trace.enable()
+        tracer.add_command(['hg', 'diff', '-a'], tracer.now(), 0, 42)
+
+        output = io.StringIO()
+        tracer.write_chrome_trace(output)
+        events = json.loads(output.getvalue())['traceEvents']
+
+        assert_equal(len(events), 1)
+        assert_equal(events[0]['name'], 'hg diff -a')
+        assert_equal(events[0]['ph'], 'X')
+        assert_equal(events[0]['args'], {'exit_code': 0, 'output_bytes': 42})
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import assert_equal, assert_is_none, assert_raises
+
+from stash.watcher import InotifyWatcher, PollingWatcher, Watcher
+
+class WatcherTestCase(object):
+    """Tests that apply to all watcher implementations."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.mkdir(os.path.join(self.path, '.vcs'))
+        self._write('a', 'a')
+
+        self.watcher = self.WATCHER_CLS(self.path, '.vcs', ['state'])
+        self.addCleanup(self.watcher.close)
+
+    def _write(self, file_name, contents):
+        """Writes *contents* to the file *file_name* in the working copy."""
+        with open(os.path.join(self.path, file_name), 'w') as f:
+            f.write(contents)
+
+    def test_dirty_paths_are_unknown_until_reset(self):
+        """Tests that the dirty paths are only known after the first reset."""
+        assert_is_none(self.watcher.get_dirty_paths())
+        self.watcher.reset(['x'], self.watcher.generation)
+        assert_equal(self.watcher.get_dirty_paths(), ['x'])
+
+    def test_changed_paths_are_dirty(self):
+        """Tests that modified, created and removed files are dirty, including
+        files in new directories.
+        """
+        self.watcher.reset([], self.watcher.generation)
+        self._write('a', 'b')
+        self._write('b', 'b')
+        os.makedirs(os.path.join(self.path, 'c', 'd'))
+        self._write(os.path.join('c', 'd', 'e'), 'e')
+        assert_equal(self.watcher.get_dirty_paths(), ['a', 'b', 'c', os.path.join('c', 'd'), os.path.join('c', 'd', 'e')])
+
+        self.watcher.reset([], self.watcher.generation)
+        os.unlink(os.path.join(self.path, 'a'))
+        assert_equal(self.watcher.get_dirty_paths(), ['a'])
+
+    def test_changes_during_scan_remain_dirty(self):
+        """Tests that paths that change after a full scan started are not
+        discarded by resetting the dirty paths.
+        """
+        generation = self.watcher.generation
+        self._write('a', 'b')
+        self.watcher.reset(['b'], generation)
+        assert_equal(self.watcher.get_dirty_paths(), ['a', 'b'])
+
+    def test_state_changes(self):
+        """Tests that changes to the state files make the dirty paths unknown,
+        unless they are made by own commands.
+        """
+        self.watcher.reset([], self.watcher.generation)
+        with self.watcher.own_changes():
+            self._write(os.path.join('.vcs', 'state'), '1')
+        assert_equal(self.watcher.get_dirty_paths(), [])
+
+        self._write(os.path.join('.vcs', 'state'), '22')
+        assert_is_none(self.watcher.get_dirty_paths())
+
+class TestInotifyWatcher(WatcherTestCase, unittest.TestCase):
+
+    WATCHER_CLS = InotifyWatcher
+
+class TestPollingWatcher(WatcherTestCase, unittest.TestCase):
+
+    WATCHER_CLS = PollingWatcher
+
+class TestWatcher(unittest.TestCase):
+
+    def test_watcher_without_poll_is_abstract(self):
+        """Tests that a watcher that does not implement polling can not be
+        instantiated.
+        """
+        class IncompleteWatcher(Watcher):
+            pass
+        assert_raises(TypeError, IncompleteWatcher, tempfile.gettempdir(), '.vcs', [])